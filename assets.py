@@ -0,0 +1,88 @@
+"""
+Реестр изображений из images/ с кэшем Telegram file_id
+
+Файл загружается в Telegram один раз, полученный file_id хранится в БД
+(telegram_assets) и переиспользуется. Повторная загрузка — только если
+изменилось содержимое файла (sha256).
+"""
+import hashlib
+import logging
+import os
+from typing import Dict, Tuple
+
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import FSInputFile, Message
+
+from database import db
+
+logger = logging.getLogger(__name__)
+
+ASSETS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'images')
+
+
+class AssetRegistry:
+    def __init__(self, directory: str = ASSETS_DIR):
+        self.directory = directory
+        # name -> (sha256, file_id)
+        self._file_ids: Dict[str, Tuple[str, str]] = {}
+        # name -> (mtime_ns, size, sha256): не перечитываем неизменённые файлы
+        self._hashes: Dict[str, Tuple[int, int, str]] = {}
+        self._loaded = False
+        # False — не читать и не сохранять file_id в БД (симуляция с фейковым ботом)
+        self.persist = True
+
+    async def load(self):
+        """Загрузить сохранённые file_id из БД"""
+        self._file_ids = await db.get_telegram_assets()
+        self._loaded = True
+        logger.info(f"🖼️ Loaded {len(self._file_ids)} cached Telegram assets")
+
+    def content_hash(self, name: str) -> str:
+        """sha256 файла; пересчитывается только при смене mtime/размера"""
+        path = os.path.join(self.directory, name)
+        stat = os.stat(path)
+        cached = self._hashes.get(name)
+        if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+            return cached[2]
+
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                digest.update(chunk)
+        sha256 = digest.hexdigest()
+        self._hashes[name] = (stat.st_mtime_ns, stat.st_size, sha256)
+        return sha256
+
+    async def send_photo(self, bot, chat_id: int, name: str, **kwargs) -> Message:
+        """Отправить изображение по file_id, при отсутствии или смене файла — загрузить"""
+        if not self._loaded and self.persist:
+            try:
+                await self.load()
+            except Exception as e:
+                logger.error(f"Failed to load Telegram assets: {e}")
+
+        sha256 = self.content_hash(name)
+        cached = self._file_ids.get(name)
+        if cached and cached[0] == sha256:
+            try:
+                return await bot.send_photo(chat_id, photo=cached[1], **kwargs)
+            except TelegramBadRequest as e:
+                # file_id мог стать недействительным (например, сменили бота)
+                logger.warning(f"Cached file_id for {name} rejected, re-uploading: {e}")
+
+        message = await bot.send_photo(
+            chat_id, photo=FSInputFile(os.path.join(self.directory, name)), **kwargs
+        )
+        file_id = message.photo[-1].file_id
+        self._file_ids[name] = (sha256, file_id)
+        if self.persist:
+            try:
+                await db.save_telegram_asset(name, sha256, file_id)
+            except Exception as e:
+                logger.error(f"Failed to save file_id for {name}: {e}")
+        logger.info(f"Uploaded asset {name} to Telegram")
+        return message
+
+
+# Глобальный экземпляр
+assets = AssetRegistry()
@@ -0,0 +1,92 @@
+"""
+Реестр чатов, недоступных для бота
+
+Заполняется по ошибкам Telegram Forbidden / chat not found и по апдейтам
+my_chat_member. Множество держится в памяти (загружается при старте), таблица
+blocked_chats — источник истины для SQL-фильтров (запрос напоминаний).
+"""
+import logging
+from typing import Set
+
+from aiogram.exceptions import TelegramForbiddenError
+
+from database import db
+
+logger = logging.getLogger(__name__)
+
+
+class ChatBlockedError(Exception):
+    """Отправка в чат из реестра заблокированных — в Telegram не ходим"""
+
+    def __init__(self, chat_id: int):
+        super().__init__(f"Chat {chat_id} is in blocked_chats (bot was blocked)")
+        self.chat_id = chat_id
+
+
+def is_unreachable_error(error: BaseException) -> bool:
+    """Ошибка означает, что писать в этот чат бессмысленно"""
+    if isinstance(error, (TelegramForbiddenError, ChatBlockedError)):
+        return True
+    text = str(error)
+    return "bot was blocked" in text or "chat not found" in text or "user is deactivated" in text
+
+
+class BlockedChats:
+    def __init__(self):
+        self._chats: Set[int] = set()
+
+    async def load(self):
+        """Загрузить реестр из БД"""
+        async with db.acquire() as conn:
+            rows = await conn.fetch("SELECT chat_id FROM blocked_chats")
+        self._chats = {row['chat_id'] for row in rows}
+        logger.info(f"🚫 Loaded {len(self._chats)} blocked chats")
+
+    def is_blocked(self, chat_id) -> bool:
+        return chat_id in self._chats
+
+    def __len__(self) -> int:
+        return len(self._chats)
+
+    async def mark(self, chat_id: int, reason: str):
+        """Добавить чат в реестр и снять запланированные напоминания"""
+        if chat_id in self._chats:
+            return
+        self._chats.add(chat_id)
+        try:
+            async with db.acquire() as conn:
+                async with conn.transaction():
+                    await conn.execute("""
+                        INSERT INTO blocked_chats (chat_id, reason) VALUES ($1, $2)
+                        ON CONFLICT (chat_id) DO NOTHING
+                    """, chat_id, reason[:200])
+                    await conn.execute(
+                        "UPDATE users SET next_reminder_at = NULL WHERE user_id = $1", chat_id
+                    )
+            logger.warning(f"Chat {chat_id} marked as blocked: {reason}")
+        except Exception as e:
+            logger.error(f"Failed to persist blocked chat {chat_id}: {e}")
+
+    async def unmark(self, chat_id: int):
+        """Пользователь снова доступен: убрать из реестра и пересчитать напоминания"""
+        self._chats.discard(chat_id)
+        try:
+            async with db.acquire() as conn:
+                async with conn.transaction():
+                    deleted = await conn.execute(
+                        "DELETE FROM blocked_chats WHERE chat_id = $1", chat_id
+                    )
+                    if deleted != "DELETE 0":
+                        # Планировщик сам решит, что ещё положено отправить
+                        await conn.execute("""
+                            UPDATE users SET next_reminder_at = NOW()
+                            WHERE user_id = $1 AND next_reminder_at IS NULL
+                              AND (completed_at IS NULL OR promo_code IS NOT NULL)
+                        """, chat_id)
+            logger.info(f"Chat {chat_id} unblocked")
+        except Exception as e:
+            logger.error(f"Failed to unblock chat {chat_id}: {e}")
+
+
+# Глобальный экземпляр
+blocked = BlockedChats()
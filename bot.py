@@ -2,22 +2,36 @@
 YouTravel × Яндекс.Путешествия Telegram Bot
 """
 import asyncio
+import html
 import logging
 from aiogram import Bot, Dispatcher, F
 from aiogram.filters import Command, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.types import Message, CallbackQuery
+from aiogram.enums import ChatMemberStatus
+from aiogram.types import Message, CallbackQuery, FSInputFile, ChatMemberUpdated
 from datetime import datetime
-import time
+import os
 
 import config
 from database import db
 from sheets import sheets
-from keyboards import get_main_menu, get_confirmation_keyboard, remove_keyboard, get_main_menu_inline
-from utils import validate_email, normalize_email, validate_inn, normalize_inn, mask_email, mask_inn
-from monitoring import monitoring
+from keyboards import get_main_menu, get_confirmation_keyboard, remove_keyboard, get_main_menu_inline, get_pagination_keyboard
+from utils import validate_email, normalize_email, validate_inn, normalize_inn, mask_email, mask_inn, encode_cursor, decode_cursor
+from monitoring import monitoring, handler_metrics
 from reminders import reminders
+from events import events
+from export import EXPORT_QUERIES, export_to_tempfile, parse_export_filters
+from outbound import gateway
+from assets import assets
+from leases import leases
+from outbox import outbox
+from blocked import blocked
+from notifications import notifier
+from templates import templates
+from loopwatch import watchdog
+from scheduler import scheduler
+from errorrate import error_rates, SUBSYSTEM_TITLES
 
 # Logging
 logging.basicConfig(
@@ -39,6 +53,10 @@ class SupportStates(StatesGroup):
 bot = Bot(token=config.BOT_TOKEN)
 dp = Dispatcher()
 
+# Число апдейтов и латентность по хендлерам для /metrics
+for observer in (dp.message, dp.callback_query, dp.my_chat_member):
+    observer.middleware(handler_metrics)
+
 # ============================================================================
 # АДМИНСКИЕ КОМАНДЫ (ПЕРВЫМИ!)
 # ============================================================================
@@ -69,10 +87,14 @@ async def cmd_admin(message: Message):
         f"• /admin_users - список пользователей\n"
         f"• /admin_incomplete - пользователи в процессе регистрации\n"
         f"• /admin_find username - найти пользователя по username\n"
+        f"• /admin_search запрос - поиск по ID, username, email, ИНН, промокоду\n"
         f"• /admin_reset user_id - сбросить пользователя\n"
         f"• /admin_promos - проверить промокоды\n"
         f"• /admin_monitor - мониторинг системы\n"
+        f"• /admin_db - пул соединений БД\n"
         f"• /admin_reminders - управление напоминаниями\n"
+        f"• /admin_funnel [дней] - воронка регистрации\n"
+        f"• /admin_export users|reminders - выгрузка в CSV\n"
         f"• /admin_clear - очистить базу данных\n"
         f"• /admin_check_email email - проверить дубликаты\n"
         f"• /admin_fix_user user_id inn promo - исправить данные\n"
@@ -142,35 +164,31 @@ async def cmd_admin_users(message: Message):
     
     await message.answer(text, parse_mode="HTML")
 
-@dp.message(Command("admin_incomplete"))
-async def cmd_admin_incomplete(message: Message):
-    """Список пользователей в процессе регистрации"""
-    user_id = message.from_user.id
-    
-    if not is_admin(user_id):
-        await message.answer("❌ У вас нет прав администратора.")
-        return
-    
-    # Получаем пользователей в процессе регистрации
-    async with db.pool.acquire() as conn:
-        incomplete_users = await conn.fetch('''
-            SELECT user_id, telegram_username, email, step, created_at
-            FROM users 
-            WHERE completed_at IS NULL 
-            AND step != 'start'
-            ORDER BY created_at DESC
-        ''')
-    
-    if not incomplete_users:
-        await message.answer("📝 Пользователей в процессе регистрации не найдено.")
-        return
-    
+INCOMPLETE_OUTREACH_TEXT = (
+    "📱 <b>Инструкция для отправки сообщений:</b>\n"
+    "1. Скопируйте список с @ из вывода выше\n"
+    "2. В Telegram перейдите в поиск\n"
+    "3. Вставьте список никнеймов (по одному)\n"
+    "4. Отправьте каждому сообщение:\n\n"
+    "Привет! Я Иван, фаундер и директор по продукту в U-Travel. Увидел, что ты начал участвовать в нашей акции с Яндекс.Путешествиями, но до конца не дошёл — не получил промокод.\n\n"
+    "Можешь, пожалуйста, рассказать, что остановило? Хочу понять, как сделать всё проще/понятнее, и что вообще тебе сейчас актуально. Мы реально хотим сделать эту историю удобной и полезной для тревел-экспертов — честно, очень ценю фидбек 🙌"
+)
+
+STEP_NAMES = {
+    'start': 'начало',
+    'email': 'ввод email',
+    'inn': 'ввод ИНН',
+    'confirmation': 'подтверждение'
+}
+
+def format_incomplete_page(users: list) -> str:
+    """Страница списка /admin_incomplete"""
     # Группируем по типам username
     usernames_with_at = []
     usernames_without_at = []
     users_without_username = []
     
-    for user in incomplete_users:
+    for user in users:
         username = user['telegram_username']
         if username:
             usernames_with_at.append(f"@{username}")
@@ -182,8 +200,7 @@ async def cmd_admin_incomplete(message: Message):
                 'created_at': user['created_at'].strftime('%d.%m.%Y %H:%M')
             })
     
-    # Формируем ответ
-    text = f"👥 <b>Пользователи в процессе регистрации ({len(incomplete_users)}):</b>\n\n"
+    text = f"👥 <b>Пользователи в процессе регистрации:</b>\n\n"
     
     if usernames_with_at:
         text += "🔗 <b>С @ (для поиска в Telegram):</b>\n"
@@ -205,23 +222,105 @@ async def cmd_admin_incomplete(message: Message):
     
     # Добавляем детальную информацию
     text += "📋 <b>Детали:</b>\n"
-    for i, user in enumerate(incomplete_users, 1):
+    for user in users:
         username = f"@{user['telegram_username']}" if user['telegram_username'] else "не указан"
         email = user['email'] or 'не указан'
-        step = user['step']
         created_at = user['created_at'].strftime('%d.%m.%Y %H:%M')
-        text += f"{i:2d}. ID: {user['user_id']} | @{username} | {email} | {step} | {created_at}\n"
+        text += f"• ID: {user['user_id']} | {username} | {email} | {user['step']} | {created_at}\n"
     
-    # Добавляем инструкцию
-    text += "\n📱 <b>Инструкция для отправки сообщений:</b>\n"
-    text += "1. Скопируйте список с @ из вывода выше\n"
-    text += "2. В Telegram перейдите в поиск\n"
-    text += "3. Вставьте список никнеймов (по одному)\n"
-    text += "4. Отправьте каждому сообщение:\n\n"
-    text += "Привет! Я Иван, фаундер и директор по продукту в U-Travel. Увидел, что ты начал участвовать в нашей акции с Яндекс.Путешествиями, но до конца не дошёл — не получил промокод.\n\n"
-    text += "Можешь, пожалуйста, рассказать, что остановило? Хочу понять, как сделать всё проще/понятнее, и что вообще тебе сейчас актуально. Мы реально хотим сделать эту историю удобной и полезной для тревел-экспертов — честно, очень ценю фидбек 🙌"
+    return text
+
+def format_reminders_page(users: list) -> str:
+    """Страница списка незавершённых регистраций для /admin_reminders"""
+    text = f"⏳ <b>Незавершенные регистрации:</b>\n\n"
+    for user in users:
+        date = user['created_at'].strftime('%d.%m %H:%M')
+        username = f"@{user['telegram_username']}" if user['telegram_username'] else "без username"
+        email = mask_email(user['email']) if user['email'] else "не указан"
+        step_name = STEP_NAMES.get(user['step'], user['step'])
+        text += f"• ID: {user['user_id']} ({username})\n"
+        text += f"  📧 {email}\n"
+        text += f"  📍 Этап: {step_name}\n"
+        text += f"  📅 {date}\n\n"
+    return text
+
+# Префикс callback_data -> (фильтр списка, форматтер страницы)
+ADMIN_LISTINGS = {
+    'pg_inc': {'exclude_start': True, 'format': format_incomplete_page},
+    'pg_rem': {'exclude_start': False, 'format': format_reminders_page},
+}
+
+async def build_admin_page(prefix: str, after=None, before=None):
+    """Загружает страницу админского списка (один индексный запрос) и строит текст с кнопками"""
+    listing = ADMIN_LISTINGS[prefix]
+    page = await db.get_incomplete_users_page(
+        config.ADMIN_PAGE_SIZE,
+        after=after,
+        before=before,
+        exclude_start=listing['exclude_start']
+    )
+    rows = page['rows']
+    if not rows:
+        return None, None
+    
+    first, last = rows[0], rows[-1]
+    keyboard = get_pagination_keyboard(
+        prefix,
+        encode_cursor(first['created_at'], first['user_id']) if page['has_prev'] else None,
+        encode_cursor(last['created_at'], last['user_id']) if page['has_next'] else None
+    )
+    return listing['format'](rows), keyboard
+
+@dp.message(Command("admin_incomplete"))
+async def cmd_admin_incomplete(message: Message):
+    """Список пользователей в процессе регистрации"""
+    user_id = message.from_user.id
     
-    await message.answer(text, parse_mode="HTML")
+    if not is_admin(user_id):
+        await message.answer("❌ У вас нет прав администратора.")
+        return
+    
+    text, keyboard = await build_admin_page('pg_inc')
+    
+    if not text:
+        await message.answer("📝 Пользователей в процессе регистрации не найдено.")
+        return
+    
+    await message.answer(text, reply_markup=keyboard, parse_mode="HTML")
+    await message.answer(INCOMPLETE_OUTREACH_TEXT, parse_mode="HTML")
+
+@dp.callback_query(F.data.startswith("pg_"))
+async def callback_admin_page(callback: CallbackQuery):
+    """Навигация по страницам админских списков (редактирует то же сообщение)"""
+    if not is_admin(callback.from_user.id):
+        await callback.answer("❌ Нет прав", show_alert=True)
+        return
+    
+    try:
+        prefix, direction, raw_cursor = callback.data.split(':', 2)
+    except ValueError:
+        await callback.answer()
+        return
+    
+    cursor = decode_cursor(raw_cursor)
+    if prefix not in ADMIN_LISTINGS or direction not in ('n', 'p') or not cursor:
+        await callback.answer()
+        return
+    
+    if direction == 'n':
+        text, keyboard = await build_admin_page(prefix, after=cursor)
+    else:
+        text, keyboard = await build_admin_page(prefix, before=cursor)
+    
+    if not text:
+        await callback.answer("Больше записей нет")
+        return
+    
+    try:
+        await callback.message.edit_text(text, reply_markup=keyboard, parse_mode="HTML")
+    except Exception as e:
+        logger.warning(f"Failed to edit admin page: {e}")
+    await callback.answer()
 
 @dp.message(Command("admin_find"))
 async def cmd_admin_find(message: Message):
@@ -242,11 +341,11 @@ async def cmd_admin_find(message: Message):
     
     try:
         # Ищем пользователя по username
-        async with db.pool.acquire() as conn:
+        async with db.acquire() as conn:
             user = await conn.fetchrow('''
                 SELECT user_id, telegram_username, email, inn, step, created_at, completed_at, promo_code
-                FROM users 
-                WHERE telegram_username = $1
+                FROM users_all 
+                WHERE lower(telegram_username) = lower($1)
                 ORDER BY created_at DESC
                 LIMIT 1
             ''', username)
@@ -289,6 +388,54 @@ async def cmd_admin_find(message: Message):
         logger.error(f"Error finding user: {e}")
         await message.answer(f"❌ Ошибка при поиске пользователя: {e}")
 
+@dp.message(Command("admin_search"))
+async def cmd_admin_search(message: Message):
+    """Поиск пользователей по ID, username, email, ИНН и промокоду (префикс и нечёткий)"""
+    user_id = message.from_user.id
+    
+    if not is_admin(user_id):
+        await message.answer("❌ У вас нет прав администратора.")
+        return
+    
+    parts = message.text.split(maxsplit=1)
+    if len(parts) < 2 or not parts[1].strip():
+        await message.answer(
+            "🔎 <b>Использование:</b>\n"
+            "<code>/admin_search запрос</code>\n\n"
+            "Ищет по ID, username, email, ИНН и промокоду.",
+            parse_mode="HTML"
+        )
+        return
+    
+    query = parts[1].strip().lstrip('@')
+    
+    try:
+        results = await db.search_users(query)
+    except Exception as e:
+        logger.error(f"Error searching users: {e}")
+        await message.answer(f"❌ Ошибка поиска: {e}")
+        return
+    
+    if not results:
+        await message.answer(f"❌ По запросу <code>{html.escape(query)}</code> ничего не найдено.", parse_mode="HTML")
+        return
+    
+    text = f"🔎 <b>Результаты поиска:</b> <code>{html.escape(query)}</code>\n\n"
+    for user in results:
+        status = "✅" if user['completed_at'] else "⏳"
+        username = f" @{user['telegram_username']}" if user['telegram_username'] else ""
+        archived = " 🗄️" if user['archived'] else ""
+        text += f"{status} ID: <code>{user['user_id']}</code>{username}{archived}\n"
+        if user['email']:
+            text += f"   📧 {html.escape(user['email'])}\n"
+        if user['inn']:
+            text += f"   🏢 {user['inn']}\n"
+        if user['promo_code']:
+            text += f"   🎟️ {user['promo_code']}\n"
+        text += f"   📍 {user['step']} | 📅 {user['created_at'].strftime('%d.%m.%Y %H:%M')}\n\n"
+    
+    await message.answer(text, parse_mode="HTML")
+
 @dp.message(Command("admin_reset"))
 async def cmd_admin_reset(message: Message):
     """Сброс пользователя (админ)"""
@@ -349,17 +496,25 @@ async def cmd_admin_monitor(message: Message):
         return
     
     try:
-        # Проверяем здоровье системы
-        health = await monitoring.check_system_health()
-        metrics = await monitoring.check_metrics()
+        # Проверяем здоровье системы (параллельно, результат кэшируется на несколько секунд)
+        health, metrics = await asyncio.gather(
+            monitoring.check_system_health(),
+            monitoring.check_metrics()
+        )
         
         # Формируем отчет
         report = f"🔍 <b>Мониторинг системы</b>\n\n"
         
         # Состояние системы
-        report += f"🔧 <b>Состояние:</b>\n"
-        report += f"• База данных: {'✅' if health['database'] else '❌'}\n"
-        report += f"• Google Sheets: {'✅' if health['google_sheets'] else '❌'}\n"
+        checks = health['checks']
+        report += f"🔧 <b>Состояние</b> (на {health['timestamp'].strftime('%H:%M:%S')}):\n"
+        for title, name in (('База данных', 'database'), ('Google Sheets', 'google_sheets'),
+                            ('Инвентарь промокодов', 'promo_inventory')):
+            check = checks[name]
+            report += f"• {title}: {'✅' if check['ok'] else '❌'} {check['latency_ms']:.0f} мс"
+            if check['error']:
+                report += f" — {html.escape(check['error'][:100])}"
+            report += "\n"
         report += f"• Промокоды: {health['promo_codes']}\n\n"
         
         # Метрики
@@ -374,15 +529,196 @@ async def cmd_admin_monitor(message: Message):
         if alerts:
             report += f"⚠️ <b>Алерты:</b>\n"
             for alert in alerts:
-                report += f"• {alert}\n"
+                report += f"• {alert['text']}\n"
         else:
             report += f"✅ <b>Все в порядке</b>\n"
         
+        # Фоновые задачи этой реплики
+        report += f"\n⏱ <b>Фоновые задачи:</b>\n"
+        for job in scheduler.get_stats():
+            if not job['active']:
+                state = "⏸ резерв"
+            elif job['running']:
+                state = "▶️"
+            else:
+                state = "✅"
+            report += f"• {job['name']} [{job['schedule']}]: {state}"
+            if job['runs']:
+                report += f", запусков {job['runs']}, avg {job['avg_ms']:.0f} мс, max {job['max_ms']:.0f} мс"
+            if job['failures']:
+                report += f", ошибок {job['failures']}"
+            if job['active'] and job['next_run_at'] and not job['running']:
+                report += f", далее {job['next_run_at'].strftime('%d.%m %H:%M')}"
+            report += "\n"
+            if job['last_error']:
+                report += f"  ↳ {html.escape(job['last_error'][:100])}\n"
+        for lease in leases.get_status():
+            if 'partitions' in lease:
+                report += (
+                    f"• {lease['name']}: партиции {len(lease['partitions'])}/{lease['count']}, "
+                    f"реплик {lease['members']}\n"
+                )
+        
+        # Очередь исходящих сообщений
+        queue = await outbox.get_stats()
+        report += (
+            f"\n📮 <b>Очередь сообщений:</b> ждут {queue['pending']} (готовы {queue['ready']}), "
+            f"ошибок за 24ч {queue['failed_24h']}\n"
+        )
+        if queue['oldest']:
+            report += f"• Самое старое: {queue['oldest'].strftime('%d.%m %H:%M')}\n"
+        
+        # Шлюз исходящих сообщений
+        outbound = gateway.get_stats()
+        report += f"\n📤 <b>Исходящие:</b> в очереди {outbound['queue_depth']}"
+        if outbound['paused_for']:
+            report += f", пауза 429 ещё {outbound['paused_for']:.0f} с"
+        report += "\n"
+        for lane, lane_stats in outbound['lanes'].items():
+            report += (
+                f"• {lane}: ждут {lane_stats['pending']}, отправлено {lane_stats['sent']}, "
+                f"ошибок {lane_stats['failed']}, p95 {lane_stats['latency_p95_ms']:.0f} мс\n"
+            )
+        
+        # Ошибки по подсистемам за 5 и 60 минут
+        errors = [(name, values) for name, values in error_rates.get_stats().items() if values['last_60m']]
+        if errors:
+            report += f"\n🧯 <b>Ошибки (5 мин / час):</b>\n"
+            for subsystem, values in sorted(errors, key=lambda item: -item[1]['last_60m']):
+                report += (
+                    f"• {SUBSYSTEM_TITLES.get(subsystem, subsystem)}: "
+                    f"{values['last_5m']} / {values['last_60m']}\n"
+                )
+        
+        # Задержка event loop и блокирующие вызовы
+        loop_stats = watchdog.get_stats()
+        report += (
+            f"\n🐶 <b>Event loop:</b> p50 {loop_stats['lag_p50_ms']:.0f} мс, "
+            f"p95 {loop_stats['lag_p95_ms']:.0f} мс, p99 {loop_stats['lag_p99_ms']:.0f} мс, "
+            f"макс {loop_stats['lag_max_ms']:.0f} мс, остановок {loop_stats['stalls']}\n"
+        )
+        for offender in loop_stats['offenders']:
+            report += (
+                f"• <code>{html.escape(offender['site'])}</code>: {offender['count']}×, "
+                f"всего {offender['total_ms'] / 1000:.1f} с, худшая {offender['worst_ms']:.0f} мс"
+            )
+            if offender['blocking'] != offender['site']:
+                report += f" (в <code>{html.escape(offender['blocking'])}</code>)"
+            report += "\n"
+        
         await message.answer(report, parse_mode="HTML")
         
     except Exception as e:
         await message.answer(f"❌ Ошибка мониторинга: {e}")
 
+@dp.message(Command("admin_db"))
+async def cmd_admin_db(message: Message):
+    """Телеметрия пула соединений с БД"""
+    user_id = message.from_user.id
+    
+    if not is_admin(user_id):
+        await message.answer("❌ У вас нет прав администратора.")
+        return
+    
+    stats = db.get_pool_stats()
+    
+    report = f"🗄️ <b>Пул соединений БД</b>\n\n"
+    report += f"🔧 <b>Размер:</b>\n"
+    report += f"• Открыто: {stats['pool_size']} (свободно {stats['pool_idle']})\n"
+    report += f"• Лимиты: {stats['min_size']}–{stats['max_size']}, текущий {stats['soft_limit']}\n"
+    report += f"• Адаптивный режим: {'✅' if stats['adaptive'] else '❌'}\n"
+    report += f"• Занято сейчас: {stats['checked_out']} (пик {stats['checked_out_max']})\n\n"
+    
+    report += f"⏳ <b>Ожидание acquire:</b>\n"
+    report += f"• Всего: {stats['acquires']}, таймаутов: {stats['acquire_timeouts']}\n"
+    report += f"• Среднее: {stats['wait_avg_ms']:.1f} мс, p95: {stats['wait_p95_ms']:.1f} мс, макс: {stats['wait_max_ms']:.1f} мс\n\n"
+    
+    report += f"⚡ <b>Запросы:</b>\n"
+    report += f"• Всего: {stats['queries']}, ошибок: {stats['query_errors']}\n"
+    report += f"• Среднее: {stats['query_avg_ms']:.1f} мс, p95: {stats['query_p95_ms']:.1f} мс, макс: {stats['query_max_ms']:.1f} мс\n"
+    
+    replica = stats['replica']
+    if replica:
+        lag = f"{stats['replica_lag']:.1f} с" if stats['replica_lag'] is not None else "нет данных"
+        report += f"\n🪞 <b>Реплика:</b> {'✅ в работе' if stats['replica_ok'] else '⚠️ отключена (чтение с primary)'}\n"
+        report += f"• Отставание: {lag}\n"
+        report += f"• Запросов: {replica['queries']}, p95: {replica['query_p95_ms']:.1f} мс\n"
+    
+    if stats['slow_queries']:
+        report += f"\n🐢 <b>Медленные запросы:</b>\n"
+        for query, seconds in stats['slow_queries']:
+            report += f"• {seconds * 1000:.0f} мс: <code>{html.escape(query)}</code>\n"
+    
+    await message.answer(report, parse_mode="HTML")
+
+FUNNEL_EVENT_NAMES = {
+    'start': '🚀 Старт',
+    'email_ok': '📧 Email принят',
+    'email_rejected': '🚫 Email отклонён',
+    'inn_ok': '🏢 ИНН введён',
+    'confirm': '✅ Подтверждение',
+    'promo_issued': '🎟️ Промокод выдан',
+    'reminder_sent': '🔔 Напоминание',
+}
+
+@dp.message(Command("admin_funnel"))
+async def cmd_admin_funnel(message: Message):
+    """Воронка регистрации по агрегатам событий"""
+    user_id = message.from_user.id
+    
+    if not is_admin(user_id):
+        await message.answer("❌ У вас нет прав администратора.")
+        return
+    
+    # /admin_funnel [days] — по умолчанию 7 дней, до 2 дней показываем по часам
+    parts = message.text.split()
+    try:
+        days = int(parts[1]) if len(parts) > 1 else 7
+    except ValueError:
+        await message.answer("❌ Использование: /admin_funnel [дней]")
+        return
+    granularity = 'hour' if days <= 2 else 'day'
+    
+    try:
+        rows = await events.get_funnel(granularity, days)
+    except Exception as e:
+        await message.answer(f"❌ Ошибка получения воронки: {e}")
+        return
+    
+    if not rows:
+        await message.answer("📈 Событий за период пока нет.")
+        return
+    
+    # Итоги по событиям
+    totals = {}
+    for row in rows:
+        count, seconds = totals.get(row['event'], (0, 0.0))
+        totals[row['event']] = (count + row['events'], seconds + row['seconds_total'])
+    
+    report = f"📈 <b>Воронка за {days} дн.</b>\n\n"
+    started = totals.get('start', (0, 0.0))[0]
+    for event, name in FUNNEL_EVENT_NAMES.items():
+        count, seconds = totals.get(event, (0, 0.0))
+        if not count:
+            continue
+        share = f" ({count / started * 100:.0f}%)" if started and event != 'start' else ""
+        avg_minutes = seconds / count / 60
+        report += f"• {name}: {count}{share}, ~{avg_minutes:.0f} мин от пред. шага\n"
+    
+    # Разбивка по бакетам: старты → промокоды
+    buckets = {}
+    for row in rows:
+        bucket = buckets.setdefault(row['bucket_start'], {})
+        bucket[row['event']] = row['events']
+    
+    report += f"\n🕐 <b>По {'часам' if granularity == 'hour' else 'дням'} (старт → промокод):</b>\n"
+    fmt = '%d.%m %H:00' if granularity == 'hour' else '%d.%m'
+    for bucket_start in sorted(buckets)[-24:]:
+        bucket = buckets[bucket_start]
+        report += f"• {bucket_start.strftime(fmt)}: {bucket.get('start', 0)} → {bucket.get('promo_issued', 0)}\n"
+    
+    await message.answer(report, parse_mode="HTML")
+
 @dp.message(Command("admin_reminders"))
 async def cmd_admin_reminders(message: Message):
     """Управление напоминаниями"""
@@ -394,33 +730,27 @@ async def cmd_admin_reminders(message: Message):
     
     try:
         # Получаем статистику напоминаний
-        async with db.pool.acquire() as conn:
-            # Создаем таблицу если не существует
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS user_reminders (
-                    user_id BIGINT,
-                    reminder_type TEXT,
-                    sent_at TIMESTAMP DEFAULT NOW(),
-                    PRIMARY KEY (user_id, reminder_type)
-                )
-            """)
-            
+        async with db.acquire(readonly=True) as conn:
             # Статистика напоминаний
             total_reminders = await conn.fetchval("SELECT COUNT(*) FROM user_reminders")
             incomplete_users = await conn.fetchval("""
                 SELECT COUNT(*) FROM users WHERE completed_at IS NULL
             """)
-            
-            # Незавершенные регистрации с деталями
-            incomplete_details = await conn.fetch("""
-                SELECT user_id, email, step, created_at, telegram_username
-                FROM users 
-                WHERE completed_at IS NULL
-                ORDER BY created_at DESC
+            scheduled = await conn.fetchrow("""
+                SELECT COUNT(*) AS pending, MIN(next_reminder_at) AS next_at
+                FROM users WHERE next_reminder_at IS NOT NULL
             """)
             
-            # Отладочная информация
-            logger.info(f"Found {len(incomplete_details)} incomplete registrations")
+            # A/B-варианты шаблонов: конверсия после напоминания
+            variants = await conn.fetch("""
+                SELECT a.reminder_type, a.variant, COUNT(*) AS assigned,
+                       COUNT(*) FILTER (WHERE u.completed_at > a.assigned_at) AS converted
+                FROM reminder_assignments a
+                LEFT JOIN users_all u ON u.user_id = a.user_id
+                WHERE a.reminder_type != 'promo_reminder'
+                GROUP BY a.reminder_type, a.variant
+                ORDER BY a.reminder_type, a.variant
+            """)
             
             # Последние напоминания
             recent_reminders = await conn.fetch("""
@@ -433,29 +763,29 @@ async def cmd_admin_reminders(message: Message):
         report = f"🔔 <b>Система напоминаний</b>\n\n"
         report += f"📊 <b>Статистика:</b>\n"
         report += f"• Всего отправлено: {total_reminders}\n"
-        report += f"• Незавершенных регистраций: {incomplete_users}\n\n"
-        
-        # Детали незавершенных регистраций
-        if incomplete_details:
-            report += f"⏳ <b>Незавершенные регистрации:</b>\n"
-            for user in incomplete_details:
-                date = user['created_at'].strftime('%d.%m %H:%M')
-                username = f"@{user['telegram_username']}" if user['telegram_username'] else "без username"
-                email = mask_email(user['email']) if user['email'] else "не указан"
-                step_names = {
-                    'start': 'начало',
-                    'email': 'ввод email',
-                    'inn': 'ввод ИНН',
-                    'confirmation': 'подтверждение'
-                }
-                step_name = step_names.get(user['step'], user['step'])
-                report += f"• ID: {user['user_id']} ({username})\n"
-                report += f"  📧 {email}\n"
-                report += f"  📍 Этап: {step_name}\n"
-                report += f"  📅 {date}\n\n"
-        else:
+        report += f"• Незавершенных регистраций: {incomplete_users}\n"
+        report += f"• Заблокировали бота: {len(blocked)}\n"
+        report += f"• Запланировано: {scheduled['pending']}"
+        if scheduled['next_at']:
+            report += f" (ближайшее {scheduled['next_at'].strftime('%d.%m %H:%M')})"
+        report += "\n\n"
+        
+        if not incomplete_users:
             report += f"✅ <b>Все регистрации завершены!</b>\n\n"
         
+        # Показываем только типы, где идёт тест (больше одного варианта)
+        per_type = [row['reminder_type'] for row in variants]
+        variants = [row for row in variants if per_type.count(row['reminder_type']) > 1]
+        if variants:
+            report += f"🧪 <b>A/B шаблонов (v{templates.version}):</b>\n"
+            for row in variants:
+                rate = row['converted'] / row['assigned'] * 100 if row['assigned'] else 0
+                report += (
+                    f"• {row['reminder_type']} [{row['variant']}]: "
+                    f"{row['converted']}/{row['assigned']} ({rate:.1f}%)\n"
+                )
+            report += "\n"
+        
         if recent_reminders:
             report += f"📝 <b>Последние напоминания:</b>\n"
             for reminder in recent_reminders:
@@ -472,10 +802,60 @@ async def cmd_admin_reminders(message: Message):
         
         await message.answer(report, parse_mode="HTML")
         
+        # Незавершенные регистрации — отдельным сообщением с постраничной навигацией
+        if incomplete_users:
+            text, keyboard = await build_admin_page('pg_rem')
+            if text:
+                await message.answer(text, reply_markup=keyboard, parse_mode="HTML")
+        
     except Exception as e:
         await message.answer(f"❌ Ошибка получения статистики напоминаний: {e}")
 
 
+@dp.message(Command("admin_export"))
+async def cmd_admin_export(message: Message):
+    """Выгрузка users / user_reminders в CSV (gzip) документом"""
+    user_id = message.from_user.id
+    
+    if not is_admin(user_id):
+        await message.answer("❌ У вас нет прав администратора.")
+        return
+    
+    parts = message.text.split()
+    if len(parts) < 2 or parts[1] not in EXPORT_QUERIES:
+        await message.answer(
+            "📤 <b>Использование:</b>\n"
+            "<code>/admin_export users|reminders [from=YYYY-MM-DD] [to=YYYY-MM-DD] [step=email]</code>\n\n"
+            "<b>Пример:</b>\n"
+            "<code>/admin_export users from=2025-10-01 step=inn</code>",
+            parse_mode="HTML"
+        )
+        return
+    
+    kind = parts[1]
+    try:
+        filters = parse_export_filters(parts[2:])
+    except ValueError as e:
+        await message.answer(f"❌ {e}")
+        return
+    
+    path = None
+    try:
+        path = await export_to_tempfile(kind, **filters)
+        filename = f"{kind}_{datetime.now().strftime('%Y%m%d_%H%M')}.csv.gz"
+        await message.answer_document(
+            FSInputFile(path, filename=filename),
+            caption=f"📤 Выгрузка {kind}"
+        )
+        logger.info(f"Admin {user_id} exported {kind} with filters {filters}")
+    except Exception as e:
+        logger.error(f"Error exporting {kind}: {e}")
+        await message.answer(f"❌ Ошибка выгрузки: {e}")
+    finally:
+        if path and os.path.exists(path):
+            os.unlink(path)
+
+
 @dp.message(Command("admin_message"))
 async def cmd_admin_message(message: Message):
     """Админ: отправить сообщение пользователю"""
@@ -551,6 +931,18 @@ async def cmd_admin_reply(message: Message):
 # КОМАНДЫ И МЕНЮ
 # ============================================================================
 
+@dp.my_chat_member()
+async def on_my_chat_member(update: ChatMemberUpdated):
+    """Пользователь заблокировал или разблокировал бота"""
+    if update.chat.type != "private":
+        return
+    
+    status = update.new_chat_member.status
+    if status == ChatMemberStatus.KICKED:
+        await blocked.mark(update.chat.id, "blocked by user")
+    elif status == ChatMemberStatus.MEMBER:
+        await blocked.unmark(update.chat.id)
+
 @dp.message(Command("start"))
 async def cmd_start(message: Message, state: FSMContext):
     """Обработчик команды /start"""
@@ -568,7 +960,7 @@ async def cmd_start(message: Message, state: FSMContext):
             f"✅ Вы уже зарегистрированы в Яндекс.Путешествиях\n"
             f"🎟️ Ваш промокод: <code>{promo_code}</code>\n\n"
             f"📋 Промокод даёт скидку 10% (до 10 000 ₽) на все бронирования.\n"
-            f"⏰ Действует до <b>10 ноября 2025</b>.\n"
+            f"⏰ Действует до <b>{templates.campaign['promo_deadline']}</b>.\n"
             f"🔒 Промокод привязан к вашему аккаунту и действует только для вашей компании.",
             reply_markup=get_main_menu(),
             parse_mode="HTML"
@@ -577,20 +969,18 @@ async def cmd_start(message: Message, state: FSMContext):
     
     # Новый пользователь или незавершённая регистрация
     await db.create_user(user_id, username)
-    
-    # Уведомляем админов о новом пользователе
-    await reminders.send_new_user_notification(user_id, "Новый пользователь")
+    events.track(user_id, 'start', step='email')
     
     # Отправляем баннер "Преимущества для бизнеса"
     try:
-        await message.answer_photo(
-            photo="https://raw.githubusercontent.com/vostoklov/youtravel-yandex-bot/main/images/welcome_banner.jpg?v=" + str(int(time.time())),
+        await assets.send_photo(
+            bot, message.chat.id, 'welcome_banner.jpg',
             caption="👋 <b>Привет!</b>\n"
             "Это бот для регистрации в партнёрской программе <b>YouTravel × Яндекс.Путешествия</b>.\n\n"
             "Теперь организаторы туров могут бронировать размещение по корпоративным тарифам Яндекс.Путешествий —\n"
             "со скидками <b>до 40%</b> в России и за рубежом 🌍\n\n"
             "🎁 После регистрации вы получите дополнительный промокод <b>−10% (до 10 000 ₽)</b> на все бронирования — он суммируется с корпоративными тарифами.\n"
-            "Промокод действует до <b>10 ноября</b>.\n\n"
+            f"Промокод действует до <b>{templates.campaign['promo_deadline_short']}</b>.\n\n"
             "📚 <a href=\"https://ytme.atlassian.net/wiki/spaces/helpcenter/pages/3686137866\">FAQ по партнерству</a> — подробная информация\n\n"
             "📩 Для начала введите e-mail, который вы используете в YouTravel:",
             reply_markup=get_main_menu(),
@@ -608,7 +998,7 @@ async def cmd_start(message: Message, state: FSMContext):
             "Теперь организаторы туров могут бронировать размещение по корпоративным тарифами Яндекс.Путешествий —\n"
             "со скидками <b>до 40%</b> в России и за рубежом 🌍\n\n"
             "🎁 После регистрации вы получите дополнительный промокод <b>−10% (до 10 000 ₽)</b> на все бронирования — он суммируется с корпоративными тарифами.\n"
-            "Промокод действует до <b>10 ноября</b>.\n\n"
+            f"Промокод действует до <b>{templates.campaign['promo_deadline_short']}</b>.\n\n"
             "📚 <a href=\"https://ytme.atlassian.net/wiki/spaces/helpcenter/pages/3686137866\">FAQ по партнерству</a> — подробная информация\n\n"
             "📩 Для начала введите e-mail, который вы используете в YouTravel:",
             reply_markup=get_main_menu(),
@@ -617,6 +1007,9 @@ async def cmd_start(message: Message, state: FSMContext):
     
     await state.set_state(RegistrationStates.waiting_for_email)
     logger.info(f"User {user_id} started registration")
+    
+    # Уведомляем админов о новом пользователе (попадёт в сводку за окно)
+    notifier.notify('new_user', f"{user_id} @{html.escape(username) if username else '—'}")
 
 @dp.message(Command("menu"))
 async def cmd_menu(message: Message):
@@ -650,7 +1043,7 @@ async def cmd_status(message: Message):
             f"🎟️ Промокод: <code>{user['promo_code']}</code>\n"
             f"📅 Дата: {completed_date}\n\n"
             f"Промокод даёт скидку 10% (до 10 000 ₽) на все бронирования.\n"
-            f"⏰ Действует до <b>10 ноября 2025</b>.\n"
+            f"⏰ Действует до <b>{templates.campaign['promo_deadline']}</b>.\n"
             f"🔒 Промокод привязан к вашему аккаунту и действует только для вашей компании.",
             reply_markup=get_main_menu(),
             parse_mode="HTML"
@@ -718,9 +1111,7 @@ async def cmd_clear_db(message: Message):
         stats_before = await db.get_stats()
         
         # Очищаем таблицы
-        async with db.pool.acquire() as conn:
-            await conn.execute('DELETE FROM user_reminders')
-            await conn.execute('DELETE FROM users')
+        await db.clear_users()
         
         # Получаем статистику ПОСЛЕ очистки
         stats_after = await db.get_stats()
@@ -758,9 +1149,7 @@ async def cmd_clear_simple(message: Message):
         stats_before = await db.get_stats()
         
         # Очищаем таблицы
-        async with db.pool.acquire() as conn:
-            await conn.execute('DELETE FROM user_reminders')
-            await conn.execute('DELETE FROM users')
+        await db.clear_users()
         
         # Получаем статистику ПОСЛЕ очистки
         stats_after = await db.get_stats()
@@ -836,7 +1225,7 @@ async def cmd_help(message: Message):
         "❓ <b>Частые вопросы:</b>\n\n"
         "• <b>Как быстро я получу промокод?</b> → Сразу после ввода ИНН.\n\n"
         "• <b>Можно ли использовать промокод несколько раз?</b> → Один промокод на компанию.\n\n"
-        "• <b>Промокод действует на все бронирования?</b> → Да, до 10 ноября 2025.\n\n"
+        f"• <b>Промокод действует на все бронирования?</b> → Да, до {templates.campaign['promo_deadline']}.\n\n"
         "• <b>Промокод работает в B2C?</b> → Нет, только в корпоративном кабинете.\n\n"
         "📚 <b>Подробная информация:</b> <a href=\"https://ytme.atlassian.net/wiki/spaces/helpcenter/pages/3686137866\">FAQ по партнерству</a>\n\n"
         "💬 Если у вас возникли проблемы, обратитесь в поддержку.",
@@ -890,12 +1279,8 @@ async def process_support_message(message: Message, state: FSMContext):
 📅 <b>Время:</b> {datetime.now().strftime('%d.%m.%Y %H:%M')}
 """
     
-    # Отправляем всем админам
-    for admin_id in config.ADMIN_USER_IDS:
-        try:
-            await bot.send_message(admin_id, support_message, parse_mode="HTML")
-        except Exception as e:
-            logger.error(f"Error sending support message to admin {admin_id}: {e}")
+    # Обращения не копятся в сводке — отправляем всем админам сразу, не задерживая ответ
+    notifier.escalate(support_message, f"support:{user_id}:{message.message_id}")
     
     # Подтверждаем пользователю
     await message.answer(
@@ -944,11 +1329,8 @@ async def cmd_reset(message: Message, state: FSMContext):
         # Получаем email пользователя перед удалением
         user_email = user.get('email') if user else None
         
-        async with db.pool.acquire() as conn:
-            result = await conn.execute(
-                "DELETE FROM users WHERE user_id = $1",
-                user_id
-            )
+        # Вместе с пользователем снимается выданный промокод и история напоминаний
+        result = await db.delete_user(user_id)
         
         logger.info(f"✓ User {user_id} deleted: {result}")
         
@@ -1006,6 +1388,7 @@ async def process_email(message: Message, state: FSMContext):
     
     # Проверка наличия в базе верифицированных ТЭ
     if not sheets.check_email_exists(email):
+        events.track(user_id, 'email_rejected', step='email')
         await message.answer(
             f"❌ Email <code>{email}</code> не найден в базе верифицированных ТЭ.\n\n"
             f"Убедитесь, что вы:\n"
@@ -1018,6 +1401,7 @@ async def process_email(message: Message, state: FSMContext):
     
     # Проверка, не зарегистрирован ли уже этот email
     if sheets.check_email_already_registered(email):
+        events.track(user_id, 'email_rejected', step='email')
         await message.answer(
             f"⚠️ Email <code>{email}</code> уже зарегистрирован в системе.\n\n"
             f"Один email может получить только один промокод.\n\n"
@@ -1028,6 +1412,7 @@ async def process_email(message: Message, state: FSMContext):
     
     # Сохраняем email
     await db.update_user(user_id, email=email, step='inn')
+    events.track(user_id, 'email_ok', step='inn')
     
     # Переходим к следующему шагу
     await message.answer(
@@ -1076,6 +1461,7 @@ async def process_inn(message: Message, state: FSMContext):
     
     # Сохраняем данные во временное состояние
     await state.update_data(inn=inn)
+    events.track(user_id, 'inn_ok', step='confirmation')
     
     # Получаем данные пользователя
     user = await db.get_user(user_id)
@@ -1109,24 +1495,56 @@ async def confirm_registration(callback: CallbackQuery, state: FSMContext):
     except Exception as e:
         logger.warning(f"Failed to answer callback: {e}")
     
-    # Проверяем, не завершена ли уже регистрация (защита от двойного клика)
-    user_data = await db.get_user(user_id)
-    if user_data and user_data.get('step') == 'completed':
+    # Получаем ИНН из состояния
+    data = await state.get_data()
+    inn = data.get('inn')
+    if not inn:
+        # Состояние потеряно (рестарт, очистка хранилища) — ИНН нужно ввести заново
+        logger.warning(f"User {user_id} confirmed without INN in state, asking again")
+        await db.update_user(user_id, step='inn')
+        await state.set_state(RegistrationStates.waiting_for_inn)
         await callback.message.edit_text(
-            "✅ Вы уже завершили регистрацию!\n\n"
-            f"🎟️ Ваш промокод: <b>{user_data.get('promo_code')}</b>",
+            "⚠️ Не удалось найти введённый ИНН.\n\n"
+            "Пожалуйста, введите <b>ИНН вашей компании</b> ещё раз (10 или 12 цифр):",
             parse_mode="HTML"
         )
         return
+    events.track(user_id, 'confirm', step='confirmation')
     
-    # Получаем ИНН из состояния
-    data = await state.get_data()
-    inn = data.get('inn')
+    # Блокировка строки, проверка ИНН, выдача промокода и запись — одной транзакцией
+    result = await db.complete_registration(user_id, inn)
+    status = result['status']
     
-    # Получаем промокод
-    promo_code = sheets.get_available_promo()
+    if status == 'already_completed':
+        # Защита от двойного клика
+        await callback.message.edit_text(
+            "✅ Вы уже завершили регистрацию!\n\n"
+            f"🎟️ Ваш промокод: <b>{result.get('promo_code')}</b>",
+            parse_mode="HTML"
+        )
+        return
     
-    if not promo_code:
+    if status == 'inn_taken':
+        await callback.message.edit_text(
+            f"❌ ИНН <code>{mask_inn(inn)}</code> уже зарегистрирован.\n\n"
+            f"Каждая компания может зарегистрироваться только один раз.\n"
+            f"Если это ошибка, свяжитесь с @youtravel_for_agents",
+            parse_mode="HTML"
+        )
+        await state.clear()
+        return
+    
+    if status != 'completed':
+        logger.error(f"Registration completion for user {user_id} failed: {status}")
+        if status == 'no_promo':
+            # Закончились промокоды — эскалируем сразу, но не чаще раза в час
+            notifier.notify(
+                'no_promo',
+                f"Промокоды закончились: пользователь {user_id} не получил код.\n"
+                f"Пополните таблицу промокодов.",
+                critical=True,
+                dedup=f"no_promo:{datetime.now().strftime('%Y%m%d%H')}"
+            )
         await callback.message.edit_text(
             "❌ <b>Ошибка</b>\n\n"
             "К сожалению, промокоды временно закончились.\n"
@@ -1135,33 +1553,21 @@ async def confirm_registration(callback: CallbackQuery, state: FSMContext):
         )
         return
     
-    # Получаем email из БД
-    email = user_data.get('email') if user_data else None
-    
-    # Сохраняем в БД
-    await db.update_user(
-        user_id,
-        inn=inn,
-        promo_code=promo_code,
-        step='completed',
-        completed_at=datetime.now()
-    )
-    
-    # Сохраняем в Google Sheets
-    if email:
-        sheets.save_registration(email, inn, promo_code)
+    promo_code = result['promo_code']
+    email = result['email']
+    events.track(user_id, 'promo_issued', step='completed')
     
     # Очищаем состояние
     await state.clear()
     
     # Отправляем скриншот с бейджем "Корпоративный тариф"
     try:
-        await callback.message.answer_photo(
-            photo="https://raw.githubusercontent.com/vostoklov/youtravel-yandex-bot/main/images/completion_screenshot.jpg?v=" + str(int(time.time())),
+        await assets.send_photo(
+            bot, callback.message.chat.id, 'completion_screenshot.jpg',
             caption=f"🎉 <b>Отлично!</b>\n"
             f"Регистрация завершена — теперь вам доступны корпоративные тарифы Яндекс.Путешествий.\n\n"
             f"🎟️ Ваш персональный промокод: <b>{promo_code}</b>\n\n"
-            f"💰 Промокод даёт −10% (до 10 000 ₽) на бронирования в Яндекс.Путешествиях, действует до <b>10 ноября 2025</b>.\n"
+            f"💰 Промокод даёт −10% (до 10 000 ₽) на бронирования в Яндекс.Путешествиях, действует до <b>{templates.campaign['promo_deadline']}</b>.\n"
             f"Скидка суммируется с корпоративными тарифами (до 40%).\n\n"
             f"🔒 Промокод уникален и действует только для вашей компании.\n\n"
             f"🔗 Перейдите к бронированию: <a href=\"https://travel.yandex.ru\">travel.yandex.ru</a>",
@@ -1179,7 +1585,7 @@ async def confirm_registration(callback: CallbackQuery, state: FSMContext):
             f"🎉 <b>Отлично!</b>\n"
             f"Регистрация завершена — теперь вам доступны корпоративные тарифы Яндекс.Путешествий.\n\n"
             f"🎟️ Ваш персональный промокод: <b>{promo_code}</b>\n\n"
-            f"💰 Промокод даёт −10% (до 10 000 ₽) на бронирования в Яндекс.Путешествиях, действует до <b>10 ноября 2025</b>.\n"
+            f"💰 Промокод даёт −10% (до 10 000 ₽) на бронирования в Яндекс.Путешествиях, действует до <b>{templates.campaign['promo_deadline']}</b>.\n"
             f"Скидка суммируется с корпоративными тарифами (до 40%).\n\n"
             f"🔒 Промокод уникален и действует только для вашей компании.\n\n"
             f"🔗 Перейдите к бронированию: <a href=\"https://travel.yandex.ru\">travel.yandex.ru</a>",
@@ -1191,11 +1597,8 @@ async def confirm_registration(callback: CallbackQuery, state: FSMContext):
         except Exception:
             pass
     
-    # Уведомляем админов о завершенной регистрации
-    try:
-        await reminders.send_completion_notification(user_id, email, promo_code)
-    except Exception as e:
-        logger.error(f"Error sending completion notification: {e}")
+    # Уведомляем админов о завершенной регистрации (попадёт в сводку за окно)
+    notifier.notify('completed', f"{user_id} {html.escape(email or '—')} → <code>{promo_code}</code>")
     
     logger.info(f"User {user_id} completed registration with promo: {promo_code}")
 
@@ -1226,9 +1629,7 @@ async def cmd_admin_clear(message: Message):
         stats_before = await db.get_stats()
         
         # Очищаем таблицы
-        async with db.pool.acquire() as conn:
-            await conn.execute('DELETE FROM user_reminders')
-            await conn.execute('DELETE FROM users')
+        await db.clear_users()
         
         # Получаем статистику ПОСЛЕ очистки
         stats_after = await db.get_stats()
@@ -1274,13 +1675,13 @@ async def cmd_admin_check_email(message: Message):
     email = parts[1].strip()
     
     try:
-        async with db.pool.acquire() as conn:
+        async with db.acquire() as conn:
             # Получаем все записи для email
             records = await conn.fetch(
                 """SELECT user_id, email, inn, promo_code, step, 
                           created_at, completed_at
-                   FROM users 
-                   WHERE email = $1
+                   FROM users_all 
+                   WHERE lower(email) = lower($1)
                    ORDER BY created_at""",
                 email
             )
@@ -1345,47 +1746,58 @@ async def cmd_admin_fix_user(message: Message):
     promo_code = parts[3]
     
     try:
-        async with db.pool.acquire() as conn:
-            # Получаем текущие данные
-            current = await conn.fetchrow(
-                'SELECT * FROM users WHERE user_id = $1',
-                target_user_id
-            )
-            
-            if not current:
-                await message.answer(f"❌ Пользователь {target_user_id} не найден.")
-                return
-            
-            # Обновляем
-            await conn.execute(
-                """UPDATE users 
-                   SET inn = $1, promo_code = $2
-                   WHERE user_id = $3""",
-                inn,
-                promo_code,
-                target_user_id
-            )
+        async with db.acquire() as conn:
+            async with conn.transaction():
+                # Получаем текущие данные
+                current = await conn.fetchrow(
+                    'SELECT * FROM users WHERE user_id = $1 FOR UPDATE',
+                    target_user_id
+                )
+                
+                if not current:
+                    await message.answer(f"❌ Пользователь {target_user_id} не найден.")
+                    return
+                
+                # Промокод закрепляется в инвентаре, чтобы promo_codes не расходился с users
+                if not await db.assign_promo(conn, target_user_id, promo_code):
+                    await message.answer(
+                        f"❌ Промокод <code>{promo_code}</code> уже выдан другому пользователю.",
+                        parse_mode="HTML"
+                    )
+                    return
+                
+                # Обновляем
+                await conn.execute(
+                    """UPDATE users 
+                       SET inn = $1, promo_code = $2
+                       WHERE user_id = $3""",
+                    inn,
+                    promo_code,
+                    target_user_id
+                )
             
             # Проверяем результат
             updated = await conn.fetchrow(
                 'SELECT * FROM users WHERE user_id = $1',
                 target_user_id
             )
-            
-            await message.answer(
-                f"✅ <b>Данные обновлены!</b>\n\n"
-                f"👤 User ID: <code>{target_user_id}</code>\n"
-                f"📧 Email: <code>{updated['email']}</code>\n\n"
-                f"<b>Было:</b>\n"
-                f"🏢 ИНН: <code>{current['inn'] or 'не указан'}</code>\n"
-                f"🎟️ Промокод: <code>{current['promo_code'] or 'не выдан'}</code>\n\n"
-                f"<b>Стало:</b>\n"
-                f"🏢 ИНН: <code>{updated['inn']}</code>\n"
-                f"🎟️ Промокод: <code>{updated['promo_code']}</code>",
-                parse_mode="HTML"
-            )
-            
-            logger.info(f"Admin {user_id} updated user {target_user_id}: inn={inn}, promo={promo_code}")
+        # Инвалидация берёт своё соединение — только после возврата текущего в пул
+        await db.invalidate(f"user:{target_user_id}", "stats:*")
+        
+        await message.answer(
+            f"✅ <b>Данные обновлены!</b>\n\n"
+            f"👤 User ID: <code>{target_user_id}</code>\n"
+            f"📧 Email: <code>{updated['email']}</code>\n\n"
+            f"<b>Было:</b>\n"
+            f"🏢 ИНН: <code>{current['inn'] or 'не указан'}</code>\n"
+            f"🎟️ Промокод: <code>{current['promo_code'] or 'не выдан'}</code>\n\n"
+            f"<b>Стало:</b>\n"
+            f"🏢 ИНН: <code>{updated['inn']}</code>\n"
+            f"🎟️ Промокод: <code>{updated['promo_code']}</code>",
+            parse_mode="HTML"
+        )
+        
+        logger.info(f"Admin {user_id} updated user {target_user_id}: inn={inn}, promo={promo_code}")
             
     except Exception as e:
         logger.error(f"Error fixing user: {e}")
@@ -1454,21 +1866,72 @@ def is_admin(user_id: int) -> bool:
 async def main():
     """Главная функция запуска бота"""
     try:
+        # Сторож event loop — первым, чтобы видеть и блокирующий старт
+        watchdog.start()
+        
+        # Счётчики ошибок по подсистемам и алерты по скользящим окнам
+        error_rates.install()
+        
         # Подключаемся к БД
         await db.connect()
         
+        # Реестр чатов, заблокировавших бота
+        await blocked.load()
+        
+        # Кэш file_id изображений
+        try:
+            await assets.load()
+        except Exception as e:
+            logger.error(f"Failed to load Telegram assets: {e}")
+        
+        # Шаблоны напоминаний и настройки кампании (дальше — перечитываются при изменениях в БД)
+        try:
+            await templates.load()
+        except Exception as e:
+            logger.error(f"Failed to load reminder templates, using built-in: {e}")
+        templates.start()
+        
         # Подключаемся к Google Sheets
         sheets.connect()
         
+        # Метрики для Prometheus (в каждой реплике)
+        try:
+            await monitoring.start_metrics_server()
+        except Exception as e:
+            logger.error(f"Failed to start metrics endpoint: {e}")
+        
+        # Все отправки идут через шлюз с приоритетами и лимитами
+        gateway.start(bot)
+        
+        # Доставка из message_outbox (во всех репликах, строки делятся через SKIP LOCKED)
+        outbox.start(bot)
+        
+        # Пополняем инвентарь промокодов до приёма апдейтов
+        try:
+            await sheets.sync_promo_inventory()
+        except Exception as e:
+            logger.error(f"Initial promo inventory sync failed: {e}")
+        
         logger.info("🤖 Bot started with admin panel")
         logger.info(f"🔧 Admin IDs: {config.ADMIN_USER_IDS}")
         logger.info(f"🔧 Admin IDs type: {type(config.ADMIN_USER_IDS)}")
         
-        # Запускаем мониторинг в фоне
-        monitoring_task = asyncio.create_task(monitoring.start_monitoring(bot))
+        # Фоновые задачи — через общий планировщик (лидерские работают в одной реплике из нескольких)
+        scheduler.service('sheets_mirror', sheets.start_mirror)      # Зеркалирование в Google Sheets
+        scheduler.service('archiver', db.start_archiver)             # Перенос старых регистраций в архив
+        scheduler.service('funnel_rollups', events.start_rollups)    # Агрегаты воронки
+        monitoring.register_jobs(scheduler, bot)                     # Алерты и ежедневный отчёт
+        reminders.register_jobs(scheduler, bot)                      # Напоминания
+        outbox.register_jobs(scheduler)                              # Очистка старых сообщений очереди
+        
+        # Журнал событий воронки пишет каждая реплика
+        events.start()
+        
+        # Сводки уведомлений админам
+        notifier.start()
         
-        # Запускаем систему напоминаний в фоне
-        reminders_task = asyncio.create_task(reminders.start_reminders(bot))
+        scheduler.start()
+        leases.start()
         
         # Запускаем polling
         await dp.start_polling(bot)
@@ -1478,9 +1941,17 @@ async def main():
     except Exception as e:
         logger.error(f"Bot error: {e}")
     finally:
-        # Останавливаем мониторинг
-        if 'monitoring_task' in locals():
-            monitoring_task.cancel()
+        # Останавливаем фоновые задачи и отпускаем локи
+        await scheduler.close()
+        await leases.close()
+        await notifier.close()
+        await templates.close()
+        await outbox.close()
+        await events.close()
+        await gateway.close()
+        await monitoring.close()
+        await watchdog.close()
+        error_rates.uninstall()
         await db.close()
         await bot.session.close()
 
@@ -55,6 +55,12 @@ async def clear_test_data():
         # Очищаем все таблицы
         print("\n🗑️  Удаляем пользователей...")
         await conn.execute('DELETE FROM users')
+        # Выданные промокоды удалённых пользователей (иначе повторная регистрация упрётся в UNIQUE)
+        await conn.execute('''
+            DELETE FROM promo_codes p
+            WHERE p.user_id IS NOT NULL
+              AND NOT EXISTS (SELECT 1 FROM users_archive a WHERE a.user_id = p.user_id)
+        ''')
         
         print("🗑️  Удаляем напоминания...")
         await conn.execute('DELETE FROM user_reminders')
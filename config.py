@@ -9,20 +9,146 @@ load_dotenv()
 # Telegram
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 
+# Шлюз исходящих сообщений: общий бюджет, пауза между сообщениями в чат, параллелизм
+OUTBOUND_RATE = float(os.getenv("OUTBOUND_RATE", "25"))
+OUTBOUND_PER_CHAT_INTERVAL = float(os.getenv("OUTBOUND_PER_CHAT_INTERVAL", "0.5"))
+OUTBOUND_CONCURRENCY = int(os.getenv("OUTBOUND_CONCURRENCY", "8"))
+OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", "3"))
+
 # Database
 DATABASE_URL = os.getenv("DATABASE_URL")
 
+# Пул соединений
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "2"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", "60"))
+# Сколько ждать свободное соединение из пула, прежде чем вернуть ошибку (секунды)
+DB_ACQUIRE_TIMEOUT = float(os.getenv("DB_ACQUIRE_TIMEOUT", "30"))
+DB_POOL_MAX_INACTIVE_LIFETIME = float(os.getenv("DB_POOL_MAX_INACTIVE_LIFETIME", "300"))
+DB_SLOW_QUERY_SECONDS = float(os.getenv("DB_SLOW_QUERY_SECONDS", "0.5"))
+# Адаптивный режим: лимит занятых соединений растёт от MIN до MAX при ожидании acquire
+DB_POOL_ADAPTIVE = os.getenv("DB_POOL_ADAPTIVE", "false").lower() in ("1", "true", "yes")
+DB_POOL_ADAPTIVE_INTERVAL = float(os.getenv("DB_POOL_ADAPTIVE_INTERVAL", "10"))
+DB_POOL_GROW_WAIT_MS = float(os.getenv("DB_POOL_GROW_WAIT_MS", "20"))
+
+# Реплика для чтения (отчёты, выгрузки, сканы напоминаний); пусто — всё через primary
+DATABASE_REPLICA_URL = os.getenv("DATABASE_REPLICA_URL")
+DB_REPLICA_POOL_MAX_SIZE = int(os.getenv("DB_REPLICA_POOL_MAX_SIZE", "5"))
+DB_REPLICA_MAX_LAG_SECONDS = float(os.getenv("DB_REPLICA_MAX_LAG_SECONDS", "5"))
+DB_REPLICA_CHECK_INTERVAL = float(os.getenv("DB_REPLICA_CHECK_INTERVAL", "5"))
+
+# In-process кэш (пользователи, статистика) с инвалидацией через LISTEN/NOTIFY
+CACHE_ENABLED = os.getenv("CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+CACHE_INVALIDATION_CHANNEL = os.getenv("CACHE_INVALIDATION_CHANNEL", "cache_invalidation")
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "10000"))
+CACHE_USER_TTL = float(os.getenv("CACHE_USER_TTL", "300"))
+CACHE_STATS_TTL = float(os.getenv("CACHE_STATS_TTL", "60"))
+
+# Напоминания: интервалы в минутах от начала регистрации (incomplete_*) и от завершения (promo_reminder)
+REMINDER_INTERVALS = {
+    'incomplete_1h': int(os.getenv("REMINDER_1H_MINUTES", "60")),
+    'incomplete_24h': int(os.getenv("REMINDER_24H_MINUTES", "1440")),
+    'incomplete_3d': int(os.getenv("REMINDER_3D_MINUTES", "4320")),
+    'promo_reminder': int(os.getenv("REMINDER_PROMO_MINUTES", "10080")),
+}
+# Этапы, для которых есть тексты напоминаний о незавершённой регистрации
+REMINDER_STEPS = ('email', 'inn', 'confirmation')
+# Планировщик держит в памяти дедлайны на горизонт вперёд и перечитывает их из БД
+REMINDER_HORIZON_MINUTES = int(os.getenv("REMINDER_HORIZON_MINUTES", "15"))
+REMINDER_HYDRATE_INTERVAL = float(os.getenv("REMINDER_HYDRATE_INTERVAL", "300"))
+
+# Партиции пользователей для напоминаний между репликами (0 — одна реплика-лидер)
+REMINDER_PARTITIONS = int(os.getenv("REMINDER_PARTITIONS", "0"))
+
+# Сколько напоминаний выбирать и отмечать за один запрос
+REMINDER_BATCH_SIZE = int(os.getenv("REMINDER_BATCH_SIZE", "500"))
+
+# Как часто проверять изменения шаблонов напоминаний и настроек кампании в БД, секунды
+TEMPLATES_RELOAD_INTERVAL = float(os.getenv("TEMPLATES_RELOAD_INTERVAL", "60"))
+
+# Архивация завершённых регистраций (должно быть больше 7 дней — срока напоминания о промокоде)
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "30"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "500"))
+ARCHIVE_BATCH_PAUSE = float(os.getenv("ARCHIVE_BATCH_PAUSE", "0.5"))
+ARCHIVE_INTERVAL = float(os.getenv("ARCHIVE_INTERVAL", "3600"))
+
+# Журнал событий воронки
+EVENTS_BATCH_SIZE = int(os.getenv("EVENTS_BATCH_SIZE", "200"))
+EVENTS_FLUSH_INTERVAL = float(os.getenv("EVENTS_FLUSH_INTERVAL", "5"))
+EVENTS_MAX_BUFFER = int(os.getenv("EVENTS_MAX_BUFFER", "50000"))
+EVENTS_ROLLUP_INTERVAL = float(os.getenv("EVENTS_ROLLUP_INTERVAL", "300"))
+
+# Размер батча для онлайн-бэкфиллов в миграциях
+MIGRATION_BATCH_SIZE = int(os.getenv("MIGRATION_BATCH_SIZE", "1000"))
+
 # Google Sheets
 GOOGLE_SHEET_EMAILS_ID = os.getenv("GOOGLE_SHEET_EMAILS_ID")
 GOOGLE_SHEET_PROMOS_ID = os.getenv("GOOGLE_SHEET_PROMOS_ID")
 GOOGLE_CREDENTIALS_JSON = os.getenv("GOOGLE_CREDENTIALS_JSON", "credentials.json")
 
+# Зеркалирование в Google Sheets и пополнение инвентаря промокодов (секунды)
+SHEETS_MIRROR_INTERVAL = float(os.getenv("SHEETS_MIRROR_INTERVAL", "10"))
+# Очередь записей в Sheets: пауза перед повтором (удваивается, до часа) и число попыток до пометки мёртвой
+SHEETS_OUTBOX_RETRY_BASE_SECONDS = float(os.getenv("SHEETS_OUTBOX_RETRY_BASE_SECONDS", "30"))
+SHEETS_OUTBOX_MAX_ATTEMPTS = int(os.getenv("SHEETS_OUTBOX_MAX_ATTEMPTS", "10"))
+PROMO_INVENTORY_SYNC_INTERVAL = float(os.getenv("PROMO_INVENTORY_SYNC_INTERVAL", "600"))
+
 # Support
 SUPPORT_USERNAME = os.getenv("SUPPORT_USERNAME", "vostoklov")
 
 # Admin
 ADMIN_USER_IDS = [int(x) for x in os.getenv("ADMIN_USER_IDS", "201800866").split(",")]
 
+# Размер страницы в админских списках (/admin_incomplete, /admin_reminders)
+ADMIN_PAGE_SIZE = int(os.getenv("ADMIN_PAGE_SIZE", "15"))
+
+# Сводки уведомлений админам: окно в секундах (0 — каждое событие сразу) и сколько последних записей показывать
+ADMIN_DIGEST_WINDOW = float(os.getenv("ADMIN_DIGEST_WINDOW", "60"))
+ADMIN_DIGEST_LAST = int(os.getenv("ADMIN_DIGEST_LAST", "10"))
+
+# Очередь исходящих сообщений (message_outbox)
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "4"))
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "20"))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "2"))
+OUTBOX_CLAIM_TIMEOUT = float(os.getenv("OUTBOX_CLAIM_TIMEOUT", "300"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_RETRY_BASE_SECONDS = float(os.getenv("OUTBOX_RETRY_BASE_SECONDS", "30"))
+# Сколько дней хранить доставленные и окончательно неудачные сообщения; период очистки (секунды)
+OUTBOX_RETENTION_DAYS = int(os.getenv("OUTBOX_RETENTION_DAYS", "7"))
+OUTBOX_CLEANUP_INTERVAL = float(os.getenv("OUTBOX_CLEANUP_INTERVAL", "3600"))
+OUTBOX_CLEANUP_BATCH = int(os.getenv("OUTBOX_CLEANUP_BATCH", "5000"))
+
+# Координация фоновых задач между репликами: проверка лока и попытка захвата (секунды)
+LEASE_CHECK_INTERVAL = float(os.getenv("LEASE_CHECK_INTERVAL", "5"))
+
+# Эндпоинт /metrics для Prometheus (порт 0 — выключен; по умолчанию только localhost,
+# для внешнего сборщика задайте METRICS_HOST=0.0.0.0); таймаут сбора значений при опросе
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9091"))
+METRICS_COLLECT_TIMEOUT = float(os.getenv("METRICS_COLLECT_TIMEOUT", "2"))
+
+# Сторож event loop: период пульса, порог остановки для снятия стека (секунды), сколько мест хранить
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.1"))
+LOOP_LAG_THRESHOLD = float(os.getenv("LOOP_LAG_THRESHOLD", "0.25"))
+LOOP_LAG_MAX_SITES = int(os.getenv("LOOP_LAG_MAX_SITES", "50"))
+
+# Проверки здоровья: таймаут каждой пробы и сколько секунд переиспользовать результат
+HEALTH_PROBE_TIMEOUT = float(os.getenv("HEALTH_PROBE_TIMEOUT", "5"))
+HEALTH_CACHE_TTL = float(os.getenv("HEALTH_CACHE_TTL", "15"))
+
+# Алерты по частоте ошибок: не чаще раза в столько секунд на подсистему и окно
+ERROR_ALERT_COOLDOWN = float(os.getenv("ERROR_ALERT_COOLDOWN", "1800"))
+
+# Планировщик: пауза перед перезапуском упавшей задачи (удваивается до MAX, сбрасывается,
+# если задача проработала RESET секунд)
+SCHEDULER_RESTART_BASE = float(os.getenv("SCHEDULER_RESTART_BASE", "5"))
+SCHEDULER_RESTART_MAX = float(os.getenv("SCHEDULER_RESTART_MAX", "300"))
+SCHEDULER_RESTART_RESET = float(os.getenv("SCHEDULER_RESTART_RESET", "600"))
+
+# Мониторинг: проверка метрик и алерты (секунды), ежедневный отчёт (cron, локальное время)
+MONITORING_CHECK_INTERVAL = float(os.getenv("MONITORING_CHECK_INTERVAL", "1800"))
+DAILY_REPORT_CRON = os.getenv("DAILY_REPORT_CRON", "0 9 * * *")
+
 # Environment
 ENVIRONMENT = os.getenv("ENVIRONMENT", "development")
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
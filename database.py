@@ -1,128 +1,786 @@
 """
 Работа с PostgreSQL базой данных
 """
+import asyncio
 import asyncpg
-from typing import Optional, Dict, Any
+import json
+import os
+import re
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Optional, Dict, Any, List, Tuple, Callable
 import config
 import logging
+from monitoring import metrics
+from datetime import datetime, timedelta
 
 logger = logging.getLogger(__name__)
 
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+MIGRATION_FILE_RE = re.compile(r"^(\d+)_[\w\-]+\.sql$")
+# Ключ advisory lock, чтобы миграции не применялись параллельно несколькими процессами
+MIGRATIONS_LOCK_KEY = 742001
+
+# UNIQUE(inn) из migrations/0001 — единственное нарушение, которое значит «ИНН уже занят»
+INN_UNIQUE_CONSTRAINT = 'users_inn_key'
+
+DB_QUERY_SECONDS = metrics.histogram('bot_db_query_seconds', 'DB query latency', ('pool', 'status'))
+DB_ACQUIRE_WAIT_SECONDS = metrics.histogram('bot_db_acquire_wait_seconds', 'Wait for a pool connection', ('pool',))
+
+
+class PoolStats:
+    """Телеметрия пула: ожидание acquire, занятые соединения, латентность запросов"""
+    
+    def __init__(self, pool: str = 'primary', window: int = 500):
+        self.pool = pool
+        self.acquires = 0
+        self.acquire_timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.waits = deque(maxlen=window)
+        self.queries = 0
+        self.query_errors = 0
+        self.query_total = 0.0
+        self.query_max = 0.0
+        self.query_times = deque(maxlen=window)
+        self.slow_queries = deque(maxlen=5)
+        self.checked_out = 0
+        self.checked_out_max = 0
+    
+    def record_wait(self, seconds: float):
+        self.acquires += 1
+        self.wait_total += seconds
+        self.wait_max = max(self.wait_max, seconds)
+        self.waits.append(seconds)
+        DB_ACQUIRE_WAIT_SECONDS.observe(seconds, self.pool)
+    
+    def record_query(self, query: str, seconds: float, failed: bool = False):
+        self.queries += 1
+        self.query_total += seconds
+        self.query_max = max(self.query_max, seconds)
+        self.query_times.append(seconds)
+        DB_QUERY_SECONDS.observe(seconds, self.pool, 'error' if failed else 'ok')
+        if failed:
+            self.query_errors += 1
+        if seconds >= config.DB_SLOW_QUERY_SECONDS:
+            self.slow_queries.append((" ".join(query.split())[:120], seconds))
+    
+    @staticmethod
+    def _percentile(samples, pct: float) -> float:
+        if not samples:
+            return 0.0
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+    
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "acquires": self.acquires,
+            "acquire_timeouts": self.acquire_timeouts,
+            "wait_avg_ms": self.wait_total / self.acquires * 1000 if self.acquires else 0.0,
+            "wait_p95_ms": self._percentile(self.waits, 0.95) * 1000,
+            "wait_max_ms": self.wait_max * 1000,
+            "checked_out": self.checked_out,
+            "checked_out_max": self.checked_out_max,
+            "queries": self.queries,
+            "query_errors": self.query_errors,
+            "query_avg_ms": self.query_total / self.queries * 1000 if self.queries else 0.0,
+            "query_p95_ms": self._percentile(self.query_times, 0.95) * 1000,
+            "query_max_ms": self.query_max * 1000,
+            "slow_queries": list(self.slow_queries),
+        }
+
+
+class LocalCache:
+    """In-process кэш с TTL; инвалидируется локально и через LISTEN/NOTIFY с других процессов"""
+    
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self._data: Dict[str, Tuple[float, Any]] = {}
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key: str) -> Any:
+        entry = self._data.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            self._data.pop(key, None)
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[1]
+    
+    def set(self, key: str, value: Any, ttl: float):
+        if self.max_entries <= 0:
+            return
+        if len(self._data) >= self.max_entries:
+            # Вытесняем самую старую запись (dict хранит порядок вставки)
+            self._data.pop(next(iter(self._data)))
+        self._data[key] = (time.monotonic() + ttl, value)
+    
+    def evict(self, key: str):
+        """Удаляет ключ; 'prefix:*' удаляет все ключи с префиксом, '*' — всё"""
+        if key == "*":
+            self._data.clear()
+        elif key.endswith("*"):
+            prefix = key[:-1]
+            for k in [k for k in self._data if k.startswith(prefix)]:
+                del self._data[k]
+        else:
+            self._data.pop(key, None)
+
+
+def next_incomplete_reminder_sql() -> str:
+    """
+    Самый ранний ещё не отправленный порог напоминания от created_at (NULL, если
+    все отправлены). Прошедший порог тоже подходит: наступившее, но ещё не
+    обработанное напоминание не должно теряться при смене этапа.
+    Выражение для UPDATE users: ссылается на users.user_id и created_at.
+    """
+    types = ('incomplete_1h', 'incomplete_24h', 'incomplete_3d')
+    minutes = ", ".join(str(int(config.REMINDER_INTERVALS[t])) for t in types)
+    names = ", ".join(f"'{t}'" for t in types)
+    return f"""(
+        SELECT MIN(created_at + make_interval(mins => t.m))
+        FROM unnest(ARRAY[{minutes}], ARRAY[{names}]) AS t(m, reminder_type)
+        WHERE NOT EXISTS (
+            SELECT 1 FROM user_reminders r
+            WHERE r.user_id = users.user_id AND r.reminder_type = t.reminder_type
+        )
+    )"""
+
+
 class Database:
     def __init__(self):
         self.pool: Optional[asyncpg.Pool] = None
+        self.stats = PoolStats('primary')
+        # Мягкий лимит одновременно занятых соединений (в адаптивном режиме меняется)
+        self.soft_limit = config.DB_POOL_MAX_SIZE
+        self._slot_freed = asyncio.Condition()
+        self._autoscale_task: Optional[asyncio.Task] = None
+        # Реплика для отчётов и сканов (опционально)
+        self.replica_pool: Optional[asyncpg.Pool] = None
+        self.replica_stats = PoolStats('replica')
+        self.replica_lag: Optional[float] = None
+        self.replica_ok = False
+        self._replica_task: Optional[asyncio.Task] = None
+        # Кэш и канал инвалидации между процессами
+        self.cache = LocalCache(config.CACHE_MAX_ENTRIES if config.CACHE_ENABLED else 0)
+        self._listener_conn: Optional[asyncpg.Connection] = None
+        self._listener_task: Optional[asyncio.Task] = None
+        # Подписчики на новые дедлайны напоминаний (планировщик напоминаний)
+        self.reminder_hooks: List[Callable[[int, datetime], None]] = []
     
     async def connect(self):
         """Создаёт connection pool"""
         self.pool = await asyncpg.create_pool(
             config.DATABASE_URL,
-            min_size=2,
-            max_size=10,
-            command_timeout=60
+            min_size=config.DB_POOL_MIN_SIZE,
+            max_size=config.DB_POOL_MAX_SIZE,
+            command_timeout=config.DB_COMMAND_TIMEOUT,
+            # Простаивающие соединения закрываются, пул сжимается сам
+            max_inactive_connection_lifetime=config.DB_POOL_MAX_INACTIVE_LIFETIME,
+            init=self._make_init(self.stats)
+        )
+        logger.info(
+            f"✅ Connected to database (pool {config.DB_POOL_MIN_SIZE}-{config.DB_POOL_MAX_SIZE}, "
+            f"adaptive={config.DB_POOL_ADAPTIVE})"
         )
-        logger.info("✅ Connected to database")
-        await self.create_tables()
+        await self.migrate()
+        
+        if config.DATABASE_REPLICA_URL:
+            try:
+                self.replica_pool = await asyncpg.create_pool(
+                    config.DATABASE_REPLICA_URL,
+                    min_size=1,
+                    max_size=config.DB_REPLICA_POOL_MAX_SIZE,
+                    command_timeout=config.DB_COMMAND_TIMEOUT,
+                    max_inactive_connection_lifetime=config.DB_POOL_MAX_INACTIVE_LIFETIME,
+                    init=self._make_init(self.replica_stats)
+                )
+                await self._check_replica_lag()
+                self._replica_task = asyncio.create_task(self._replica_lag_loop())
+                logger.info(f"✅ Connected to read replica (lag {self.replica_lag})")
+            except Exception as e:
+                # Без реплики всё работает через primary
+                logger.error(f"Failed to connect to read replica, using primary only: {e}")
+                self.replica_pool = None
+        
+        if config.CACHE_ENABLED:
+            self._listener_task = asyncio.create_task(self._listen_invalidations())
+        
+        if config.DB_POOL_ADAPTIVE:
+            self.soft_limit = config.DB_POOL_MIN_SIZE
+            self._autoscale_task = asyncio.create_task(self._autoscale_loop())
     
     async def close(self):
         """Закрывает connection pool"""
+        if self._autoscale_task:
+            self._autoscale_task.cancel()
+        if self._replica_task:
+            self._replica_task.cancel()
+        if self._listener_task:
+            self._listener_task.cancel()
+        if self._listener_conn and not self._listener_conn.is_closed():
+            await self._listener_conn.close()
+        if self.replica_pool:
+            await self.replica_pool.close()
         if self.pool:
             await self.pool.close()
             logger.info("Database connection closed")
     
-    async def create_tables(self):
-        """Создаёт таблицы если их нет"""
-        async with self.pool.acquire() as conn:
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id BIGINT PRIMARY KEY,
-                    telegram_username TEXT,
-                    email TEXT,
-                    inn TEXT,
-                    promo_code TEXT,
-                    step TEXT DEFAULT 'start',
-                    created_at TIMESTAMP DEFAULT NOW(),
-                    completed_at TIMESTAMP,
-                    UNIQUE(inn)
+    @staticmethod
+    def _make_init(stats: PoolStats):
+        """init-хук пула: подключает учёт латентности запросов к каждому соединению"""
+        async def init(conn: asyncpg.Connection):
+            conn.add_query_logger(
+                lambda record: stats.record_query(
+                    record.query, record.elapsed, failed=record.exception is not None
                 )
-            """)
-            
-            await conn.execute("""
-                CREATE INDEX IF NOT EXISTS idx_users_email ON users(email)
-            """)
-            
-            await conn.execute("""
-                CREATE INDEX IF NOT EXISTS idx_users_inn ON users(inn)
-            """)
+            )
+        return init
+    
+    @asynccontextmanager
+    async def acquire(self, readonly: bool = False):
+        """
+        Получить соединение с учётом времени ожидания и мягкого лимита.
+
+        readonly=True — запрос можно выполнить на реплике (отчёты, сканы).
+        Если реплики нет или она отстаёт, используется primary.
+        """
+        started = time.monotonic()
+        timeout = config.DB_ACQUIRE_TIMEOUT
+        if readonly and self.replica_pool and self.replica_ok:
+            self.replica_stats.checked_out += 1
+            try:
+                try:
+                    conn = await self.replica_pool.acquire(timeout=timeout)
+                except asyncio.TimeoutError:
+                    self.replica_stats.acquire_timeouts += 1
+                    raise
+                self.replica_stats.record_wait(time.monotonic() - started)
+                try:
+                    yield conn
+                finally:
+                    await self.replica_pool.release(conn)
+            finally:
+                self.replica_stats.checked_out -= 1
+            return
+        
+        # DB_ACQUIRE_TIMEOUT покрывает и ожидание мягкого лимита, и сам пул
+        try:
+            async with self._slot_freed:
+                await asyncio.wait_for(
+                    self._slot_freed.wait_for(lambda: self.stats.checked_out < self.soft_limit),
+                    timeout
+                )
+                self.stats.checked_out += 1
+        except asyncio.TimeoutError:
+            self.stats.acquire_timeouts += 1
+            raise
+        try:
+            try:
+                remaining = max(timeout - (time.monotonic() - started), 0.001)
+                conn = await self.pool.acquire(timeout=remaining)
+            except asyncio.TimeoutError:
+                self.stats.acquire_timeouts += 1
+                raise
+            self.stats.record_wait(time.monotonic() - started)
+            self.stats.checked_out_max = max(self.stats.checked_out_max, self.stats.checked_out)
+            try:
+                yield conn
+            finally:
+                await self.pool.release(conn)
+        finally:
+            async with self._slot_freed:
+                self.stats.checked_out -= 1
+                self._slot_freed.notify()
+    
+    async def _autoscale_loop(self):
+        """Адаптивный размер: растём при устойчивом ожидании, сжимаемся при простое"""
+        interval = config.DB_POOL_ADAPTIVE_INTERVAL
+        grow_after_ms = config.DB_POOL_GROW_WAIT_MS
+        last_acquires, last_wait = 0, 0.0
+        
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                acquires = self.stats.acquires - last_acquires
+                wait = self.stats.wait_total - last_wait
+                last_acquires, last_wait = self.stats.acquires, self.stats.wait_total
+                avg_wait_ms = wait / acquires * 1000 if acquires else 0.0
+                
+                if avg_wait_ms > grow_after_ms and self.soft_limit < config.DB_POOL_MAX_SIZE:
+                    self.soft_limit += 1
+                    logger.info(f"DB pool grown to {self.soft_limit} (avg wait {avg_wait_ms:.1f} ms)")
+                    async with self._slot_freed:
+                        self._slot_freed.notify_all()
+                elif (
+                    self.stats.checked_out_max < self.soft_limit - 1
+                    and self.soft_limit > config.DB_POOL_MIN_SIZE
+                ):
+                    self.soft_limit -= 1
+                    logger.info(f"DB pool shrunk to {self.soft_limit} (idle)")
+                
+                # Пик занятости считаем по окну
+                self.stats.checked_out_max = self.stats.checked_out
+            except Exception as e:
+                logger.error(f"DB pool autoscale error: {e}")
+    
+    async def _check_replica_lag(self):
+        """Измеряет отставание реплики; при превышении порога чтения уходят на primary"""
+        try:
+            async with self.replica_pool.acquire() as conn:
+                # Если всё полученное уже применено — реплика догнала primary
+                lag = await conn.fetchval("""
+                    SELECT CASE
+                        WHEN NOT pg_is_in_recovery() THEN 0
+                        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                        ELSE COALESCE(EXTRACT(EPOCH FROM NOW() - pg_last_xact_replay_timestamp()), 0)
+                    END
+                """)
+            self.replica_lag = float(lag)
+            healthy = self.replica_lag <= config.DB_REPLICA_MAX_LAG_SECONDS
+        except Exception as e:
+            logger.error(f"Replica lag check failed: {e}")
+            self.replica_lag = None
+            healthy = False
+        
+        if healthy != self.replica_ok:
+            if healthy:
+                logger.info(f"Read replica back in rotation (lag {self.replica_lag:.1f}s)")
+            else:
+                logger.warning(f"Read replica lagging ({self.replica_lag}s), falling back to primary")
+        self.replica_ok = healthy
+    
+    async def _replica_lag_loop(self):
+        """Периодическая проверка отставания реплики"""
+        while True:
+            await asyncio.sleep(config.DB_REPLICA_CHECK_INTERVAL)
+            await self._check_replica_lag()
+    
+    async def invalidate(self, *keys: str):
+        """Сбросить ключи кэша здесь и во всех остальных процессах бота (NOTIFY)"""
+        for key in keys:
+            self.cache.evict(key)
+        if not config.CACHE_ENABLED or not keys:
+            return
+        try:
+            async with self.acquire() as conn:
+                await conn.execute(
+                    "SELECT pg_notify($1, $2)",
+                    config.CACHE_INVALIDATION_CHANNEL, ",".join(keys)
+                )
+        except Exception as e:
+            logger.error(f"Failed to publish cache invalidation {keys}: {e}")
+    
+    def _on_invalidation(self, conn, pid, channel, payload: str):
+        for key in payload.split(","):
+            if key:
+                self.cache.evict(key)
+    
+    async def _listen_invalidations(self):
+        """Отдельное LISTEN-соединение; при обрыве переподключается и сбрасывает весь кэш"""
+        backoff = 1
+        while True:
+            lost = asyncio.Event()
+            try:
+                self._listener_conn = await asyncpg.connect(config.DATABASE_URL)
+                self._listener_conn.add_termination_listener(lambda conn: lost.set())
+                await self._listener_conn.add_listener(
+                    config.CACHE_INVALIDATION_CHANNEL, self._on_invalidation
+                )
+                # Пока соединения не было, сообщения могли потеряться
+                self.cache.evict("*")
+                logger.info("✅ Listening for cache invalidations")
+                backoff = 1
+                await lost.wait()
+                logger.warning("Cache invalidation listener disconnected")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Cache invalidation listener error: {e}")
             
-            logger.info("✅ Tables created/verified")
+            self.cache.evict("*")
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 60)
+    
+    def get_pool_stats(self) -> Dict[str, Any]:
+        """Снимок телеметрии пула для админки"""
+        snapshot = self.stats.snapshot()
+        snapshot.update({
+            "pool_size": self.pool.get_size() if self.pool else 0,
+            "pool_idle": self.pool.get_idle_size() if self.pool else 0,
+            "min_size": config.DB_POOL_MIN_SIZE,
+            "max_size": config.DB_POOL_MAX_SIZE,
+            "soft_limit": self.soft_limit,
+            "adaptive": config.DB_POOL_ADAPTIVE,
+            "replica": self.replica_stats.snapshot() if self.replica_pool else None,
+            "replica_ok": self.replica_ok,
+            "replica_lag": self.replica_lag,
+        })
+        return snapshot
+    
+    def _load_migrations(self) -> List[Tuple[int, str, str]]:
+        """Читает файлы миграций, отсортированные по номеру версии"""
+        migrations = []
+        for filename in os.listdir(MIGRATIONS_DIR):
+            match = MIGRATION_FILE_RE.match(filename)
+            if not match:
+                continue
+            with open(os.path.join(MIGRATIONS_DIR, filename), encoding="utf-8") as f:
+                migrations.append((int(match.group(1)), filename, f.read()))
+        
+        migrations.sort(key=lambda m: m[0])
+        versions = [m[0] for m in migrations]
+        if len(versions) != len(set(versions)):
+            raise RuntimeError(f"Duplicate migration versions in {MIGRATIONS_DIR}")
+        return migrations
+    
+    async def migrate(self):
+        """Применяет недостающие миграции схемы (один раз при старте)"""
+        async with self.acquire() as conn:
+            # Блокировка на уровне сессии: второй процесс дождётся первого
+            await conn.execute("SELECT pg_advisory_lock($1)", MIGRATIONS_LOCK_KEY)
+            try:
+                await conn.execute("""
+                    CREATE TABLE IF NOT EXISTS schema_version (
+                        version INTEGER PRIMARY KEY,
+                        name TEXT NOT NULL,
+                        applied_at TIMESTAMP DEFAULT NOW()
+                    )
+                """)
+                applied = {
+                    row['version']
+                    for row in await conn.fetch("SELECT version FROM schema_version")
+                }
+                
+                for version, name, sql in self._load_migrations():
+                    if version in applied:
+                        continue
+                    
+                    logger.info(f"Applying migration {name}...")
+                    if sql.lstrip().startswith("-- backfill"):
+                        await self._run_backfill(conn, name, sql)
+                        await conn.execute(
+                            "INSERT INTO schema_version (version, name) VALUES ($1, $2)",
+                            version, name
+                        )
+                    elif sql.lstrip().startswith("-- no-transaction"):
+                        await self._run_without_transaction(conn, name, sql)
+                        await conn.execute(
+                            "INSERT INTO schema_version (version, name) VALUES ($1, $2)",
+                            version, name
+                        )
+                    else:
+                        async with conn.transaction():
+                            await conn.execute(sql)
+                            await conn.execute(
+                                "INSERT INTO schema_version (version, name) VALUES ($1, $2)",
+                                version, name
+                            )
+                    logger.info(f"✅ Migration {name} applied")
+            finally:
+                await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATIONS_LOCK_KEY)
+        
+        logger.info("✅ Schema is up to date")
+    
+    async def _run_backfill(self, conn: asyncpg.Connection, name: str, sql: str):
+        """Батчевый онлайн-бэкфилл: повторяет запрос, пока он затрагивает строки"""
+        batch_size = config.MIGRATION_BATCH_SIZE
+        total = 0
+        while True:
+            # Каждый батч — отдельная короткая транзакция, чтобы не держать блокировки
+            result = await conn.execute(sql, batch_size)
+            affected = int(result.split()[-1]) if result.split()[-1].isdigit() else 0
+            total += affected
+            if affected == 0:
+                break
+            logger.info(f"Backfill {name}: {total} rows processed")
+    
+    async def _run_without_transaction(self, conn: asyncpg.Connection, name: str, sql: str):
+        """
+        Миграция вне транзакции (CREATE INDEX CONCURRENTLY): каждый оператор
+        отдельным запросом, иначе несколько операторов в одном запросе
+        выполняются неявной транзакцией
+        """
+        lines = [line for line in sql.splitlines() if not line.strip().startswith("--")]
+        statements = [stmt.strip() for stmt in "\n".join(lines).split(";") if stmt.strip()]
+        for n, statement in enumerate(statements, 1):
+            await conn.execute(statement)
+            logger.info(f"Migration {name}: statement {n}/{len(statements)} done")
     
     async def get_user(self, user_id: int) -> Optional[Dict[str, Any]]:
         """Получить пользователя по ID"""
-        async with self.pool.acquire() as conn:
+        cached = self.cache.get(f"user:{user_id}")
+        if cached is not None:
+            return dict(cached)
+        
+        async with self.acquire() as conn:
             row = await conn.fetchrow(
-                "SELECT * FROM users WHERE user_id = $1",
+                "SELECT * FROM users_all WHERE user_id = $1",
                 user_id
             )
-            return dict(row) if row else None
+        if not row:
+            return None
+        user = dict(row)
+        self.cache.set(f"user:{user_id}", user, config.CACHE_USER_TTL)
+        return dict(user)
     
+    def _notify_reminder(self, user_id: int, due_at: Optional[datetime]):
+        """Сообщить планировщику о новом дедлайне напоминания"""
+        if due_at is None:
+            return
+        for hook in self.reminder_hooks:
+            try:
+                hook(user_id, due_at)
+            except Exception as e:
+                logger.error(f"Reminder hook failed for user {user_id}: {e}")
+
     async def create_user(self, user_id: int, username: Optional[str] = None):
         """Создать нового пользователя"""
-        async with self.pool.acquire() as conn:
-            await conn.execute("""
-                INSERT INTO users (user_id, telegram_username, step)
-                VALUES ($1, $2, 'email')
+        async with self.acquire() as conn:
+            due_at = await conn.fetchval("""
+                INSERT INTO users (user_id, telegram_username, step, next_reminder_at)
+                VALUES ($1, $2, 'email', NOW() + make_interval(mins => $3))
                 ON CONFLICT (user_id) DO NOTHING
-            """, user_id, username)
+                RETURNING next_reminder_at
+            """, user_id, username, config.REMINDER_INTERVALS['incomplete_1h'])
             logger.info(f"User {user_id} created")
+        await self.invalidate(f"user:{user_id}", "stats:*")
+        self._notify_reminder(user_id, due_at)
     
     async def update_user(self, user_id: int, **kwargs):
-        """Обновить данные пользователя"""
+        """Обновить данные пользователя (при смене этапа пересчитывается next_reminder_at)"""
         if not kwargs:
             return
         
-        set_clause = ", ".join([f"{k} = ${i+2}" for i, k in enumerate(kwargs.keys())])
+        extra = ""
+        if kwargs.get('completed_at'):
+            kwargs['next_reminder_at'] = kwargs['completed_at'] + timedelta(
+                minutes=config.REMINDER_INTERVALS['promo_reminder']
+            )
+        elif 'step' in kwargs:
+            if kwargs['step'] in config.REMINDER_STEPS:
+                extra = f", next_reminder_at = {next_incomplete_reminder_sql()}"
+            else:
+                kwargs['next_reminder_at'] = None
+        
+        set_clause = ", ".join([f"{k} = ${i+2}" for i, k in enumerate(kwargs.keys())]) + extra
         values = [user_id] + list(kwargs.values())
         
-        async with self.pool.acquire() as conn:
-            await conn.execute(
-                f"UPDATE users SET {set_clause} WHERE user_id = $1",
+        async with self.acquire() as conn:
+            due_at = await conn.fetchval(
+                f"UPDATE users SET {set_clause} WHERE user_id = $1 RETURNING next_reminder_at",
                 *values
             )
             logger.info(f"User {user_id} updated: {kwargs}")
+        await self.invalidate(f"user:{user_id}", "stats:*")
+        self._notify_reminder(user_id, due_at)
     
+    async def complete_registration(self, user_id: int, inn: str) -> Dict[str, Any]:
+        """
+        Завершение регистрации одной транзакцией.
+
+        Блокирует строку пользователя, проверяет уникальность ИНН, забирает свободный
+        промокод, записывает завершение и ставит запись в Google Sheets в очередь.
+        Возвращает {"status": ...}: completed, already_completed, inn_taken,
+        no_promo, not_found. Для completed/already_completed есть promo_code и email.
+        """
+        async with self.acquire() as conn:
+            try:
+                async with conn.transaction():
+                    user = await conn.fetchrow(
+                        "SELECT * FROM users WHERE user_id = $1 FOR UPDATE",
+                        user_id
+                    )
+                    if not user:
+                        archived = await conn.fetchrow(
+                            "SELECT promo_code, email FROM users_archive WHERE user_id = $1",
+                            user_id
+                        )
+                        if archived:
+                            return {"status": "already_completed", **dict(archived)}
+                        return {"status": "not_found"}
+
+                    # Повторный клик: возвращаем уже выданный промокод
+                    if user['completed_at'] or user['step'] == 'completed':
+                        return {
+                            "status": "already_completed",
+                            "promo_code": user['promo_code'],
+                            "email": user['email']
+                        }
+
+                    inn_taken = await conn.fetchval(
+                        "SELECT EXISTS(SELECT 1 FROM users_all WHERE inn = $1 AND user_id != $2)",
+                        inn, user_id
+                    )
+                    if inn_taken:
+                        return {"status": "inn_taken"}
+
+                    promo_code = await conn.fetchval("""
+                        UPDATE promo_codes SET user_id = $1, claimed_at = NOW()
+                        WHERE code = (
+                            SELECT code FROM promo_codes
+                            WHERE user_id IS NULL
+                            ORDER BY code
+                            LIMIT 1
+                            FOR UPDATE SKIP LOCKED
+                        )
+                        RETURNING code
+                    """, user_id)
+                    if not promo_code:
+                        return {"status": "no_promo"}
+
+                    completed_at = datetime.now()
+                    # Следующее напоминание — о промокоде
+                    due_at = completed_at + timedelta(minutes=config.REMINDER_INTERVALS['promo_reminder'])
+                    await conn.execute("""
+                        UPDATE users
+                        SET inn = $2, promo_code = $3, step = 'completed', completed_at = $4,
+                            next_reminder_at = $5
+                        WHERE user_id = $1
+                    """, user_id, inn, promo_code, completed_at, due_at)
+
+                    # Зеркалирование в Google Sheets выполняет фоновый воркер
+                    await conn.executemany(
+                        "INSERT INTO sheets_outbox (kind, payload) VALUES ($1, $2::jsonb)",
+                        [
+                            ("promo_used", json.dumps({
+                                "code": promo_code,
+                                "claimed_at": completed_at.strftime("%d.%m.%Y %H:%M")
+                            })),
+                            ("registration", json.dumps({
+                                "email": user['email'],
+                                "inn": inn,
+                                "promo_code": promo_code
+                            })),
+                        ]
+                    )
+            except asyncpg.UniqueViolationError as e:
+                if e.constraint_name != INN_UNIQUE_CONSTRAINT:
+                    raise
+                # Параллельная регистрация с тем же ИНН успела раньше
+                return {"status": "inn_taken"}
+
+        await self.invalidate(f"user:{user_id}", "stats:*")
+        self._notify_reminder(user_id, due_at)
+        logger.info(f"User {user_id} completed registration with promo {promo_code}")
+        return {"status": "completed", "promo_code": promo_code, "email": user['email']}
+
+    async def import_promo_codes(self, codes: List[str]) -> int:
+        """Добавить свободные промокоды в инвентарь (уже известные коды не трогаются)"""
+        if not codes:
+            return 0
+        async with self.acquire() as conn:
+            result = await conn.execute("""
+                INSERT INTO promo_codes (code)
+                SELECT UNNEST($1::text[])
+                ON CONFLICT (code) DO NOTHING
+            """, codes)
+        imported = int(result.split()[-1])
+        if imported:
+            await self.invalidate("stats:*")
+        return imported
+
+    async def count_free_promos(self) -> int:
+        """Количество невыданных промокодов в инвентаре"""
+        async with self.acquire(readonly=True) as conn:
+            return await conn.fetchval("SELECT COUNT(*) FROM promo_codes WHERE user_id IS NULL")
+
+    async def fetch_sheets_outbox(self, limit: int = 50) -> List[Dict[str, Any]]:
+        """Необработанные записи для Google Sheets (старые первыми, без отложенных и мёртвых)"""
+        async with self.acquire() as conn:
+            rows = await conn.fetch("""
+                SELECT id, kind, payload, attempts FROM sheets_outbox
+                WHERE processed_at IS NULL AND failed_at IS NULL AND available_at <= NOW()
+                ORDER BY id
+                LIMIT $1
+            """, limit)
+        return [dict(row, payload=json.loads(row['payload'])) for row in rows]
+
+    async def finish_sheets_outbox(self, outbox_id: int, error: Optional[str] = None) -> bool:
+        """
+        Отметить запись очереди как обработанную или зафиксировать ошибку.
+        После ошибки запись откладывается с экспоненциальной паузой, после
+        SHEETS_OUTBOX_MAX_ATTEMPTS — помечается мёртвой. True — запись мертва.
+        """
+        async with self.acquire() as conn:
+            if error is None:
+                await conn.execute(
+                    "UPDATE sheets_outbox SET processed_at = NOW(), attempts = attempts + 1 WHERE id = $1",
+                    outbox_id
+                )
+                return False
+            return bool(await conn.fetchval("""
+                UPDATE sheets_outbox
+                SET attempts = attempts + 1,
+                    last_error = $2,
+                    available_at = NOW() + make_interval(secs => LEAST($3 * 2 ^ attempts, 3600)),
+                    failed_at = CASE WHEN attempts + 1 >= $4 THEN NOW() END
+                WHERE id = $1
+                RETURNING failed_at IS NOT NULL
+            """, outbox_id, error[:500], config.SHEETS_OUTBOX_RETRY_BASE_SECONDS,
+                config.SHEETS_OUTBOX_MAX_ATTEMPTS))
+
+    async def get_telegram_assets(self) -> Dict[str, Tuple[str, str]]:
+        """Сохранённые file_id изображений: name -> (sha256, file_id)"""
+        async with self.acquire() as conn:
+            rows = await conn.fetch("SELECT name, sha256, file_id FROM telegram_assets")
+        return {row['name']: (row['sha256'], row['file_id']) for row in rows}
+
+    async def save_telegram_asset(self, name: str, sha256: str, file_id: str):
+        """Запомнить file_id загруженного изображения"""
+        async with self.acquire() as conn:
+            await conn.execute("""
+                INSERT INTO telegram_assets (name, sha256, file_id)
+                VALUES ($1, $2, $3)
+                ON CONFLICT (name) DO UPDATE
+                SET sha256 = EXCLUDED.sha256, file_id = EXCLUDED.file_id, updated_at = NOW()
+            """, name, sha256, file_id)
+
     async def check_inn_exists(self, inn: str) -> bool:
         """Проверить существует ли уже такой ИНН"""
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             result = await conn.fetchval(
-                "SELECT EXISTS(SELECT 1 FROM users WHERE inn = $1)",
+                "SELECT EXISTS(SELECT 1 FROM users_all WHERE inn = $1)",
                 inn
             )
             return result
     
     async def get_stats(self) -> Dict[str, Any]:
         """Получить базовую статистику"""
-        async with self.pool.acquire() as conn:
-            total = await conn.fetchval("SELECT COUNT(*) FROM users")
+        cached = self.cache.get("stats:basic")
+        if cached is not None:
+            return dict(cached)
+        
+        async with self.acquire(readonly=True) as conn:
+            total = await conn.fetchval("SELECT COUNT(*) FROM users_all")
             completed = await conn.fetchval(
-                "SELECT COUNT(*) FROM users WHERE completed_at IS NOT NULL"
+                "SELECT COUNT(*) FROM users_all WHERE completed_at IS NOT NULL"
             )
             promo_codes_issued = await conn.fetchval(
-                "SELECT COUNT(*) FROM users WHERE promo_code IS NOT NULL"
+                "SELECT COUNT(*) FROM users_all WHERE promo_code IS NOT NULL"
             )
-            return {
-                "total_users": total,
-                "completed_users": completed,
-                "conversion_rate": round(completed / total * 100, 2) if total > 0 else 0,
-                "promo_codes_issued": promo_codes_issued
-            }
+        stats = {
+            "total_users": total,
+            "completed_users": completed,
+            "conversion_rate": round(completed / total * 100, 2) if total > 0 else 0,
+            "promo_codes_issued": promo_codes_issued
+        }
+        self.cache.set("stats:basic", stats, config.CACHE_STATS_TTL)
+        return dict(stats)
     
     async def get_detailed_stats(self) -> Dict[str, Any]:
         """Получить детальную статистику"""
-        async with self.pool.acquire() as conn:
+        cached = self.cache.get("stats:detailed")
+        if cached is not None:
+            return dict(cached)
+        
+        async with self.acquire(readonly=True) as conn:
             # Общая статистика
-            total = await conn.fetchval("SELECT COUNT(*) FROM users")
+            total = await conn.fetchval("SELECT COUNT(*) FROM users_all")
             completed = await conn.fetchval(
-                "SELECT COUNT(*) FROM users WHERE completed_at IS NOT NULL"
+                "SELECT COUNT(*) FROM users_all WHERE completed_at IS NOT NULL"
             )
             in_progress = await conn.fetchval(
                 "SELECT COUNT(*) FROM users WHERE completed_at IS NULL AND step != 'start'"
@@ -130,58 +788,253 @@ class Database:
             
             # За последние 24 часа
             users_last_24h = await conn.fetchval(
-                "SELECT COUNT(*) FROM users WHERE created_at > NOW() - INTERVAL '24 hours'"
+                "SELECT COUNT(*) FROM users_all WHERE created_at > NOW() - INTERVAL '24 hours'"
             )
             completed_last_24h = await conn.fetchval(
-                "SELECT COUNT(*) FROM users WHERE completed_at > NOW() - INTERVAL '24 hours'"
+                "SELECT COUNT(*) FROM users_all WHERE completed_at > NOW() - INTERVAL '24 hours'"
             )
             
             # Промокоды
             promo_codes_issued = await conn.fetchval(
-                "SELECT COUNT(*) FROM users WHERE promo_code IS NOT NULL"
+                "SELECT COUNT(*) FROM users_all WHERE promo_code IS NOT NULL"
             )
             
-            # Получаем количество доступных промокодов из Google Sheets
-            try:
-                logger.info("Getting available promos from Google Sheets...")
-                from sheets import sheets
-                available_promos_list = sheets.get_available_promo_codes()
-                available_promos = len(available_promos_list)
-                logger.info(f"Found {available_promos} available promo codes")
-            except Exception as e:
-                logger.error(f"Error getting available promos: {e}")
-                import traceback
-                logger.error(traceback.format_exc())
-                available_promos = 0
-            
-            return {
-                "total_users": total,
-                "completed_users": completed,
-                "in_progress_users": in_progress,
-                "conversion_rate": round(completed / total * 100, 2) if total > 0 else 0,
-                "users_last_24h": users_last_24h,
-                "completed_last_24h": completed_last_24h,
-                "promo_codes_issued": promo_codes_issued,
-                "available_promos": available_promos
-            }
+            # Свободные промокоды — из инвентаря в БД
+            available_promos = await conn.fetchval(
+                "SELECT COUNT(*) FROM promo_codes WHERE user_id IS NULL"
+            )
+        
+        stats = {
+            "total_users": total,
+            "completed_users": completed,
+            "in_progress_users": in_progress,
+            "conversion_rate": round(completed / total * 100, 2) if total > 0 else 0,
+            "users_last_24h": users_last_24h,
+            "completed_last_24h": completed_last_24h,
+            "promo_codes_issued": promo_codes_issued,
+            "available_promos": available_promos
+        }
+        self.cache.set("stats:detailed", stats, config.CACHE_STATS_TTL)
+        return dict(stats)
     
     async def get_recent_users(self, limit: int = 10) -> list:
         """Получить последних пользователей"""
-        async with self.pool.acquire() as conn:
+        async with self.acquire(readonly=True) as conn:
             rows = await conn.fetch(
                 "SELECT * FROM users ORDER BY created_at DESC LIMIT $1",
                 limit
             )
             return [dict(row) for row in rows]
     
+    async def get_incomplete_users_page(
+        self,
+        limit: int,
+        after: Optional[Tuple[datetime, int]] = None,
+        before: Optional[Tuple[datetime, int]] = None,
+        exclude_start: bool = False
+    ) -> Dict[str, Any]:
+        """
+        Страница незавершённых регистраций (новые сверху), keyset-пагинация по (created_at, user_id).
+
+        after — курсор последней строки предыдущей страницы (листаем вперёд),
+        before — курсор первой строки текущей страницы (листаем назад).
+        Возвращает rows и флаги has_prev/has_next.
+        """
+        conditions = ["completed_at IS NULL"]
+        if exclude_start:
+            conditions.append("step != 'start'")
+
+        args: list = [limit + 1]
+        if before:
+            conditions.append("(created_at, user_id) > ($2, $3)")
+            args.extend(before)
+            order = "ASC"
+        else:
+            if after:
+                conditions.append("(created_at, user_id) < ($2, $3)")
+                args.extend(after)
+            order = "DESC"
+
+        async with self.acquire(readonly=True) as conn:
+            rows = await conn.fetch(f"""
+                SELECT user_id, telegram_username, email, step, created_at
+                FROM users
+                WHERE {' AND '.join(conditions)}
+                ORDER BY created_at {order}, user_id {order}
+                LIMIT $1
+            """, *args)
+
+        rows = [dict(row) for row in rows]
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+
+        if before:
+            rows.reverse()
+            return {"rows": rows, "has_prev": has_more, "has_next": True}
+        return {"rows": rows, "has_prev": after is not None, "has_next": has_more}
+
+    async def search_users(self, query: str, limit: int = 10) -> List[Dict[str, Any]]:
+        """
+        Ранжированный поиск по user_id, username, email, ИНН и промокоду (активные и архивные).
+
+        Точное совпадение и префикс ранжируются выше нечёткого (pg_trgm) совпадения.
+        Все условия покрыты индексами из миграции 0006.
+        """
+        # Экранируем спецсимволы LIKE, чтобы запрос искался буквально
+        escaped = query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        prefix = escaped + '%'
+        user_id = int(query) if query.isdigit() and len(query) <= 18 else None
+
+        async with self.acquire(readonly=True) as conn:
+            rows = await conn.fetch("""
+                SELECT user_id, telegram_username, email, inn, promo_code, step,
+                       created_at, completed_at, archived,
+                       GREATEST(
+                           CASE WHEN user_id = $3 THEN 1.0 ELSE 0 END,
+                           CASE WHEN inn = $1 THEN 1.0 WHEN inn LIKE $2 THEN 0.9 ELSE 0 END,
+                           CASE WHEN upper(promo_code) = upper($1) THEN 1.0
+                                WHEN upper(promo_code) LIKE upper($2) THEN 0.9 ELSE 0 END,
+                           CASE WHEN lower(telegram_username) = lower($1) THEN 1.0
+                                WHEN lower(telegram_username) LIKE lower($2) THEN 0.8
+                                ELSE COALESCE(similarity(lower(telegram_username), lower($1)), 0) END,
+                           CASE WHEN lower(email) = lower($1) THEN 1.0
+                                WHEN lower(email) LIKE lower($2) THEN 0.8
+                                ELSE COALESCE(similarity(lower(email), lower($1)), 0) END
+                       ) AS score
+                FROM users_all
+                WHERE user_id = $3
+                   OR inn LIKE $2
+                   OR upper(promo_code) LIKE upper($2)
+                   OR lower(telegram_username) LIKE lower($2)
+                   OR lower(telegram_username) % lower($1)
+                   OR lower(email) LIKE lower($2)
+                   OR lower(email) % lower($1)
+                ORDER BY score DESC, created_at DESC
+                LIMIT $4
+            """, query, prefix, user_id, limit)
+        return [dict(row) for row in rows]
+
+    async def archive_completed_users(self) -> int:
+        """Перенести давно завершённые регистрации в users_archive батчами"""
+        total = 0
+        while True:
+            async with self.acquire() as conn:
+                # Короткая транзакция на батч: сначала вставка в архив, удаляются
+                # только реально записанные строки — пользователь не пропадёт из обеих таблиц
+                result = await conn.execute("""
+                    WITH batch AS (
+                        SELECT user_id, telegram_username, email, inn, promo_code,
+                               step, created_at, completed_at
+                        FROM users
+                        WHERE completed_at IS NOT NULL
+                          AND completed_at < NOW() - make_interval(days => $1)
+                        ORDER BY completed_at
+                        LIMIT $2
+                        FOR UPDATE SKIP LOCKED
+                    ),
+                    archived AS (
+                        INSERT INTO users_archive (user_id, telegram_username, email, inn, promo_code,
+                                                   step, created_at, completed_at)
+                        SELECT * FROM batch
+                        ON CONFLICT (user_id) DO UPDATE SET
+                            telegram_username = EXCLUDED.telegram_username,
+                            email = EXCLUDED.email,
+                            inn = EXCLUDED.inn,
+                            promo_code = EXCLUDED.promo_code,
+                            step = EXCLUDED.step,
+                            created_at = EXCLUDED.created_at,
+                            completed_at = EXCLUDED.completed_at,
+                            archived_at = NOW()
+                        RETURNING user_id
+                    )
+                    DELETE FROM users
+                    WHERE user_id IN (SELECT user_id FROM archived)
+                """, config.ARCHIVE_AFTER_DAYS, config.ARCHIVE_BATCH_SIZE)
+            moved = int(result.split()[-1])
+            total += moved
+            if moved < config.ARCHIVE_BATCH_SIZE:
+                break
+            # Даём пройти пользовательским запросам между батчами
+            await asyncio.sleep(config.ARCHIVE_BATCH_PAUSE)
+        
+        if total:
+            logger.info(f"Archived {total} completed users")
+        return total
+    
+    async def start_archiver(self):
+        """Периодическая архивация завершённых регистраций"""
+        logger.info("🗄️ Starting users archiver...")
+        while True:
+            try:
+                await self.archive_completed_users()
+            except Exception as e:
+                logger.error(f"Users archiver error: {e}")
+            await asyncio.sleep(config.ARCHIVE_INTERVAL)
+    
+    @staticmethod
+    async def release_promo(conn: asyncpg.Connection, user_id: int) -> Optional[str]:
+        """
+        Снять с пользователя выданный промокод (в транзакции вызывающего).
+        Код уже показан пользователю и отмечен в листе Promos как выданный,
+        поэтому в свободный пул он не возвращается — строка удаляется.
+        """
+        return await conn.fetchval(
+            "DELETE FROM promo_codes WHERE user_id = $1 RETURNING code", user_id
+        )
+
+    @staticmethod
+    async def assign_promo(conn: asyncpg.Connection, user_id: int, code: str) -> bool:
+        """
+        Закрепить конкретный промокод за пользователем (в транзакции вызывающего).
+        False — код уже выдан другому пользователю, ничего не изменено.
+        """
+        owner = await conn.fetchval(
+            "SELECT user_id FROM promo_codes WHERE code = $1 FOR UPDATE", code
+        )
+        if owner is not None and owner != user_id:
+            return False
+        # UNIQUE(user_id): прежний код пользователя снимаем до закрепления нового
+        await conn.execute(
+            "DELETE FROM promo_codes WHERE user_id = $1 AND code != $2", user_id, code
+        )
+        await conn.execute("""
+            INSERT INTO promo_codes (code, user_id, claimed_at)
+            VALUES ($1, $2, NOW())
+            ON CONFLICT (code) DO UPDATE
+            SET user_id = EXCLUDED.user_id,
+                claimed_at = COALESCE(promo_codes.claimed_at, EXCLUDED.claimed_at)
+        """, code, user_id)
+        return True
+
     async def delete_user(self, user_id: int) -> bool:
-        """Удалить пользователя"""
-        async with self.pool.acquire() as conn:
-            result = await conn.execute(
-                "DELETE FROM users WHERE user_id = $1",
-                user_id
-            )
-            return result == "DELETE 1"
+        """Удалить пользователя вместе с выданным промокодом и историей напоминаний"""
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                result = await conn.execute(
+                    "DELETE FROM users WHERE user_id = $1",
+                    user_id
+                )
+                archived = await conn.execute(
+                    "DELETE FROM users_archive WHERE user_id = $1",
+                    user_id
+                )
+                await conn.execute("DELETE FROM user_reminders WHERE user_id = $1", user_id)
+                await conn.execute("DELETE FROM reminder_assignments WHERE user_id = $1", user_id)
+                # Иначе повторная регистрация упрётся в UNIQUE(promo_codes.user_id)
+                await self.release_promo(conn, user_id)
+        await self.invalidate(f"user:{user_id}", "stats:*")
+        return result == "DELETE 1" or archived == "DELETE 1"
+
+    async def clear_users(self):
+        """Удалить всех пользователей (админская очистка) вместе с выданными промокодами"""
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute('DELETE FROM user_reminders')
+                await conn.execute('DELETE FROM reminder_assignments')
+                await conn.execute('DELETE FROM users')
+                await conn.execute('DELETE FROM users_archive')
+                await conn.execute('DELETE FROM promo_codes WHERE user_id IS NOT NULL')
+        await self.invalidate("*")
 
 # Глобальный инстанс
 db = Database()
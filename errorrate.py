@@ -0,0 +1,246 @@
+"""
+Алерты по частоте ошибок в скользящих окнах
+
+Логгер-хендлер считает записи уровня ERROR и выше по подсистемам (по имени
+логгера) в кольцевом буфере поминутных счётчиков на час. На каждую ошибку
+проверяются окна 5 и 60 минут — это константная работа: сумма пяти ячеек
+и поддерживаемая сумма за час. Превышение порога отправляет админам
+немедленное уведомление, повторное по той же подсистеме и окну — не раньше
+чем через ERROR_ALERT_COOLDOWN.
+"""
+import asyncio
+import html
+import logging
+import threading
+import time
+from typing import Optional, Dict, Any, List, Set
+
+import config
+from monitoring import metrics, monitoring
+from notifications import notifier
+
+logger = logging.getLogger(__name__)
+
+# Префикс имени логгера -> подсистема
+SUBSYSTEM_LOGGERS = {
+    'database': 'db',
+    'asyncpg': 'db',
+    'leases': 'db',
+    'sheets': 'sheets',
+    'gspread': 'sheets',
+    'outbound': 'telegram',
+    'outbox': 'telegram',
+    'assets': 'telegram',
+    'blocked': 'telegram',
+    'aiogram': 'telegram',
+    'fns_api': 'fns',
+}
+
+SUBSYSTEM_TITLES = {
+    'db': 'База данных',
+    'sheets': 'Google Sheets',
+    'telegram': 'Telegram',
+    'fns': 'ФНС',
+    'app': 'Приложение',
+}
+
+# Окно в минутах -> ключ порога в monitoring.alert_thresholds
+WINDOWS = {
+    5: 'high_error_rate_5m',
+    60: 'high_error_rate',
+}
+
+# После неудачной отправки алерта повторяем не раньше чем через (секунды)
+ALERT_RETRY_SECONDS = 60
+
+ERRORS_TOTAL = metrics.counter('bot_errors_total', 'Logged errors by subsystem', ('subsystem',))
+
+
+def subsystem_for(logger_name: str) -> str:
+    root = logger_name.split('.', 1)[0]
+    return SUBSYSTEM_LOGGERS.get(root, 'app')
+
+
+class MinuteRing:
+    """Поминутные счётчики за последний час и их сумма"""
+    __slots__ = ('counts', 'minute', 'total')
+
+    def __init__(self):
+        self.counts = [0] * 60
+        self.minute: Optional[int] = None
+        self.total = 0
+
+    def advance(self, minute: int):
+        """Сдвинуть окно до minute, обнулив устаревшие ячейки (амортизированно O(1))"""
+        if self.minute is None or minute - self.minute >= 60:
+            self.counts = [0] * 60
+            self.total = 0
+        elif minute > self.minute:
+            for m in range(self.minute + 1, minute + 1):
+                slot = m % 60
+                self.total -= self.counts[slot]
+                self.counts[slot] = 0
+        else:
+            return
+        self.minute = minute
+
+    def add(self, minute: int, count: int = 1):
+        self.advance(minute)
+        self.counts[minute % 60] += count
+        self.total += count
+
+    def window(self, minutes: int) -> int:
+        """Сумма за последние minutes минут, включая текущую"""
+        if self.minute is None:
+            return 0
+        if minutes >= 60:
+            return self.total
+        return sum(self.counts[(self.minute - k) % 60] for k in range(minutes))
+
+
+class ErrorRateMonitor(logging.Handler):
+    def __init__(self):
+        super().__init__(level=logging.ERROR)
+        self.rings: Dict[str, MinuteRing] = {}
+        self.last_error: Dict[str, str] = {}
+        # (подсистема, окно) -> когда последний раз алертили
+        self._alerted_at: Dict[tuple, float] = {}
+        # (подсистема, окно), по которым алерт сейчас отправляется
+        self._inflight: Set[tuple] = set()
+        self._tasks: Set[asyncio.Task] = set()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._counts_lock = threading.Lock()
+        self.alerts_sent = 0
+
+    def install(self):
+        """Подключить к корневому логгеру (в запущенном event loop)"""
+        self._loop = asyncio.get_running_loop()
+        root = logging.getLogger()
+        if self not in root.handlers:
+            root.addHandler(self)
+
+    def uninstall(self):
+        logging.getLogger().removeHandler(self)
+        self._loop = None
+
+    def emit(self, record: logging.LogRecord):
+        if record.name == __name__:
+            # Ошибки самой отправки алертов не считаем, чтобы не зациклиться
+            return
+        try:
+            self.record(subsystem_for(record.name), record.getMessage())
+        except Exception:
+            self.handleError(record)
+
+    def record(self, subsystem: str, message: str = '', count: int = 1):
+        """Учесть ошибку подсистемы и проверить пороги"""
+        ERRORS_TOTAL.inc(subsystem, amount=count)
+        now = time.time()
+        minute = int(now // 60)
+        with self._counts_lock:
+            ring = self.rings.get(subsystem)
+            if ring is None:
+                ring = self.rings[subsystem] = MinuteRing()
+            ring.add(minute, count)
+            if message:
+                self.last_error[subsystem] = message[:300]
+            breached = []
+            for window, threshold in self._thresholds():
+                observed = ring.window(window)
+                if observed < threshold:
+                    continue
+                key = (subsystem, window)
+                if key in self._inflight:
+                    continue
+                if now - self._alerted_at.get(key, 0.0) < config.ERROR_ALERT_COOLDOWN:
+                    continue
+                # Cooldown начнётся только после успешной отправки
+                self._inflight.add(key)
+                breached.append((window, observed, threshold))
+        if breached:
+            self._alert(subsystem, breached, now)
+
+    @staticmethod
+    def _thresholds() -> List[tuple]:
+        return [
+            (window, monitoring.alert_thresholds[key])
+            for window, key in WINDOWS.items()
+            if monitoring.alert_thresholds.get(key)
+        ]
+
+    def _alert(self, subsystem: str, breached: List[tuple], now: float):
+        """Одно сообщение на событие, даже если превышены оба окна"""
+        keys = [(subsystem, window) for window, _, _ in breached]
+        if self._loop is None or self._loop.is_closed():
+            self._settle(keys, delivered=False)
+            return
+        title = SUBSYSTEM_TITLES.get(subsystem, subsystem)
+        text = f"🚨 <b>Рост ошибок: {title}</b>\n\n"
+        text += "\n".join(
+            f"• {observed} за {window} мин (порог {threshold})"
+            for window, observed, threshold in breached
+        )
+        last = self.last_error.get(subsystem)
+        if last:
+            text += f"\n\nПоследняя: <code>{html.escape(last)}</code>"
+        # dedup_key совпадает у реплик в одном интервале cooldown — админ получит одно сообщение
+        bucket = int(now // max(config.ERROR_ALERT_COOLDOWN, 1))
+        windows = '+'.join(str(window) for window, _, _ in breached)
+        dedup = f"error_rate:{subsystem}:{windows}:{bucket}"
+        # emit бывает и из потоков (Sheets через to_thread)
+        self._loop.call_soon_threadsafe(self._start_delivery, text, dedup, subsystem, keys)
+
+    def _start_delivery(self, text: str, dedup: str, subsystem: str, keys: List[tuple]):
+        task = asyncio.ensure_future(self._deliver(text, dedup, subsystem, keys))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _deliver(self, text: str, dedup: str, subsystem: str, keys: List[tuple]):
+        # Очередь алертов живёт в БД: при её сбое отправляем напрямую через шлюз
+        try:
+            await notifier.escalate_now(text, dedup, direct_fallback=subsystem == 'db')
+        except Exception as e:
+            logger.error(f"Failed to deliver error-rate alert: {e}")
+            self._settle(keys, delivered=False)
+        else:
+            self._settle(keys, delivered=True)
+
+    def _settle(self, keys: List[tuple], delivered: bool):
+        """Снять отметку отправки; cooldown — после доставки, после сбоя — короткая пауза"""
+        now = time.time()
+        alerted_at = now if delivered else now - config.ERROR_ALERT_COOLDOWN + ALERT_RETRY_SECONDS
+        with self._counts_lock:
+            for key in keys:
+                self._inflight.discard(key)
+                self._alerted_at[key] = alerted_at
+            if delivered:
+                self.alerts_sent += 1
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Ошибки по подсистемам за окна (для админки и check_metrics)"""
+        minute = int(time.time() // 60)
+        stats = {}
+        with self._counts_lock:
+            for subsystem, ring in self.rings.items():
+                ring.advance(minute)
+                stats[subsystem] = {
+                    **{f"last_{window}m": ring.window(window) for window in WINDOWS},
+                    'last_error': self.last_error.get(subsystem),
+                }
+        return stats
+
+    def breaches(self) -> List[str]:
+        """Подсистемы, которые сейчас выше порога, — строками для алертов"""
+        stats = self.get_stats()
+        lines = []
+        for subsystem, values in stats.items():
+            for window, threshold in self._thresholds():
+                observed = values[f"last_{window}m"]
+                if observed >= threshold:
+                    title = SUBSYSTEM_TITLES.get(subsystem, subsystem)
+                    lines.append(f"⚠️ Много ошибок ({title}): {observed} за {window} мин")
+        return lines
+
+
+# Глобальный экземпляр
+error_rates = ErrorRateMonitor()
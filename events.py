@@ -0,0 +1,159 @@
+"""
+Журнал событий воронки регистрации и агрегаты по часам/дням
+"""
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Optional, Dict, Any, List, Tuple
+import config
+from database import db
+
+logger = logging.getLogger(__name__)
+
+# Допустимые события воронки
+FUNNEL_EVENTS = (
+    'start',
+    'email_ok',
+    'email_rejected',
+    'inn_ok',
+    'confirm',
+    'promo_issued',
+    'reminder_sent',
+)
+
+class EventLog:
+    def __init__(self):
+        self.buffer: List[Tuple[int, str, Optional[str], datetime]] = []
+        self.dropped = 0
+        self._flush_now = asyncio.Event()
+        self._writer_task: Optional[asyncio.Task] = None
+
+    def track(self, user_id: int, event: str, step: Optional[str] = None):
+        """Записать событие (без ожидания БД — попадёт в следующий батч)"""
+        if event not in FUNNEL_EVENTS:
+            logger.warning(f"Unknown funnel event: {event}")
+            return
+
+        if len(self.buffer) >= config.EVENTS_MAX_BUFFER:
+            # БД недоступна слишком долго — не растим память бесконечно
+            self.dropped += 1
+            return
+
+        self.buffer.append((user_id, event, step, datetime.now()))
+        if len(self.buffer) >= config.EVENTS_BATCH_SIZE:
+            self._flush_now.set()
+
+    def start(self):
+        """Запуск фонового писателя"""
+        if not self._writer_task:
+            self._writer_task = asyncio.create_task(self._writer_loop())
+
+    async def _writer_loop(self):
+        """Пишет накопленные события батчами: по таймеру или при заполнении батча"""
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_now.wait(), timeout=config.EVENTS_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_now.clear()
+            await self.flush()
+
+    async def flush(self):
+        """Сбросить буфер в user_events одним COPY"""
+        if not self.buffer:
+            return
+
+        batch, self.buffer = self.buffer, []
+        try:
+            async with db.acquire() as conn:
+                await conn.copy_records_to_table(
+                    'user_events',
+                    records=batch,
+                    columns=['user_id', 'event', 'step', 'created_at']
+                )
+        except Exception as e:
+            logger.error(f"Failed to write {len(batch)} funnel events: {e}")
+            # Вернём батч в начало буфера, попробуем в следующий раз; сверх лимита
+            # отбрасываем самые старые
+            self.buffer = batch + self.buffer
+            overflow = len(self.buffer) - config.EVENTS_MAX_BUFFER
+            if overflow > 0:
+                del self.buffer[:overflow]
+                self.dropped += overflow
+
+    async def close(self):
+        """Остановить писателя и дописать остаток"""
+        if self._writer_task:
+            self._writer_task.cancel()
+            self._writer_task = None
+        await self.flush()
+
+    async def rollup(self) -> int:
+        """Инкрементально досчитать часовые и дневные агрегаты по новым событиям"""
+        async with db.acquire() as conn:
+            async with conn.transaction():
+                last_id = await conn.fetchval("""
+                    INSERT INTO rollup_state (name) VALUES ('funnel')
+                    ON CONFLICT (name) DO UPDATE SET name = EXCLUDED.name
+                    RETURNING last_event_id
+                """)
+                # Берём только строки, записанные больше минуты назад (по часам БД), чтобы
+                # не перепрыгнуть id батча, который другая реплика ещё не закоммитила
+                max_id = await conn.fetchval("""
+                    SELECT MAX(id) FROM user_events
+                    WHERE id > $1 AND inserted_at < NOW() - INTERVAL '1 minute'
+                """, last_id)
+                if not max_id:
+                    return 0
+
+                for granularity in ('hour', 'day'):
+                    await conn.execute("""
+                        INSERT INTO funnel_rollups (granularity, bucket_start, event, events, seconds_total)
+                        SELECT $3, date_trunc($3, e.created_at), e.event, COUNT(*),
+                               COALESCE(SUM(EXTRACT(EPOCH FROM e.created_at - prev.created_at)), 0)
+                        FROM user_events e
+                        LEFT JOIN LATERAL (
+                            SELECT p.created_at FROM user_events p
+                            WHERE p.user_id = e.user_id AND p.created_at < e.created_at
+                            ORDER BY p.created_at DESC
+                            LIMIT 1
+                        ) prev ON TRUE
+                        WHERE e.id > $1 AND e.id <= $2
+                        GROUP BY 2, 3
+                        ON CONFLICT (granularity, bucket_start, event) DO UPDATE
+                        SET events = funnel_rollups.events + EXCLUDED.events,
+                            seconds_total = funnel_rollups.seconds_total + EXCLUDED.seconds_total
+                    """, last_id, max_id, granularity)
+
+                await conn.execute("""
+                    UPDATE rollup_state SET last_event_id = $1, updated_at = NOW()
+                    WHERE name = 'funnel'
+                """, max_id)
+
+                logger.info(f"Funnel rollup processed events {last_id + 1}..{max_id}")
+                return max_id - last_id
+
+    async def start_rollups(self):
+        """Периодический пересчёт агрегатов"""
+        logger.info("📈 Starting funnel rollups...")
+        while True:
+            try:
+                await self.rollup()
+            except Exception as e:
+                logger.error(f"Funnel rollup error: {e}")
+            await asyncio.sleep(config.EVENTS_ROLLUP_INTERVAL)
+
+    async def get_funnel(self, granularity: str = 'day', days: int = 7) -> List[Dict[str, Any]]:
+        """Агрегаты воронки за период: O(бакетов), а не O(пользователей)"""
+        since = datetime.now() - timedelta(days=days)
+        async with db.acquire(readonly=True) as conn:
+            rows = await conn.fetch("""
+                SELECT bucket_start, event, events, seconds_total
+                FROM funnel_rollups
+                WHERE granularity = $1 AND bucket_start >= date_trunc($1, $2::timestamp)
+                ORDER BY bucket_start, event
+            """, granularity, since)
+        return [dict(row) for row in rows]
+
+# Глобальный экземпляр
+events = EventLog()
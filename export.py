@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Потоковая выгрузка users и user_reminders в сжатый CSV через COPY ... TO STDOUT
+
+Строки не загружаются в память целиком: COPY отдаёт данные чанками,
+которые сразу пишутся в gzip-файл на диске.
+
+Использование:
+    python export.py users --from 2025-10-01 --to 2025-10-31 --step email
+    python export.py reminders -o reminders.csv.gz
+"""
+import argparse
+import asyncio
+import gzip
+import logging
+import os
+import tempfile
+from datetime import datetime, date, timedelta
+from typing import Optional, Dict, Any, List, Tuple
+
+from database import db
+
+logger = logging.getLogger(__name__)
+
+# Тип выгрузки -> (запрос, колонка для фильтра по дате)
+EXPORT_QUERIES = {
+    'users': ("""
+        SELECT u.user_id, u.telegram_username, u.email, u.inn, u.promo_code,
+               u.step, u.created_at, u.completed_at, u.archived
+        FROM users_all u
+    """, "u.created_at"),
+    'reminders': ("""
+        SELECT r.user_id, r.reminder_type, r.sent_at, u.step
+        FROM user_reminders r
+        LEFT JOIN users_all u ON u.user_id = r.user_id
+    """, "r.sent_at"),
+}
+
+
+def build_export_query(
+    kind: str,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    step: Optional[str] = None
+) -> Tuple[str, List[Any]]:
+    """Собирает запрос выгрузки с фильтрами по диапазону дат (включительно) и этапу"""
+    if kind not in EXPORT_QUERIES:
+        raise ValueError(f"Unknown export kind: {kind}")
+
+    query, date_column = EXPORT_QUERIES[kind]
+    conditions = []
+    args: List[Any] = []
+
+    if date_from:
+        args.append(datetime.combine(date_from, datetime.min.time()))
+        conditions.append(f"{date_column} >= ${len(args)}")
+    if date_to:
+        args.append(datetime.combine(date_to + timedelta(days=1), datetime.min.time()))
+        conditions.append(f"{date_column} < ${len(args)}")
+    if step:
+        args.append(step)
+        conditions.append(f"u.step = ${len(args)}")
+
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += f" ORDER BY {date_column}"
+    return query, args
+
+
+async def export_to_file(
+    kind: str,
+    path: str,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    step: Optional[str] = None
+) -> int:
+    """Выгружает данные в gzip-CSV по пути path, возвращает размер файла в байтах"""
+    query, args = build_export_query(kind, date_from, date_to, step)
+
+    with gzip.open(path, 'wb') as gz:
+        async def write_chunk(chunk: bytes):
+            gz.write(chunk)
+
+        async with db.acquire(readonly=True) as conn:
+            await conn.copy_from_query(
+                query, *args,
+                output=write_chunk,
+                format='csv',
+                header=True
+            )
+
+    size = os.path.getsize(path)
+    logger.info(f"Exported {kind} to {path} ({size} bytes)")
+    return size
+
+
+async def export_to_tempfile(kind: str, **filters) -> str:
+    """Выгрузка во временный файл (для отправки документом в Telegram). Файл удаляет вызывающий"""
+    fd, path = tempfile.mkstemp(prefix=f"{kind}_", suffix=".csv.gz")
+    os.close(fd)
+    try:
+        await export_to_file(kind, path, **filters)
+    except Exception:
+        os.unlink(path)
+        raise
+    return path
+
+
+def parse_export_filters(tokens: List[str]) -> Dict[str, Any]:
+    """Разбор фильтров вида from=2025-10-01 to=2025-10-31 step=email"""
+    filters: Dict[str, Any] = {}
+    for token in tokens:
+        key, sep, value = token.partition('=')
+        if not sep or not value:
+            raise ValueError(f"Неверный фильтр: {token}")
+        if key == 'from':
+            filters['date_from'] = date.fromisoformat(value)
+        elif key == 'to':
+            filters['date_to'] = date.fromisoformat(value)
+        elif key == 'step':
+            filters['step'] = value
+        else:
+            raise ValueError(f"Неизвестный фильтр: {key}")
+    return filters
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Выгрузка users / user_reminders в CSV (gzip)")
+    parser.add_argument('kind', choices=sorted(EXPORT_QUERIES))
+    parser.add_argument('--from', dest='date_from', type=date.fromisoformat, help='YYYY-MM-DD')
+    parser.add_argument('--to', dest='date_to', type=date.fromisoformat, help='YYYY-MM-DD')
+    parser.add_argument('--step', help='Фильтр по этапу регистрации')
+    parser.add_argument('-o', '--output', help='Файл результата (по умолчанию <kind>_<дата>.csv.gz)')
+    args = parser.parse_args()
+
+    output = args.output or f"{args.kind}_{datetime.now().strftime('%Y%m%d_%H%M')}.csv.gz"
+
+    await db.connect()
+    try:
+        size = await export_to_file(
+            args.kind, output,
+            date_from=args.date_from,
+            date_to=args.date_to,
+            step=args.step
+        )
+        print(f"✅ Выгружено в {output} ({size} байт)")
+    finally:
+        await db.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    asyncio.run(main())
@@ -3,6 +3,7 @@
 """
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from typing import Optional
 
 def get_main_menu() -> ReplyKeyboardMarkup:
     """Главное меню"""
@@ -44,3 +45,14 @@ def get_main_menu_inline() -> InlineKeyboardMarkup:
 def remove_keyboard() -> ReplyKeyboardRemove:
     """Убрать клавиатуру"""
     return ReplyKeyboardRemove()
+
+def get_pagination_keyboard(prefix: str, prev_cursor: Optional[str], next_cursor: Optional[str]) -> Optional[InlineKeyboardMarkup]:
+    """Кнопки навигации по страницам админского списка"""
+    buttons = []
+    if prev_cursor:
+        buttons.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"{prefix}:p:{prev_cursor}"))
+    if next_cursor:
+        buttons.append(InlineKeyboardButton(text="Вперёд ➡️", callback_data=f"{prefix}:n:{next_cursor}"))
+    if not buttons:
+        return None
+    return InlineKeyboardMarkup(inline_keyboard=[buttons])
@@ -0,0 +1,229 @@
+"""
+Координация фоновых задач между репликами бота через advisory-локи Postgres
+
+Два режима:
+- leader(name, factory) — задача работает только в одной реплике; остальные
+  ждут и забирают лок, как только держатель пропал;
+- partitioned(name, count) — пользователи делятся на count партиций
+  (user_id % count), реплики делят партиции поровну между собой.
+
+Все локи сессионные и держатся на одном выделенном соединении: при падении
+процесса Postgres снимает их сразу, при пропаже хоста — по TCP keepalive.
+"""
+import asyncio
+import hashlib
+import logging
+import math
+from datetime import datetime
+from typing import Optional, Dict, Any, Callable, Awaitable, Set, List
+
+import asyncpg
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Первый ключ двухключевого advisory-лока для лидерских задач
+LEADER_NAMESPACE = 0x4C454144  # 'LEAD'
+
+
+def lease_key(name: str) -> int:
+    """Стабильный неотрицательный 31-битный ключ по имени"""
+    digest = hashlib.blake2b(name.encode(), digest_size=4).digest()
+    return int.from_bytes(digest, 'big') & 0x7FFFFFFF
+
+
+class PartitionLease:
+    """Набор партиций, которыми сейчас владеет эта реплика"""
+
+    def __init__(self, name: str, count: int, on_change: Optional[Callable[[], None]] = None):
+        self.name = name
+        self.count = count
+        self.on_change = on_change
+        self.owned: Set[int] = set()
+        self.members = 0
+        self.partition_key = lease_key(f"{name}:partitions")
+        self.member_key = lease_key(f"{name}:members")
+
+    def owns(self, user_id: int) -> bool:
+        return user_id % self.count in self.owned
+
+    def _changed(self):
+        if self.on_change:
+            try:
+                self.on_change()
+            except Exception as e:
+                logger.error(f"Partition change callback failed for {self.name}: {e}")
+
+
+class _LeaderJob:
+    def __init__(self, name: str, factory: Callable[[], Awaitable[Any]]):
+        self.name = name
+        self.key = lease_key(name)
+        self.factory = factory
+        self.task: Optional[asyncio.Task] = None
+        self.held_since: Optional[datetime] = None
+        self.restarts = 0
+
+
+class LeaseManager:
+    def __init__(self):
+        self._jobs: Dict[str, _LeaderJob] = {}
+        self._partitions: Dict[str, PartitionLease] = {}
+        self._conn: Optional[asyncpg.Connection] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def leader(self, name: str, factory: Callable[[], Awaitable[Any]]):
+        """Запускать factory() только в реплике, которая держит лок name"""
+        self._jobs[name] = _LeaderJob(name, factory)
+
+    def partitioned(self, name: str, count: int,
+                    on_change: Optional[Callable[[], None]] = None) -> PartitionLease:
+        """Делить count партиций между живыми репликами"""
+        lease = PartitionLease(name, count, on_change)
+        self._partitions[name] = lease
+        return lease
+
+    def start(self):
+        if not self._task:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        self._release_all()
+        if self._conn:
+            try:
+                await self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
+
+    async def _connect(self) -> asyncpg.Connection:
+        # Keepalive на стороне сервера: сессия пропавшего хоста закроется за ~25 с
+        conn = await asyncpg.connect(
+            config.DATABASE_URL,
+            server_settings={
+                'application_name': 'bot-leases',
+                'tcp_keepalives_idle': '10',
+                'tcp_keepalives_interval': '5',
+                'tcp_keepalives_count': '3',
+            }
+        )
+        for lease in self._partitions.values():
+            await conn.execute(
+                "SELECT pg_advisory_lock($1, pg_backend_pid())", lease.member_key
+            )
+        return conn
+
+    async def _run(self):
+        logger.info(f"🔒 Starting lease manager ({', '.join(list(self._jobs) + list(self._partitions))})")
+        while True:
+            try:
+                if self._conn is None or self._conn.is_closed():
+                    self._release_all()
+                    self._conn = await self._connect()
+                await self._tick()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Соединение потеряно — локи сняты сервером, останавливаем свои задачи
+                logger.error(f"Lease manager error, releasing leases: {e}")
+                self._release_all()
+                if self._conn:
+                    try:
+                        self._conn.terminate()
+                    except Exception:
+                        pass
+                    self._conn = None
+            await asyncio.sleep(config.LEASE_CHECK_INTERVAL)
+
+    async def _tick(self):
+        conn = self._conn
+        # Проверка соединения (и заодно keepalive)
+        await asyncio.wait_for(conn.fetchval("SELECT 1"), timeout=config.LEASE_CHECK_INTERVAL)
+
+        for job in self._jobs.values():
+            if job.task is None:
+                if await conn.fetchval("SELECT pg_try_advisory_lock($1, $2)", LEADER_NAMESPACE, job.key):
+                    job.held_since = datetime.now()
+                    job.task = asyncio.create_task(job.factory())
+                    logger.info(f"🔒 Acquired lease {job.name}, starting job")
+            elif job.task.done():
+                # Задача упала, лок всё ещё наш — перезапускаем
+                if not job.task.cancelled() and job.task.exception():
+                    logger.error(f"Leader job {job.name} crashed: {job.task.exception()}")
+                job.restarts += 1
+                job.task = asyncio.create_task(job.factory())
+
+        for lease in self._partitions.values():
+            await self._rebalance(conn, lease)
+
+    async def _rebalance(self, conn: asyncpg.Connection, lease: PartitionLease):
+        """Держим ceil(count / участников) партиций: лишние отдаём, свободные берём"""
+        lease.members = await conn.fetchval("""
+            SELECT COUNT(*) FROM pg_locks
+            WHERE locktype = 'advisory' AND granted
+              AND classid::bigint = $1 AND objsubid = 2
+        """, lease.member_key) or 1
+        share = math.ceil(lease.count / lease.members)
+        changed = False
+
+        while len(lease.owned) > share:
+            partition = max(lease.owned)
+            await conn.execute("SELECT pg_advisory_unlock($1, $2)", lease.partition_key, partition)
+            lease.owned.discard(partition)
+            changed = True
+
+        for partition in range(lease.count):
+            if len(lease.owned) >= share:
+                break
+            if partition in lease.owned:
+                continue
+            if await conn.fetchval("SELECT pg_try_advisory_lock($1, $2)", lease.partition_key, partition):
+                lease.owned.add(partition)
+                changed = True
+
+        if changed:
+            logger.info(
+                f"Partitions of {lease.name}: {sorted(lease.owned)} "
+                f"({lease.members} replicas)"
+            )
+            lease._changed()
+
+    def _release_all(self):
+        """Остановить лидерские задачи и забыть партиции (локи уже не наши)"""
+        for job in self._jobs.values():
+            if job.task:
+                job.task.cancel()
+                logger.warning(f"🔓 Lease {job.name} released, job stopped")
+            job.task = None
+            job.held_since = None
+        for lease in self._partitions.values():
+            if lease.owned:
+                lease.owned.clear()
+                lease._changed()
+
+    def get_status(self) -> List[Dict[str, Any]]:
+        """Что держит эта реплика"""
+        status = []
+        for job in self._jobs.values():
+            status.append({
+                'name': job.name,
+                'leader': job.task is not None,
+                'since': job.held_since,
+                'restarts': job.restarts,
+            })
+        for lease in self._partitions.values():
+            status.append({
+                'name': lease.name,
+                'partitions': sorted(lease.owned),
+                'count': lease.count,
+                'members': lease.members,
+            })
+        return status
+
+
+# Глобальный экземпляр
+leases = LeaseManager()
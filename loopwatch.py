@@ -0,0 +1,206 @@
+"""
+Сторож event loop: задержка цикла и блокирующие вызовы
+
+Корутина-пульс спит LOOP_LAG_INTERVAL секунд и меряет, насколько позже
+проснулась, — это и есть задержка цикла (lag). Отдельный поток следит за
+пульсом: если цикл не отвечает дольше LOOP_LAG_THRESHOLD, он снимает стек
+потока с циклом (sys._current_frames) и запоминает, где тот застрял, —
+ближайшую функцию нашего кода и вызов, внутри которого он висит (например,
+gspread → ssl.read). Когда цикл оживает, задержка приписывается этому месту.
+"""
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+from collections import deque
+from typing import Optional, Dict, Any, List, Tuple
+
+import config
+from monitoring import metrics
+
+logger = logging.getLogger(__name__)
+
+LOOP_LAG_SECONDS = metrics.histogram(
+    'bot_event_loop_lag_seconds', 'Event loop wake-up delay',
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+)
+LOOP_STALLS = metrics.counter(
+    'bot_event_loop_stalls_total', 'Event loop stalls over the threshold by blocking site', ('site',)
+)
+
+# Код проекта — всё, что лежит рядом с этим файлом (кроме виртуального окружения)
+_PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+_SKIP_PARTS = (os.sep + 'site-packages' + os.sep, os.sep + 'dist-packages' + os.sep)
+
+
+def _is_project_file(filename: str) -> bool:
+    return filename.startswith(_PROJECT_DIR) and not any(part in filename for part in _SKIP_PARTS)
+
+
+def _frame_label(frame) -> str:
+    module = frame.f_globals.get('__name__', '?')
+    return f"{module}.{frame.f_code.co_name}:{frame.f_lineno}"
+
+
+def describe_stack(frame) -> Tuple[str, str, List[str]]:
+    """
+    (место в нашем коде, вызов, на котором висим, короткий стек) для кадра
+    потока с циклом. Место — ближайший к вершине кадр из файлов проекта.
+    """
+    stack = []
+    while frame is not None:
+        stack.append(frame)
+        frame = frame.f_back
+    if not stack:
+        return 'unknown', 'unknown', []
+
+    blocking = _frame_label(stack[0])
+    site = next(
+        (_frame_label(f) for f in stack
+         if _is_project_file(f.f_code.co_filename) and f.f_code.co_filename != __file__),
+        blocking
+    )
+    return site, blocking, [_frame_label(f) for f in stack[:12]]
+
+
+class _Offender:
+    __slots__ = ('site', 'blocking', 'stack', 'count', 'total', 'worst')
+
+    def __init__(self, site: str):
+        self.site = site
+        self.blocking = ''
+        self.stack: List[str] = []
+        self.count = 0
+        self.total = 0.0
+        self.worst = 0.0
+
+
+class LoopWatchdog:
+    def __init__(self, window: int = 3000):
+        self.lags = deque(maxlen=window)
+        self.max_lag = 0.0
+        self.stalls = 0
+        self.offenders: Dict[str, _Offender] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._beat = 0.0
+        # Что поток увидел во время текущей остановки: (место, вызов, стек)
+        self._captured: Optional[Tuple[str, str, List[str]]] = None
+        self._task: Optional[asyncio.Task] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def start(self):
+        """Запуск пульса в текущем цикле и потока-наблюдателя"""
+        if self._task or config.LOOP_LAG_INTERVAL <= 0:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.create_task(self._pulse())
+        self._thread = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+        self._thread.start()
+        logger.info(
+            f"🐶 Event loop watchdog started (tick {config.LOOP_LAG_INTERVAL * 1000:.0f} ms, "
+            f"threshold {config.LOOP_LAG_THRESHOLD * 1000:.0f} ms)"
+        )
+
+    async def close(self):
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        if self._thread:
+            await asyncio.to_thread(self._thread.join, 1.0)
+            self._thread = None
+
+    async def _pulse(self):
+        interval = config.LOOP_LAG_INTERVAL
+        while True:
+            expected = time.monotonic() + interval
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            self._beat = now
+            lag = max(0.0, now - expected)
+            self.lags.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+            LOOP_LAG_SECONDS.observe(lag)
+            if lag >= config.LOOP_LAG_THRESHOLD:
+                self._record_stall(lag)
+            else:
+                self._captured = None
+
+    def _watch(self):
+        """Поток: снимок стека, пока цикл стоит (одна попытка на остановку)"""
+        period = min(config.LOOP_LAG_INTERVAL, config.LOOP_LAG_THRESHOLD) / 2
+        captured_beat = None
+        while not self._stop.wait(period):
+            beat = self._beat
+            if beat == captured_beat:
+                continue
+            if time.monotonic() - beat < config.LOOP_LAG_INTERVAL + config.LOOP_LAG_THRESHOLD:
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            try:
+                self._captured = describe_stack(frame)
+            finally:
+                del frame
+            captured_beat = beat
+
+    def _record_stall(self, lag: float):
+        captured, self._captured = self._captured, None
+        site, blocking, stack = captured or ('unknown', 'unknown', [])
+        self.stalls += 1
+        LOOP_STALLS.inc(site)
+
+        offender = self.offenders.get(site)
+        if offender is None:
+            if len(self.offenders) >= config.LOOP_LAG_MAX_SITES:
+                # Вытесняем место с наименьшим суммарным простоем
+                weakest = min(self.offenders.values(), key=lambda o: o.total)
+                del self.offenders[weakest.site]
+            offender = self.offenders[site] = _Offender(site)
+        offender.count += 1
+        offender.total += lag
+        if lag >= offender.worst:
+            offender.worst = lag
+            offender.blocking = blocking
+            offender.stack = stack
+
+        logger.warning(f"Event loop blocked for {lag * 1000:.0f} ms at {site} (in {blocking})")
+
+    def get_stats(self, top: int = 5) -> Dict[str, Any]:
+        """Перцентили задержки за окно и худшие места по суммарному простою"""
+        lags = sorted(self.lags)
+
+        def pct(p: float) -> float:
+            return lags[min(len(lags) - 1, int(len(lags) * p))] * 1000 if lags else 0.0
+
+        offenders = sorted(self.offenders.values(), key=lambda o: o.total, reverse=True)[:top]
+        return {
+            'lag_p50_ms': pct(0.5),
+            'lag_p95_ms': pct(0.95),
+            'lag_p99_ms': pct(0.99),
+            'lag_max_ms': self.max_lag * 1000,
+            'stalls': self.stalls,
+            'offenders': [
+                {
+                    'site': o.site,
+                    'blocking': o.blocking,
+                    'count': o.count,
+                    'total_ms': o.total * 1000,
+                    'worst_ms': o.worst * 1000,
+                    'stack': list(o.stack),
+                }
+                for o in offenders
+            ],
+        }
+
+
+# Глобальный экземпляр
+watchdog = LoopWatchdog()
@@ -0,0 +1,22 @@
+-- Базовая схема: пользователи и отправленные напоминания
+CREATE TABLE IF NOT EXISTS users (
+    user_id BIGINT PRIMARY KEY,
+    telegram_username TEXT,
+    email TEXT,
+    inn TEXT,
+    promo_code TEXT,
+    step TEXT DEFAULT 'start',
+    created_at TIMESTAMP DEFAULT NOW(),
+    completed_at TIMESTAMP,
+    UNIQUE(inn)
+);
+
+CREATE INDEX IF NOT EXISTS idx_users_email ON users(email);
+CREATE INDEX IF NOT EXISTS idx_users_inn ON users(inn);
+
+CREATE TABLE IF NOT EXISTS user_reminders (
+    user_id BIGINT,
+    reminder_type TEXT,
+    sent_at TIMESTAMP DEFAULT NOW(),
+    PRIMARY KEY (user_id, reminder_type)
+);
@@ -0,0 +1,4 @@
+-- Индекс для keyset-пагинации админских списков незавершённых регистраций
+CREATE INDEX IF NOT EXISTS idx_users_incomplete_created
+    ON users (created_at DESC, user_id DESC)
+    WHERE completed_at IS NULL;
@@ -0,0 +1,27 @@
+-- Журнал переходов по воронке и агрегаты по часам/дням
+CREATE TABLE IF NOT EXISTS user_events (
+    id BIGSERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL,
+    event TEXT NOT NULL,
+    step TEXT,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_user_events_user ON user_events (user_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_user_events_created ON user_events (created_at);
+
+CREATE TABLE IF NOT EXISTS funnel_rollups (
+    granularity TEXT NOT NULL,
+    bucket_start TIMESTAMP NOT NULL,
+    event TEXT NOT NULL,
+    events INTEGER NOT NULL DEFAULT 0,
+    -- Сумма секунд от предыдущего события пользователя (время на шаг = seconds_total / events)
+    seconds_total DOUBLE PRECISION NOT NULL DEFAULT 0,
+    PRIMARY KEY (granularity, bucket_start, event)
+);
+
+CREATE TABLE IF NOT EXISTS rollup_state (
+    name TEXT PRIMARY KEY,
+    last_event_id BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT NOW()
+);
@@ -0,0 +1,27 @@
+-- Инвентарь промокодов в БД (источник — лист Promos) и очередь записей в Google Sheets
+CREATE TABLE IF NOT EXISTS promo_codes (
+    code TEXT PRIMARY KEY,
+    user_id BIGINT UNIQUE,
+    claimed_at TIMESTAMP,
+    imported_at TIMESTAMP DEFAULT NOW()
+);
+
+-- Свободные коды выбираются через этот индекс
+CREATE INDEX IF NOT EXISTS idx_promo_codes_free ON promo_codes (code) WHERE user_id IS NULL;
+
+-- Уже выданные ботом коды переносим в инвентарь как занятые
+INSERT INTO promo_codes (code, user_id, claimed_at)
+SELECT promo_code, user_id, completed_at FROM users WHERE promo_code IS NOT NULL
+ON CONFLICT DO NOTHING;
+
+CREATE TABLE IF NOT EXISTS sheets_outbox (
+    id BIGSERIAL PRIMARY KEY,
+    kind TEXT NOT NULL,
+    payload JSONB NOT NULL,
+    created_at TIMESTAMP DEFAULT NOW(),
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    processed_at TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_sheets_outbox_pending ON sheets_outbox (id) WHERE processed_at IS NULL;
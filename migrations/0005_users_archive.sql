@@ -0,0 +1,25 @@
+-- Холодное хранилище завершённых регистраций и объединённое представление
+CREATE TABLE IF NOT EXISTS users_archive (
+    user_id BIGINT PRIMARY KEY,
+    telegram_username TEXT,
+    email TEXT,
+    inn TEXT UNIQUE,
+    promo_code TEXT,
+    step TEXT,
+    created_at TIMESTAMP,
+    completed_at TIMESTAMP,
+    archived_at TIMESTAMP DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_users_archive_email ON users_archive(email);
+
+-- Индекс для выбора кандидатов на архивацию
+CREATE INDEX IF NOT EXISTS idx_users_completed_at ON users (completed_at) WHERE completed_at IS NOT NULL;
+
+-- Все пользователи: активные и архивные (для выгрузок, поиска и статистики)
+CREATE OR REPLACE VIEW users_all AS
+    SELECT user_id, telegram_username, email, inn, promo_code, step, created_at, completed_at, FALSE AS archived
+    FROM users
+    UNION ALL
+    SELECT user_id, telegram_username, email, inn, promo_code, step, created_at, completed_at, TRUE AS archived
+    FROM users_archive;
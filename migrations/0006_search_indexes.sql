@@ -0,0 +1,17 @@
+-- no-transaction
+-- Регистронезависимый поиск по email/username и нечёткий поиск (pg_trgm)
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_email_lower ON users (lower(email));
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_username_lower ON users (lower(telegram_username));
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_email_trgm ON users USING gin (lower(email) gin_trgm_ops);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_username_trgm ON users USING gin (lower(telegram_username) gin_trgm_ops);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_inn_prefix ON users (inn text_pattern_ops);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_promo_prefix ON users (upper(promo_code) text_pattern_ops);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_archive_email_lower ON users_archive (lower(email));
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_archive_username_lower ON users_archive (lower(telegram_username));
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_archive_email_trgm ON users_archive USING gin (lower(email) gin_trgm_ops);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_archive_username_trgm ON users_archive USING gin (lower(telegram_username) gin_trgm_ops);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_archive_inn_prefix ON users_archive (inn text_pattern_ops);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_archive_promo_prefix ON users_archive (upper(promo_code) text_pattern_ops);
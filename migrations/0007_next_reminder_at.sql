@@ -0,0 +1,6 @@
+-- Время следующего напоминания: планировщик спит до ближайшего значения
+ALTER TABLE users ADD COLUMN IF NOT EXISTS next_reminder_at TIMESTAMP;
+
+CREATE INDEX IF NOT EXISTS idx_users_next_reminder
+    ON users (next_reminder_at)
+    WHERE next_reminder_at IS NOT NULL;
@@ -0,0 +1,23 @@
+-- backfill
+-- Заполняем next_reminder_at для существующих пользователей батчами по $1.
+-- Незавершённые на этапах с напоминаниями: через час после старта (или сразу, если час прошёл);
+-- завершённые без напоминания о промокоде: через 7 дней после завершения (или сразу).
+-- Интервалы соответствуют значениям REMINDER_INTERVALS по умолчанию на момент миграции.
+WITH candidates AS (
+    SELECT u.user_id,
+           CASE
+               WHEN u.completed_at IS NULL AND u.step IN ('email', 'inn', 'confirmation')
+                   THEN GREATEST(u.created_at + INTERVAL '60 minutes', NOW())
+               WHEN u.completed_at IS NOT NULL AND u.promo_code IS NOT NULL AND NOT EXISTS (
+                   SELECT 1 FROM user_reminders r
+                   WHERE r.user_id = u.user_id AND r.reminder_type = 'promo_reminder'
+               )
+                   THEN GREATEST(u.completed_at + INTERVAL '7 days', NOW())
+           END AS due
+    FROM users u
+    WHERE u.next_reminder_at IS NULL
+)
+UPDATE users u
+SET next_reminder_at = c.due
+FROM (SELECT user_id, due FROM candidates WHERE due IS NOT NULL LIMIT $1) c
+WHERE u.user_id = c.user_id
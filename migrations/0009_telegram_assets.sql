@@ -0,0 +1,7 @@
+-- Кэш file_id загруженных в Telegram изображений из images/
+CREATE TABLE IF NOT EXISTS telegram_assets (
+    name TEXT PRIMARY KEY,
+    sha256 TEXT NOT NULL,
+    file_id TEXT NOT NULL,
+    updated_at TIMESTAMP DEFAULT NOW()
+);
@@ -0,0 +1,20 @@
+-- Очередь исходящих сообщений: напоминания, уведомления и алерты админам
+CREATE TABLE IF NOT EXISTS message_outbox (
+    id BIGSERIAL PRIMARY KEY,
+    dedup_key TEXT NOT NULL UNIQUE,
+    chat_id BIGINT NOT NULL,
+    lane TEXT NOT NULL DEFAULT 'bulk',
+    priority SMALLINT NOT NULL DEFAULT 2,
+    payload JSONB NOT NULL,
+    created_at TIMESTAMP DEFAULT NOW(),
+    available_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    attempts INT NOT NULL DEFAULT 0,
+    last_error TEXT,
+    sent_at TIMESTAMP,
+    failed_at TIMESTAMP
+);
+
+-- Выбор следующей пачки для отправки
+CREATE INDEX IF NOT EXISTS idx_message_outbox_pending
+    ON message_outbox (priority, available_at)
+    WHERE sent_at IS NULL AND failed_at IS NULL;
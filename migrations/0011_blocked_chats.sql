@@ -0,0 +1,6 @@
+-- Чаты, куда бот не может писать (пользователь заблокировал бота, чат не найден)
+CREATE TABLE IF NOT EXISTS blocked_chats (
+    chat_id BIGINT PRIMARY KEY,
+    reason TEXT,
+    blocked_at TIMESTAMP DEFAULT NOW()
+);
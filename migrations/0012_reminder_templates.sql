@@ -0,0 +1,31 @@
+-- Шаблоны напоминаний, переопределяющие встроенные (templates.py)
+-- step = '*' — шаблон для любого этапа; несколько вариантов — A/B-тест с весами
+CREATE TABLE IF NOT EXISTS reminder_templates (
+    reminder_type TEXT NOT NULL,
+    step TEXT NOT NULL DEFAULT '*',
+    variant TEXT NOT NULL DEFAULT 'a',
+    weight INTEGER NOT NULL DEFAULT 1,
+    body TEXT NOT NULL,
+    active BOOLEAN NOT NULL DEFAULT TRUE,
+    updated_at TIMESTAMP DEFAULT NOW(),
+    PRIMARY KEY (reminder_type, step, variant)
+);
+
+-- Настройки кампании ($promo_deadline и др. в шаблонах и текстах бота)
+CREATE TABLE IF NOT EXISTS campaign_settings (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    updated_at TIMESTAMP DEFAULT NOW()
+);
+
+-- Какой вариант шаблона получил пользователь (для анализа конверсии)
+CREATE TABLE IF NOT EXISTS reminder_assignments (
+    user_id BIGINT NOT NULL,
+    reminder_type TEXT NOT NULL,
+    variant TEXT NOT NULL,
+    assigned_at TIMESTAMP DEFAULT NOW(),
+    PRIMARY KEY (user_id, reminder_type)
+);
+
+CREATE INDEX IF NOT EXISTS idx_reminder_assignments_variant
+    ON reminder_assignments(reminder_type, variant);
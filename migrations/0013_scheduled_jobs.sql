@@ -0,0 +1,12 @@
+-- Состояние периодических задач планировщика (scheduler.py): последний запуск и его итог
+CREATE TABLE IF NOT EXISTS scheduled_jobs (
+    name TEXT PRIMARY KEY,
+    last_run_at TIMESTAMP,
+    last_success_at TIMESTAMP,
+    last_status TEXT,
+    last_error TEXT,
+    last_duration_ms DOUBLE PRECISION,
+    runs BIGINT NOT NULL DEFAULT 0,
+    failures BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT NOW()
+);
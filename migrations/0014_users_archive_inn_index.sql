@@ -0,0 +1,6 @@
+-- Уникальность ИНН в архиве ломала перенос целого батча из-за одного дубля
+-- (а архиватор повторял его бесконечно). Уникальность проверяется при
+-- регистрации по users_all, в архиве достаточно обычного индекса для поиска.
+ALTER TABLE users_archive DROP CONSTRAINT IF EXISTS users_archive_inn_key;
+
+CREATE INDEX IF NOT EXISTS idx_users_archive_inn ON users_archive(inn);
@@ -0,0 +1,8 @@
+-- Очистка старых сообщений и статистика по неудачам без полного скана
+CREATE INDEX IF NOT EXISTS idx_message_outbox_sent_at
+    ON message_outbox (sent_at)
+    WHERE sent_at IS NOT NULL;
+
+CREATE INDEX IF NOT EXISTS idx_message_outbox_failed_at
+    ON message_outbox (failed_at)
+    WHERE failed_at IS NOT NULL;
@@ -0,0 +1,9 @@
+-- Очередь записей в Sheets: отложенный повтор после ошибки и пометка мёртвых записей,
+-- чтобы одна сбойная запись не блокировала очередь
+ALTER TABLE sheets_outbox ADD COLUMN IF NOT EXISTS available_at TIMESTAMP NOT NULL DEFAULT NOW();
+ALTER TABLE sheets_outbox ADD COLUMN IF NOT EXISTS failed_at TIMESTAMP;
+
+DROP INDEX IF EXISTS idx_sheets_outbox_pending;
+CREATE INDEX IF NOT EXISTS idx_sheets_outbox_pending
+    ON sheets_outbox (id)
+    WHERE processed_at IS NULL AND failed_at IS NULL;
@@ -0,0 +1,17 @@
+-- Реестр шаблонов ловит правки по MAX(updated_at): обычный UPDATE тоже должен его сдвигать
+CREATE OR REPLACE FUNCTION touch_updated_at() RETURNS trigger AS $$
+BEGIN
+    NEW.updated_at = NOW();
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS reminder_templates_touch ON reminder_templates;
+CREATE TRIGGER reminder_templates_touch
+    BEFORE UPDATE ON reminder_templates
+    FOR EACH ROW EXECUTE FUNCTION touch_updated_at();
+
+DROP TRIGGER IF EXISTS campaign_settings_touch ON campaign_settings;
+CREATE TRIGGER campaign_settings_touch
+    BEFORE UPDATE ON campaign_settings
+    FOR EACH ROW EXECUTE FUNCTION touch_updated_at();
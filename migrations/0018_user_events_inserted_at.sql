@@ -0,0 +1,4 @@
+-- Время записи строки на стороне БД: created_at — время события в приложении и
+-- у батчей, дописанных после сбоя, оно в прошлом. Водяной знак агрегатов
+-- воронки считается по inserted_at.
+ALTER TABLE user_events ADD COLUMN IF NOT EXISTS inserted_at TIMESTAMP NOT NULL DEFAULT NOW();
@@ -0,0 +1,27 @@
+-- backfill
+-- Дозаполняем next_reminder_at тем же правилом, что и 0008, но условия из веток
+-- CASE перенесены в WHERE: LIMIT применяется только к подходящим пользователям,
+-- и батч не пересматривает тех, кому напоминание не положено.
+-- Там, где 0008 уже отработала, подходящих строк нет и миграция завершается сразу.
+WITH candidates AS (
+    SELECT u.user_id,
+           CASE
+               WHEN u.completed_at IS NULL
+                   THEN GREATEST(u.created_at + INTERVAL '60 minutes', NOW())
+               ELSE GREATEST(u.completed_at + INTERVAL '7 days', NOW())
+           END AS due
+    FROM users u
+    WHERE u.next_reminder_at IS NULL
+      AND (
+          (u.completed_at IS NULL AND u.step IN ('email', 'inn', 'confirmation'))
+          OR (u.completed_at IS NOT NULL AND u.promo_code IS NOT NULL AND NOT EXISTS (
+              SELECT 1 FROM user_reminders r
+              WHERE r.user_id = u.user_id AND r.reminder_type = 'promo_reminder'
+          ))
+      )
+    LIMIT $1
+)
+UPDATE users u
+SET next_reminder_at = c.due
+FROM candidates c
+WHERE u.user_id = c.user_id
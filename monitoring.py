@@ -1,71 +1,375 @@
 """
 Система мониторинга и алертов
+
+Кроме отчётов в Telegram здесь живёт реестр метрик в формате Prometheus:
+модули регистрируют счётчики и гистограммы при импорте и обновляют их в
+горячем пути (словарь + инкремент под локом, без аллокаций на наблюдение),
+а HTTP-эндпоинт /metrics отдаёт их по запросу. Значения, которые дешевле
+снять в момент опроса (инвентарь промокодов, очереди), собираются
+коллекторами.
+
+Модуль не импортирует database/sheets/outbox на верхнем уровне — они сами
+регистрируют метрики здесь.
 """
 import asyncio
+import bisect
+import hashlib
 import logging
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from typing import Dict, Any
+from typing import Dict, Any, List, Tuple, Callable, Awaitable, Optional
+
+from aiogram import BaseMiddleware
+from aiohttp import web
+
 import config
-from database import db
-from sheets import sheets
 
 logger = logging.getLogger(__name__)
 
+# Бакеты по умолчанию, секунды
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values: Dict[Tuple, Any] = {}
+        # Наблюдения приходят и из потоков (Sheets через to_thread)
+        self._lock = threading.Lock()
+
+    def _header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+    def render(self) -> List[str]:
+        lines = self._header()
+        with self._lock:
+            items = list(self._values.items())
+        for labels, value in sorted(items):
+            lines.append(f"{self.name}{_format_labels(self.labels, labels)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value: float, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                # [счётчики по бакетам (+Inf последним), сумма, количество]
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        """Замер блока; работает и как декоратор синхронной функции"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def render(self) -> List[str]:
+        lines = self._header()
+        with self._lock:
+            items = [(labels, (list(s[0]), s[1], s[2])) for labels, s in self._values.items()]
+        for labels, (counts, total, count) in sorted(items):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(
+                    f"{self.name}_bucket{_format_labels(self.labels, labels, le)} {cumulative}"
+                )
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, labels)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        # Асинхронные функции, обновляющие gauge перед выдачей
+        self._collectors: List[Callable[[], Awaitable[None]]] = []
+
+    def _register(self, metric: _Metric) -> _Metric:
+        existing = self._metrics.get(metric.name)
+        if existing is not None:
+            # Повторный импорт модуля не должен плодить метрики
+            return existing
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labels: Tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labels))
+
+    def gauge(self, name: str, documentation: str, labels: Tuple[str, ...] = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labels))
+
+    def histogram(self, name: str, documentation: str, labels: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labels, buckets))
+
+    def collector(self, func: Callable[[], Awaitable[None]]):
+        """Зарегистрировать сбор значений в момент опроса (можно как декоратор)"""
+        self._collectors.append(func)
+        return func
+
+    async def render(self) -> str:
+        for collect in self._collectors:
+            try:
+                await asyncio.wait_for(collect(), timeout=config.METRICS_COLLECT_TIMEOUT)
+            except Exception as e:
+                logger.warning(f"Metrics collector {getattr(collect, '__name__', collect)} failed: {e}")
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# Глобальный реестр
+metrics = MetricsRegistry()
+
+# Метрики диспетчера (остальные модули регистрируют свои)
+UPDATES_TOTAL = metrics.counter(
+    'bot_updates_total', 'Updates handled per handler', ('handler', 'status')
+)
+HANDLER_SECONDS = metrics.histogram(
+    'bot_handler_seconds', 'Handler latency', ('handler',)
+)
+PROMO_INVENTORY = metrics.gauge(
+    'bot_promo_inventory', 'Free promo codes in the DB inventory'
+)
+HEALTH_PROBE_SECONDS = metrics.histogram(
+    'bot_health_probe_seconds', 'Health probe latency', ('probe',)
+)
+HEALTH_PROBE_UP = metrics.gauge(
+    'bot_health_probe_up', 'Result of the last health probe (1 - ok)', ('probe',)
+)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Inner middleware: число апдейтов и латентность по хендлерам"""
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get('handler')
+        name = getattr(getattr(handler_object, 'callback', None), '__name__', 'unknown')
+        started = time.perf_counter()
+        status = 'ok'
+        try:
+            return await handler(event, data)
+        except Exception:
+            status = 'error'
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, name)
+            UPDATES_TOTAL.inc(name, status)
+
+
+handler_metrics = HandlerMetricsMiddleware()
+
+# Уровни алертов: critical уходит админам сразу, info — только в отчёты
+IMMEDIATE_SEVERITIES = ('critical',)
+
+
+def alert(severity: str, key: str, text: str) -> Dict[str, str]:
+    """
+    Алерт check_metrics: уровень задаётся явно, key — стабильный id для
+    дедупликации (текст с текущими цифрами меняется от проверки к проверке)
+    """
+    return {'severity': severity, 'key': key, 'text': text}
+
+
+@metrics.collector
+async def _collect_promo_inventory():
+    from database import db
+    stats = await db.get_detailed_stats()
+    PROMO_INVENTORY.set(stats['available_promos'])
+
+
 class MonitoringSystem:
     def __init__(self):
         self.last_check = None
+        self.registry = metrics
+        self._runner: Optional[web.AppRunner] = None
+        # Последняя проверка здоровья и текущая, если идёт
+        self._health: Optional[Dict[str, Any]] = None
+        self._health_at = 0.0
+        self._health_task: Optional[asyncio.Task] = None
         self.alert_thresholds = {
             'low_promos': 5,  # Минимум промокодов
-            'high_error_rate': 10,  # Максимум ошибок в час
+            'high_error_rate': 10,  # Максимум ошибок в час (на подсистему)
+            'high_error_rate_5m': 5,  # Максимум ошибок за 5 минут (на подсистему)
             'low_conversion': 20,  # Минимум конверсии в %
         }
     
-    async def check_system_health(self) -> Dict[str, Any]:
-        """Проверка здоровья системы"""
-        health_status = {
-            'timestamp': datetime.now(),
-            'database': False,
-            'google_sheets': False,
-            'promo_codes': 0,
-            'errors': []
-        }
-        
+    async def start_metrics_server(self):
+        """HTTP-эндпоинт /metrics для Prometheus (METRICS_PORT=0 — выключен)"""
+        if self._runner or not config.METRICS_PORT:
+            return
+        app = web.Application()
+        app.router.add_get('/metrics', self._handle_metrics)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, config.METRICS_HOST, config.METRICS_PORT).start()
+        logger.info(f"📈 Metrics endpoint on http://{config.METRICS_HOST}:{config.METRICS_PORT}/metrics")
+    
+    async def close(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+    
+    async def _handle_metrics(self, request: web.Request) -> web.Response:
+        body = await self.registry.render()
+        return web.Response(text=body, content_type='text/plain', charset='utf-8',
+                            headers={'X-Content-Type-Options': 'nosniff'})
+    
+    async def _probe_database(self) -> Dict[str, Any]:
+        from database import db
+        async with db.acquire() as conn:
+            await conn.fetchval("SELECT 1")
+        return {}
+    
+    async def _probe_promo_inventory(self) -> Dict[str, Any]:
+        from database import db
+        async with db.acquire(readonly=True) as conn:
+            available = await conn.fetchval("SELECT COUNT(*) FROM promo_codes WHERE user_id IS NULL")
+        return {'promo_codes': available}
+    
+    async def _probe_google_sheets(self) -> Dict[str, Any]:
+        from sheets import sheets
+        # Только метаданные таблицы, без выгрузки листов
+        await asyncio.to_thread(sheets.ping)
+        return {}
+    
+    async def _run_probe(self, name: str, probe: Callable[[], Awaitable[Dict[str, Any]]]) -> Dict[str, Any]:
+        started = time.perf_counter()
+        result = {'ok': False, 'latency_ms': 0.0, 'error': None}
         try:
-            # Проверка базы данных
-            await db.get_stats()
-            health_status['database'] = True
+            result.update(await asyncio.wait_for(probe(), timeout=config.HEALTH_PROBE_TIMEOUT))
+            result['ok'] = True
+        except asyncio.TimeoutError:
+            result['error'] = f"timeout after {config.HEALTH_PROBE_TIMEOUT:g}s"
         except Exception as e:
-            health_status['errors'].append(f"Database error: {e}")
-            logger.error(f"Database health check failed: {e}")
+            result['error'] = str(e) or type(e).__name__
+        result['latency_ms'] = (time.perf_counter() - started) * 1000
+        HEALTH_PROBE_SECONDS.observe(result['latency_ms'] / 1000, name)
+        HEALTH_PROBE_UP.set(1 if result['ok'] else 0, name)
+        if not result['ok']:
+            logger.error(f"Health probe {name} failed: {result['error']}")
+        return result
+    
+    async def _run_health_checks(self) -> Dict[str, Any]:
+        probes = {
+            'database': self._probe_database,
+            'google_sheets': self._probe_google_sheets,
+            'promo_inventory': self._probe_promo_inventory,
+        }
+        results = await asyncio.gather(*(self._run_probe(name, probe) for name, probe in probes.items()))
+        checks = dict(zip(probes, results))
         
-        try:
-            # Проверка Google Sheets
-            promo_codes = sheets.get_available_promo_codes()
-            health_status['google_sheets'] = True
-            health_status['promo_codes'] = len(promo_codes)
-        except Exception as e:
-            health_status['errors'].append(f"Google Sheets error: {e}")
-            logger.error(f"Google Sheets health check failed: {e}")
+        names = {'database': 'Database', 'google_sheets': 'Google Sheets', 'promo_inventory': 'Promo inventory'}
+        return {
+            'timestamp': datetime.now(),
+            'database': checks['database']['ok'],
+            'google_sheets': checks['google_sheets']['ok'],
+            'promo_codes': checks['promo_inventory'].get('promo_codes', 0),
+            'checks': checks,
+            'errors': [
+                f"{names[name]} error: {check['error']}"
+                for name, check in checks.items() if not check['ok']
+            ],
+        }
+    
+    async def check_system_health(self, max_age: Optional[float] = None) -> Dict[str, Any]:
+        """
+        Проверка здоровья системы: пробы идут параллельно, каждая со своим
+        таймаутом. Результат моложе max_age (по умолчанию HEALTH_CACHE_TTL)
+        берётся из кэша, одновременные вызовы ждут одну и ту же проверку.
+        """
+        max_age = config.HEALTH_CACHE_TTL if max_age is None else max_age
+        if self._health and time.monotonic() - self._health_at < max_age:
+            return self._health
         
-        return health_status
+        if self._health_task is None or self._health_task.done():
+            self._health_task = asyncio.create_task(self._run_health_checks())
+        # shield: отмена одного вызывающего не обрывает проверку для остальных
+        health = await asyncio.shield(self._health_task)
+        if health is not self._health:
+            self._health, self._health_at = health, time.monotonic()
+            self.last_check = health['timestamp']
+        return health
     
     async def check_metrics(self) -> Dict[str, Any]:
         """Проверка ключевых метрик"""
+        from database import db
+        from errorrate import error_rates
         try:
+            # Свободные промокоды — из инвентаря в БД, лист Promos не выгружаем
             stats = await db.get_detailed_stats()
             
-            # Проверяем промокоды
-            available_promos = sheets.get_available_promo_codes()
-            stats['available_promos'] = len(available_promos)
-            
             # Проверяем пороги
             alerts = []
             
             if stats['available_promos'] < self.alert_thresholds['low_promos']:
-                alerts.append(f"⚠️ Мало промокодов: {stats['available_promos']}")
+                alerts.append(alert('critical', 'promos_low', f"⚠️ Мало промокодов: {stats['available_promos']}"))
             
             if stats['conversion_rate'] < self.alert_thresholds['low_conversion']:
-                alerts.append(f"⚠️ Низкая конверсия: {stats['conversion_rate']:.1f}%")
+                alerts.append(alert('info', 'conversion_low', f"⚠️ Низкая конверсия: {stats['conversion_rate']:.1f}%"))
+            
+            # Частота ошибок по подсистемам — только для отчётов, сами алерты уходят сразу из errorrate
+            alerts.extend(alert('info', 'error_rate', line) for line in error_rates.breaches())
             
             return {
                 'stats': stats,
@@ -77,12 +381,13 @@ class MonitoringSystem:
             logger.error(f"Metrics check failed: {e}")
             return {
                 'stats': {},
-                'alerts': [f"❌ Ошибка проверки метрик: {e}"],
+                'alerts': [alert('critical', 'metrics_check_failed', f"❌ Ошибка проверки метрик: {e}")],
                 'timestamp': datetime.now()
             }
     
     async def send_daily_report(self, bot) -> bool:
         """Отправка ежедневного отчета админам"""
+        from outbox import outbox, outbox_message
         try:
             metrics = await self.check_metrics()
             health = await self.check_system_health()
@@ -90,13 +395,13 @@ class MonitoringSystem:
             # Формируем отчет
             report = self._format_daily_report(metrics, health)
             
-            # Отправляем всем админам
-            for admin_id in config.ADMIN_USER_IDS:
-                try:
-                    await bot.send_message(admin_id, report, parse_mode="HTML")
-                    logger.info(f"Daily report sent to admin {admin_id}")
-                except Exception as e:
-                    logger.error(f"Failed to send report to admin {admin_id}: {e}")
+            # Ставим в очередь всем админам: не больше одного отчёта в день
+            day = datetime.now().strftime('%Y%m%d')
+            await outbox.enqueue([
+                outbox_message(f"daily_report:{admin_id}:{day}", admin_id, report, lane='admin')
+                for admin_id in config.ADMIN_USER_IDS
+            ])
+            logger.info("Daily report queued for admins")
             
             return True
             
@@ -131,46 +436,42 @@ class MonitoringSystem:
         # Алерты
         if alerts:
             report += f"⚠️ <b>Внимание:</b>\n"
-            for alert in alerts:
-                report += f"• {alert}\n"
+            for item in alerts:
+                report += f"• {item['text']}\n"
         else:
             report += f"✅ <b>Все системы работают нормально</b>\n"
         
         return report
     
-    async def start_monitoring(self, bot):
-        """Запуск мониторинга"""
-        logger.info("🔍 Starting monitoring system...")
+    def register_jobs(self, scheduler, bot):
+        """Проверка алертов по интервалу и ежедневный отчёт по расписанию"""
+        scheduler.every('monitoring', config.MONITORING_CHECK_INTERVAL, self.check_alerts,
+                        jitter=30, timeout=300)
+        scheduler.cron('daily_report', config.DAILY_REPORT_CRON,
+                       lambda: self._daily_report_job(bot), catchup='once', timeout=300)
+    
+    async def _daily_report_job(self, bot):
+        if not await self.send_daily_report(bot):
+            raise RuntimeError("daily report was not queued")
+    
+    async def check_alerts(self):
+        """Проверить метрики и сразу отправить критические алерты"""
+        from outbox import outbox, outbox_message
+        metrics = await self.check_metrics()
         
-        while True:
-            try:
-                # Проверяем каждые 30 минут
-                await asyncio.sleep(1800)  # 30 минут
-                
-                # Проверяем метрики
-                metrics = await self.check_metrics()
-                
-                # Если есть критические алерты, отправляем немедленно
-                critical_alerts = [alert for alert in metrics['alerts'] if '❌' in alert]
-                if critical_alerts:
-                    for admin_id in config.ADMIN_USER_IDS:
-                        try:
-                            await bot.send_message(
-                                admin_id, 
-                                f"🚨 <b>Критический алерт!</b>\n\n" + "\n".join(critical_alerts),
-                                parse_mode="HTML"
-                            )
-                        except Exception as e:
-                            logger.error(f"Failed to send critical alert to admin {admin_id}: {e}")
-                
-                # Отправляем ежедневный отчет в 9:00
-                now = datetime.now()
-                if now.hour == 9 and now.minute < 30:
-                    await self.send_daily_report(bot)
-                
-            except Exception as e:
-                logger.error(f"Monitoring error: {e}")
-                await asyncio.sleep(300)  # 5 минут при ошибке
+        # Критические отправляем немедленно
+        urgent = [item for item in metrics['alerts'] if item['severity'] in IMMEDIATE_SEVERITIES]
+        if urgent:
+            text = f"🚨 <b>Критический алерт!</b>\n\n" + "\n".join(item['text'] for item in urgent)
+            # Один и тот же набор алертов — не чаще раза в час; ключ строим по стабильным id,
+            # а не по тексту, в котором меняются текущие цифры
+            keys = ",".join(sorted({item['key'] for item in urgent}))
+            digest = hashlib.sha1(keys.encode()).hexdigest()[:12]
+            hour = datetime.now().strftime('%Y%m%d%H')
+            await outbox.enqueue([
+                outbox_message(f"alert:{admin_id}:{digest}:{hour}", admin_id, text, lane='admin')
+                for admin_id in config.ADMIN_USER_IDS
+            ])
 
 # Глобальный экземпляр
 monitoring = MonitoringSystem()
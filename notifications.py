@@ -0,0 +1,152 @@
+"""
+Уведомления админам: сводки по окнам и немедленная эскалация
+
+Обычные события (новый пользователь, завершённая регистрация) копятся в
+памяти и раз в ADMIN_DIGEST_WINDOW секунд уходят одной сводкой на админа:
+счётчики по типам и последние ADMIN_DIGEST_LAST записей каждого типа. Критичные события
+(закончились промокоды, обращения в поддержку) отправляются сразу.
+notify() не ждёт ни БД, ни Telegram — вызывается прямо из хендлеров.
+"""
+import asyncio
+import logging
+import uuid
+from collections import Counter, deque
+from datetime import datetime
+from typing import Optional, Dict, Set
+
+import config
+from outbound import outbound_lane
+from outbox import outbox, outbox_message
+
+logger = logging.getLogger(__name__)
+
+# Тип события -> заголовок в сводке
+DIGEST_KINDS = {
+    'new_user': '🆕 Новые пользователи',
+    'completed': '✅ Завершили регистрацию',
+    'no_promo': '❌ Не хватило промокода',
+}
+
+# Сводки разных реплик не должны схлопываться по dedup_key
+INSTANCE_ID = uuid.uuid4().hex[:8]
+
+# Сколько ждать постановки в очередь, прежде чем отправить срочное напрямую (секунды)
+DIRECT_FALLBACK_AFTER = 10
+
+
+class AdminNotifier:
+    def __init__(self):
+        self._counts: Counter = Counter()
+        self._entries: Dict[str, deque] = {}
+        self._window_start = datetime.now()
+        self._task: Optional[asyncio.Task] = None
+        self._pending: Set[asyncio.Task] = set()
+
+    def notify(self, kind: str, entry: str, critical: bool = False, dedup: Optional[str] = None):
+        """
+        Событие для админов (entry — строка HTML). critical — отправить сразу,
+        dedup — ключ, чтобы одинаковая эскалация не уходила повторно.
+        """
+        if critical or config.ADMIN_DIGEST_WINDOW <= 0:
+            title = DIGEST_KINDS.get(kind, kind)
+            self.escalate(f"{title}\n\n{entry}", dedup or f"{kind}:{uuid.uuid4().hex}")
+            return
+
+        self._counts[kind] += 1
+        entries = self._entries.setdefault(kind, deque(maxlen=config.ADMIN_DIGEST_LAST))
+        entries.append(entry)
+
+    def escalate(self, text: str, dedup: str):
+        """Немедленно поставить сообщение всем админам, не задерживая вызывающего"""
+        task = asyncio.create_task(self._enqueue(text, f"escalate:{dedup}"))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    async def escalate_now(self, text: str, dedup: str, direct_fallback: bool = False):
+        """
+        Как escalate, но дожидается постановки в очередь и пробрасывает ошибку.
+        direct_fallback — если очередь недоступна (лежит БД), отправить админам
+        напрямую через шлюз, минуя message_outbox.
+        """
+        key = f"escalate:{dedup}"
+        if not direct_fallback:
+            await self._deliver(text, key)
+            return
+        try:
+            await asyncio.wait_for(self._deliver(text, key), timeout=DIRECT_FALLBACK_AFTER)
+            return
+        except Exception as e:
+            if outbox.bot is None:
+                raise
+            logger.warning(f"Outbox unavailable for {key}, sending directly: {e}")
+        with outbound_lane('admin'):
+            for admin_id in config.ADMIN_USER_IDS:
+                await outbox.bot.send_message(admin_id, text, parse_mode="HTML")
+
+    async def _deliver(self, text: str, key: str):
+        await outbox.enqueue([
+            outbox_message(f"{key}:{admin_id}", admin_id, text, lane='admin')
+            for admin_id in config.ADMIN_USER_IDS
+        ])
+
+    async def _enqueue(self, text: str, key: str):
+        try:
+            await self._deliver(text, key)
+        except Exception as e:
+            logger.error(f"Failed to queue admin notification {key}: {e}")
+
+    def start(self):
+        """Запуск отправки сводок"""
+        if not self._task and config.ADMIN_DIGEST_WINDOW > 0:
+            self._task = asyncio.create_task(self._digest_loop())
+
+    async def close(self):
+        """Остановить цикл и отправить накопленное"""
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+        if self._pending:
+            await asyncio.gather(*self._pending, return_exceptions=True)
+
+    async def _digest_loop(self):
+        logger.info(f"📬 Starting admin digests ({config.ADMIN_DIGEST_WINDOW:.0f}s window)...")
+        while True:
+            await asyncio.sleep(config.ADMIN_DIGEST_WINDOW)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Admin digest error: {e}")
+
+    async def flush(self):
+        """Отправить сводку за текущее окно, если в нём что-то было"""
+        window_start, window_end = self._window_start, datetime.now()
+        self._window_start = window_end
+        if not self._counts:
+            return
+
+        counts, entries = self._counts, self._entries
+        self._counts, self._entries = Counter(), {}
+
+        text = self.format_digest(counts, entries, window_start, window_end)
+        await self._enqueue(text, f"digest:{INSTANCE_ID}:{window_start.strftime('%Y%m%d%H%M%S')}")
+
+    @staticmethod
+    def format_digest(counts: Counter, entries: Dict[str, deque],
+                      window_start: datetime, window_end: datetime) -> str:
+        text = (
+            f"📬 <b>Сводка за {window_start.strftime('%H:%M')}–{window_end.strftime('%H:%M')}</b>\n"
+        )
+        for kind, count in counts.most_common():
+            text += f"\n<b>{DIGEST_KINDS.get(kind, kind)}: {count}</b>\n"
+            shown = entries.get(kind, ())
+            if count > len(shown):
+                text += f"<i>последние {len(shown)}, ещё {count - len(shown)} раньше:</i>\n"
+            for entry in shown:
+                text += f"• {entry}\n"
+        text += "\n📊 Статистика: /admin_stats"
+        return text
+
+
+# Глобальный экземпляр
+notifier = AdminNotifier()
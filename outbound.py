@@ -0,0 +1,296 @@
+"""
+Единый шлюз исходящих сообщений в Telegram
+
+Все запросы бота на отправку проходят через middleware сессии aiogram и
+встают в очередь с приоритетами: ответы пользователям обгоняют уведомления
+админам, а те — массовые рассылки (напоминания). Шлюз держит общий бюджет
+сообщений в секунду, паузу между сообщениями в один чат, соблюдает retry_after
+при 429 и ограничивает число одновременных запросов.
+
+Линия выбирается контекстом вызова:
+
+    with outbound_lane('bulk'):
+        await bot.send_message(user_id, text)
+"""
+import asyncio
+import itertools
+import logging
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional, Dict, Any, List
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods.base import TelegramMethod, TelegramType, Response
+
+import config
+from monitoring import metrics
+from blocked import blocked, ChatBlockedError, is_unreachable_error
+
+logger = logging.getLogger(__name__)
+
+# Линия -> приоритет (меньше — раньше)
+LANES = {
+    'user': 0,    # ответы в диалоге
+    'admin': 1,   # уведомления и алерты админам
+    'bulk': 2,    # напоминания и прочие рассылки
+}
+
+# Методы, которые расходуют лимиты Telegram на отправку
+SEND_METHODS = {
+    'sendMessage', 'sendPhoto', 'sendDocument', 'sendMediaGroup',
+    'copyMessage', 'forwardMessage', 'editMessageText', 'editMessageCaption',
+}
+
+# Как часто выбрасывать истёкшие паузы по чатам (секунды)
+CHAT_SLOTS_PRUNE_INTERVAL = 60
+
+OUTBOUND_SENDS = metrics.counter(
+    'bot_outbound_sends_total', 'Telegram send requests by lane and result', ('lane', 'method', 'status')
+)
+OUTBOUND_LATENCY = metrics.histogram(
+    'bot_outbound_latency_seconds', 'Time from enqueue to Telegram response', ('lane',)
+)
+OUTBOUND_QUEUE = metrics.gauge('bot_outbound_queue_depth', 'Pending outbound requests', ('lane',))
+
+_current_lane: ContextVar[str] = ContextVar('outbound_lane', default='user')
+
+
+@contextmanager
+def outbound_lane(lane: str):
+    """Отправки внутри блока идут по указанной линии"""
+    if lane not in LANES:
+        raise ValueError(f"Unknown outbound lane: {lane}")
+    token = _current_lane.set(lane)
+    try:
+        yield
+    finally:
+        _current_lane.reset(token)
+
+
+class _Job:
+    __slots__ = ('lane', 'chat_id', 'make_request', 'bot', 'method', 'future',
+                 'enqueued_at', 'not_before', 'attempts')
+
+    def __init__(self, lane, chat_id, make_request, bot, method, future):
+        self.lane = lane
+        self.chat_id = chat_id
+        self.make_request = make_request
+        self.bot = bot
+        self.method = method
+        self.future = future
+        self.enqueued_at = time.monotonic()
+        self.not_before: Optional[float] = None
+        self.attempts = 0
+
+
+class LaneStats:
+    """Счётчики и задержка постановка->отправка по линии (скользящее окно)"""
+
+    def __init__(self, window: int = 500):
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.pending = 0
+        self.latency_ms = deque(maxlen=window)
+
+    def snapshot(self) -> Dict[str, Any]:
+        latencies = sorted(self.latency_ms)
+        return {
+            'pending': self.pending,
+            'sent': self.sent,
+            'failed': self.failed,
+            'retried': self.retried,
+            'latency_p50_ms': latencies[len(latencies) // 2] if latencies else 0.0,
+            'latency_p95_ms': latencies[int(len(latencies) * 0.95)] if latencies else 0.0,
+            'latency_max_ms': latencies[-1] if latencies else 0.0,
+        }
+
+
+class OutboundGateway(BaseRequestMiddleware):
+    def __init__(self):
+        self.lanes = {lane: LaneStats() for lane in LANES}
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._seq = itertools.count()
+        self._workers: List[asyncio.Task] = []
+        # Глобальный token bucket
+        self._tokens = float(config.OUTBOUND_RATE)
+        self._refilled_at = time.monotonic()
+        self._bucket_lock = asyncio.Lock()
+        # Пауза после 429 (flood control у Telegram общий на бота)
+        self._paused_until = 0.0
+        # chat_id -> ближайшее время, когда в чат можно отправлять (истёкшие чистятся раз в минуту)
+        self._chat_slots: Dict[int, float] = {}
+        self._slots_pruned_at = time.monotonic()
+
+    def start(self, bot):
+        """Подключить шлюз к сессии бота и запустить воркеры"""
+        if self._workers:
+            return
+        self._queue = asyncio.PriorityQueue()
+        bot.session.middleware(self)
+        self._workers = [
+            asyncio.create_task(self._worker_loop())
+            for _ in range(config.OUTBOUND_CONCURRENCY)
+        ]
+        logger.info(
+            f"📤 Outbound gateway started ({config.OUTBOUND_RATE} msg/s, "
+            f"{config.OUTBOUND_CONCURRENCY} workers)"
+        )
+
+    async def close(self):
+        """Остановить воркеры; неотправленные запросы завершаются отменой"""
+        for task in self._workers:
+            task.cancel()
+        self._workers = []
+        if self._queue:
+            while not self._queue.empty():
+                _, _, job = self._queue.get_nowait()
+                if not job.future.done():
+                    job.future.cancel()
+        self._queue = None
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot,
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        if self._queue is None or method.__api_method__ not in SEND_METHODS:
+            return await make_request(bot, method)
+
+        lane = _current_lane.get()
+        chat_id = getattr(method, 'chat_id', None)
+        if lane != 'user' and blocked.is_blocked(chat_id):
+            # Ответы в диалоге пропускаем: пользователь, который пишет боту, его не блокирует
+            raise ChatBlockedError(chat_id)
+        job = _Job(
+            lane, chat_id, make_request, bot, method,
+            asyncio.get_running_loop().create_future()
+        )
+        self.lanes[lane].pending += 1
+        self._put(job)
+        return await job.future
+
+    def _put(self, job: _Job):
+        if self._queue is None:
+            # Шлюз закрыт, пока задание ждало своего слота (call_later)
+            if not job.future.done():
+                job.future.cancel()
+            return
+        self._queue.put_nowait((LANES[job.lane], next(self._seq), job))
+
+    async def _worker_loop(self):
+        while True:
+            _, _, job = await self._queue.get()
+            if job.future.done():
+                # Вызывающий уже отменил ожидание
+                self.lanes[job.lane].pending -= 1
+                continue
+
+            # Пауза между сообщениями в один чат: резервируем слот и откладываем,
+            # не занимая воркер ожиданием
+            if job.not_before is None and job.chat_id is not None:
+                now = time.monotonic()
+                self._prune_chat_slots(now)
+                slot = max(now, self._chat_slots.get(job.chat_id, 0.0))
+                self._chat_slots[job.chat_id] = slot + config.OUTBOUND_PER_CHAT_INTERVAL
+                job.not_before = slot
+                if slot > now:
+                    asyncio.get_running_loop().call_later(slot - now, self._put, job)
+                    continue
+
+            await self._take_token()
+            await self._execute(job)
+
+    async def _take_token(self):
+        """Глобальный бюджет сообщений в секунду с учётом паузы после 429"""
+        async with self._bucket_lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(
+                    float(config.OUTBOUND_RATE),
+                    self._tokens + (now - self._refilled_at) * config.OUTBOUND_RATE
+                )
+                self._refilled_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / config.OUTBOUND_RATE)
+
+    async def _execute(self, job: _Job):
+        stats = self.lanes[job.lane]
+        job.attempts += 1
+        try:
+            result = await job.make_request(job.bot, job.method)
+        except TelegramRetryAfter as e:
+            self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+            if job.attempts <= config.OUTBOUND_MAX_RETRIES:
+                logger.warning(
+                    f"Telegram flood control: retry after {e.retry_after}s "
+                    f"({job.lane} lane, chat {job.chat_id})"
+                )
+                stats.retried += 1
+                OUTBOUND_SENDS.inc(job.lane, job.method.__api_method__, 'retry')
+                self._put(job)
+                return
+            self._finish(job, exception=e)
+        except Exception as e:
+            if isinstance(job.chat_id, int) and is_unreachable_error(e):
+                await blocked.mark(job.chat_id, str(e))
+            self._finish(job, exception=e)
+        else:
+            if blocked.is_blocked(job.chat_id):
+                # Чат снова доступен (например, ответ пользователю, который разблокировал бота)
+                await blocked.unmark(job.chat_id)
+            self._finish(job, result=result)
+
+    def _finish(self, job: _Job, result=None, exception: Optional[BaseException] = None):
+        stats = self.lanes[job.lane]
+        stats.pending -= 1
+        elapsed = time.monotonic() - job.enqueued_at
+        if exception is None:
+            stats.sent += 1
+            stats.latency_ms.append(elapsed * 1000)
+        else:
+            stats.failed += 1
+        OUTBOUND_SENDS.inc(job.lane, job.method.__api_method__, 'error' if exception else 'ok')
+        OUTBOUND_LATENCY.observe(elapsed, job.lane)
+        if job.future.done():
+            return
+        if exception is None:
+            job.future.set_result(result)
+        else:
+            job.future.set_exception(exception)
+
+    def _prune_chat_slots(self, now: float):
+        """Не держим слоты чатов, чья пауза уже истекла (проход раз в CHAT_SLOTS_PRUNE_INTERVAL)"""
+        if now - self._slots_pruned_at < CHAT_SLOTS_PRUNE_INTERVAL:
+            return
+        self._slots_pruned_at = now
+        self._chat_slots = {
+            chat_id: slot for chat_id, slot in self._chat_slots.items() if slot > now
+        }
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Глубина очереди и задержка по линиям"""
+        return {
+            'queue_depth': self._queue.qsize() if self._queue else 0,
+            'paused_for': max(0.0, self._paused_until - time.monotonic()),
+            'lanes': {lane: stats.snapshot() for lane, stats in self.lanes.items()},
+        }
+
+
+# Глобальный экземпляр
+gateway = OutboundGateway()
+
+
+@metrics.collector
+async def _collect_outbound_queue():
+    for lane, stats in gateway.lanes.items():
+        OUTBOUND_QUEUE.set(stats.pending, lane)
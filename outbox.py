@@ -0,0 +1,247 @@
+"""
+Надёжная очередь исходящих сообщений (message_outbox)
+
+Напоминания, уведомления о завершённых регистрациях и алерты мониторинга
+сначала записываются в таблицу — в той же транзакции, что и изменения,
+из-за которых они появились. Воркеры забирают строки через
+FOR UPDATE SKIP LOCKED, отправляют через шлюз исходящих сообщений и
+отмечают доставку. Доставка at-least-once: забранная строка, которую воркер
+не успел отметить (падение процесса), снова станет доступна через
+OUTBOX_CLAIM_TIMEOUT. Повторная постановка с тем же dedup_key игнорируется.
+"""
+import asyncio
+import json
+import logging
+from typing import Optional, Dict, Any, List
+
+import asyncpg
+
+import config
+from database import db
+from events import events
+from outbound import LANES, outbound_lane
+from assets import assets
+from blocked import blocked, is_unreachable_error
+
+logger = logging.getLogger(__name__)
+
+
+def outbox_message(dedup_key: str, chat_id: int, text: str, lane: str = 'bulk',
+                   photo: Optional[str] = None, track: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Сообщение для enqueue: text в HTML, photo — имя файла из images/ (text станет подписью),
+    track — событие воронки, которое записывается при доставке.
+    """
+    return {
+        'dedup_key': dedup_key,
+        'chat_id': chat_id,
+        'lane': lane,
+        'payload': {'text': text, 'photo': photo, 'track': track},
+    }
+
+
+class MessageOutbox:
+    def __init__(self):
+        self.bot = None
+        self._workers: List[asyncio.Task] = []
+        self._wakeup = asyncio.Event()
+        self.delivered = 0
+        self.retried = 0
+        self.failed = 0
+
+    async def enqueue(self, messages: List[Dict[str, Any]], conn: Optional[asyncpg.Connection] = None):
+        """Поставить сообщения в очередь (можно внутри транзакции вызывающего через conn)"""
+        messages = [m for m in messages if not blocked.is_blocked(m['chat_id'])]
+        if not messages:
+            return
+        records = [
+            (m['dedup_key'], m['chat_id'], m['lane'], LANES[m['lane']], json.dumps(m['payload']))
+            for m in messages
+        ]
+        query = """
+            INSERT INTO message_outbox (dedup_key, chat_id, lane, priority, payload)
+            VALUES ($1, $2, $3, $4, $5::jsonb)
+            ON CONFLICT (dedup_key) DO NOTHING
+        """
+        if conn is not None:
+            await conn.executemany(query, records)
+        else:
+            async with db.acquire() as conn:
+                await conn.executemany(query, records)
+            self.wake()
+
+    def wake(self):
+        """Разбудить воркеры этого процесса (другие реплики подхватят по таймеру)"""
+        self._wakeup.set()
+
+    def start(self, bot):
+        """Запуск воркеров доставки"""
+        self.bot = bot
+        if not self._workers:
+            self._workers = [
+                asyncio.create_task(self._worker_loop())
+                for _ in range(config.OUTBOX_WORKERS)
+            ]
+            logger.info(f"📮 Message outbox started ({config.OUTBOX_WORKERS} workers)")
+
+    async def close(self):
+        for task in self._workers:
+            task.cancel()
+        self._workers = []
+
+    async def _worker_loop(self):
+        while True:
+            try:
+                rows = await self._claim()
+                if not rows:
+                    self._wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout=config.OUTBOX_POLL_INTERVAL)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                for row in rows:
+                    await self._process(row)
+
+            except Exception as e:
+                logger.error(f"Outbox worker error: {e}")
+                await asyncio.sleep(config.OUTBOX_POLL_INTERVAL)
+
+    async def _claim(self) -> List[Dict[str, Any]]:
+        """Забрать пачку: строка становится невидимой для других воркеров на OUTBOX_CLAIM_TIMEOUT"""
+        async with db.acquire() as conn:
+            rows = await conn.fetch("""
+                UPDATE message_outbox
+                SET available_at = NOW() + make_interval(secs => $2), attempts = attempts + 1
+                WHERE id IN (
+                    SELECT id FROM message_outbox
+                    WHERE sent_at IS NULL AND failed_at IS NULL AND available_at <= NOW()
+                    ORDER BY priority, available_at
+                    LIMIT $1
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id, chat_id, lane, payload, attempts
+            """, config.OUTBOX_BATCH_SIZE, config.OUTBOX_CLAIM_TIMEOUT)
+        return sorted(
+            (dict(row, payload=json.loads(row['payload'])) for row in rows),
+            key=lambda row: (LANES[row['lane']], row['id'])
+        )
+
+    async def _process(self, row: Dict[str, Any]):
+        if blocked.is_blocked(row['chat_id']):
+            await self._finish(row, failed=True, error="blocked_chats")
+            return
+        try:
+            await self._deliver(row)
+        except Exception as e:
+            error = str(e)
+            if is_unreachable_error(e):
+                # Повторять бессмысленно; шлюз уже внёс чат в реестр, без шлюза — вносим сами
+                logger.warning(f"Outbox message {row['id']} undeliverable to {row['chat_id']}: {error}")
+                await blocked.mark(row['chat_id'], error)
+                await self._finish(row, failed=True, error=error)
+            elif row['attempts'] >= config.OUTBOX_MAX_ATTEMPTS:
+                logger.error(f"Outbox message {row['id']} failed after {row['attempts']} attempts: {error}")
+                await self._finish(row, failed=True, error=error)
+            else:
+                logger.warning(f"Outbox message {row['id']} to {row['chat_id']} will be retried: {error}")
+                await self._retry(row, error)
+            return
+
+        await self._finish(row)
+        if row['payload'].get('track'):
+            events.track(row['chat_id'], row['payload']['track'])
+
+    async def _deliver(self, row: Dict[str, Any]):
+        payload = row['payload']
+        with outbound_lane(row['lane']):
+            if payload.get('photo'):
+                try:
+                    await assets.send_photo(
+                        self.bot, row['chat_id'], payload['photo'],
+                        caption=payload['text'], parse_mode="HTML"
+                    )
+                    return
+                except Exception as e:
+                    if is_unreachable_error(e):
+                        raise
+                    logger.error(f"Error sending outbox photo to {row['chat_id']}: {e}")
+                    # Fallback без изображения
+            await self.bot.send_message(row['chat_id'], payload['text'], parse_mode="HTML")
+
+    async def _finish(self, row: Dict[str, Any], failed: bool = False, error: Optional[str] = None):
+        async with db.acquire() as conn:
+            if failed:
+                await conn.execute(
+                    "UPDATE message_outbox SET failed_at = NOW(), last_error = $2 WHERE id = $1",
+                    row['id'], error[:500]
+                )
+            else:
+                await conn.execute(
+                    "UPDATE message_outbox SET sent_at = NOW(), last_error = NULL WHERE id = $1",
+                    row['id']
+                )
+        if failed:
+            self.failed += 1
+        else:
+            self.delivered += 1
+
+    async def _retry(self, row: Dict[str, Any], error: str):
+        """Экспоненциальная пауза перед следующей попыткой (не больше часа)"""
+        delay = min(config.OUTBOX_RETRY_BASE_SECONDS * 2 ** (row['attempts'] - 1), 3600)
+        async with db.acquire() as conn:
+            await conn.execute("""
+                UPDATE message_outbox
+                SET available_at = NOW() + make_interval(secs => $2), last_error = $3
+                WHERE id = $1
+            """, row['id'], delay, error[:500])
+        self.retried += 1
+
+    def register_jobs(self, scheduler):
+        """Очистка старых строк очереди (в одной реплике)"""
+        scheduler.every('outbox_cleanup', config.OUTBOX_CLEANUP_INTERVAL, self.cleanup,
+                        jitter=60, timeout=900)
+
+    async def cleanup(self) -> int:
+        """Удалить доставленные и неудачные сообщения старше OUTBOX_RETENTION_DAYS батчами"""
+        total = 0
+        while True:
+            async with db.acquire() as conn:
+                result = await conn.execute("""
+                    DELETE FROM message_outbox
+                    WHERE id IN (
+                        SELECT id FROM message_outbox
+                        WHERE sent_at < NOW() - make_interval(days => $1)
+                           OR failed_at < NOW() - make_interval(days => $1)
+                        LIMIT $2
+                    )
+                """, config.OUTBOX_RETENTION_DAYS, config.OUTBOX_CLEANUP_BATCH)
+            deleted = int(result.split()[-1])
+            total += deleted
+            if deleted < config.OUTBOX_CLEANUP_BATCH:
+                break
+            await asyncio.sleep(config.ARCHIVE_BATCH_PAUSE)
+
+        if total:
+            logger.info(f"🧹 Removed {total} old outbox messages")
+        return total
+
+    async def get_stats(self) -> Dict[str, Any]:
+        """Состояние очереди для админки (каждый счётчик идёт по своему индексу)"""
+        async with db.acquire(readonly=True) as conn:
+            row = await conn.fetchrow("""
+                SELECT
+                    COUNT(*) AS pending,
+                    COUNT(*) FILTER (WHERE available_at <= NOW()) AS ready,
+                    MIN(created_at) AS oldest,
+                    (SELECT COUNT(*) FROM message_outbox
+                     WHERE failed_at > NOW() - INTERVAL '24 hours') AS failed_24h
+                FROM message_outbox
+                WHERE sent_at IS NULL AND failed_at IS NULL
+            """)
+        return dict(row)
+
+
+# Глобальный экземпляр
+outbox = MessageOutbox()
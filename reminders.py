@@ -2,402 +2,275 @@
 Система автонапоминаний для пользователей
 """
 import asyncio
+import heapq
 import logging
 from datetime import datetime, timedelta
 import time
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Tuple, Optional
 import config
 from database import db
+from outbox import outbox, outbox_message
+from leases import leases, PartitionLease
+from templates import templates
+from monitoring import metrics
 
 logger = logging.getLogger(__name__)
 
+REMINDER_CYCLE_SECONDS = metrics.histogram(
+    'bot_reminder_cycle_seconds', 'Duration of one due-reminders pass',
+    buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+)
+REMINDERS_QUEUED = metrics.counter('bot_reminders_queued_total', 'Reminders queued for delivery', ('type',))
+
+# Пороги напоминаний о незавершённой регистрации (по возрастанию)
+INCOMPLETE_REMINDERS = ('incomplete_1h', 'incomplete_24h', 'incomplete_3d')
+
 class ReminderSystem:
     def __init__(self):
         self.bot = None
-        self.reminder_intervals = {
-            'incomplete_1h': 60,      # 1 час после начала
-            'incomplete_24h': 1440,   # 24 часа
-            'incomplete_3d': 4320,    # 3 дня
-            'promo_reminder': 10080,  # 7 дней после получения промокода
-        }
+        self.reminder_intervals = dict(config.REMINDER_INTERVALS)
+        # Мин-куча (due_at, user_id) с дедлайнами в пределах горизонта
+        self._heap: List[Tuple[datetime, int]] = []
+        self._horizon_end: Optional[datetime] = None
+        self._wakeup = asyncio.Event()
+        self._rehydrate = False
+        # При нескольких репликах — только свои партиции пользователей
+        self.partitions: Optional[PartitionLease] = None
+        if config.REMINDER_PARTITIONS > 0:
+            self.partitions = leases.partitioned(
+                'reminders', config.REMINDER_PARTITIONS, on_change=self._on_partitions_changed
+            )
+        # Новые дедлайны из create_user/update_user/complete_registration
+        db.reminder_hooks.append(self.schedule)
+    
+    def schedule(self, user_id: int, due_at: datetime):
+        """Добавить дедлайн; будит планировщик, если он раньше текущего ближайшего"""
+        if self._horizon_end is None or due_at > self._horizon_end:
+            # Дальние дедлайны подхватит следующая загрузка из БД
+            return
+        if self.partitions and not self.partitions.owns(user_id):
+            return
+        is_earliest = not self._heap or due_at < self._heap[0][0]
+        heapq.heappush(self._heap, (due_at, user_id))
+        if is_earliest:
+            self._wakeup.set()
+    
+    def _on_partitions_changed(self):
+        """Набор партиций изменился — перечитать дедлайны"""
+        self._rehydrate = True
+        self._wakeup.set()
+    
+    def _partition_filter(self) -> Tuple[Optional[int], List[int]]:
+        """Параметры фильтра user_id % count = ANY(owned); (None, []) — без партиций"""
+        if not self.partitions:
+            return None, []
+        return self.partitions.count, sorted(self.partitions.owned)
+    
+    def register_jobs(self, scheduler, bot):
+        """Цикл напоминаний под присмотром планировщика: лидер или партиции во всех репликах"""
+        scheduler.service('reminders', lambda: self.start_reminders(bot), leader=self.partitions is None)
     
     async def start_reminders(self, bot):
-        """Запуск системы напоминаний"""
+        """Запуск системы напоминаний: спим до ближайшего дедлайна, а не опрашиваем по таймеру"""
         self.bot = bot
         logger.info("🔔 Starting reminder system...")
         
+        next_hydrate = 0.0
         while True:
             try:
-                await self.check_incomplete_registrations()
-                await self.check_promo_reminders()
-                await asyncio.sleep(300)  # Проверяем каждые 5 минут
+                self._wakeup.clear()
+                if self._rehydrate or time.monotonic() >= next_hydrate:
+                    self._rehydrate = False
+                    await self.hydrate()
+                    next_hydrate = time.monotonic() + config.REMINDER_HYDRATE_INTERVAL
+                
+                now = datetime.now()
+                if self._heap and self._heap[0][0] <= now:
+                    await self.process_due()
+                    continue
+                
+                timeout = next_hydrate - time.monotonic()
+                if self._heap:
+                    timeout = min(timeout, (self._heap[0][0] - now).total_seconds())
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=max(timeout, 0))
+                except asyncio.TimeoutError:
+                    pass
                 
             except Exception as e:
                 logger.error(f"Reminder system error: {e}")
                 await asyncio.sleep(60)  # 1 минута при ошибке
     
-    async def check_incomplete_registrations(self):
-        """Проверка незавершенных регистраций"""
-        try:
-            # Получаем пользователей с незавершенной регистрацией
-            incomplete_users = await self.get_incomplete_users()
-            
-            for user in incomplete_users:
-                await self.send_reminder_if_needed(user)
-                
-        except Exception as e:
-            logger.error(f"Error checking incomplete registrations: {e}")
-    
-    async def get_incomplete_users(self) -> List[Dict[str, Any]]:
-        """Получаем пользователей с незавершенной регистрацией"""
-        try:
-            async with db.pool.acquire() as conn:
-                # Пользователи без completed_at
+    async def hydrate(self):
+        """
+        Загрузить ближайшие дедлайны из БД (индекс по next_reminder_at).
+
+        Держим в памяти только горизонт вперёд: периодическая перезагрузка заодно
+        подхватывает дедлайны, записанные другими процессами.
+        """
+        horizon_end = datetime.now() + timedelta(minutes=config.REMINDER_HORIZON_MINUTES)
+        limit = config.REMINDER_BATCH_SIZE * 20
+        partition_count, owned = self._partition_filter()
+        if partition_count and not owned:
+            # Ни одной партиции пока не досталось
+            rows = []
+        else:
+            async with db.acquire() as conn:
                 rows = await conn.fetch("""
-                    SELECT user_id, email, step, created_at, completed_at
-                    FROM users 
-                    WHERE completed_at IS NULL
-                    ORDER BY created_at DESC
-                """)
-                
-                return [dict(row) for row in rows]
-                
-        except Exception as e:
-            logger.error(f"Error getting incomplete users: {e}")
-            return []
-    
-    async def send_reminder_if_needed(self, user: Dict[str, Any]):
-        """Отправляем напоминание если нужно"""
-        try:
-            user_id = user['user_id']
-            created_at = user['created_at']
-            step = user['step']
-            
-            # Вычисляем время с момента создания
-            time_since_creation = datetime.now() - created_at
-            minutes_since = int(time_since_creation.total_seconds() / 60)
-            
-            # Определяем тип напоминания (отправляем самое подходящее)
-            reminder_type = None
-            if minutes_since >= self.reminder_intervals['incomplete_3d']:
-                reminder_type = 'incomplete_3d'
-            elif minutes_since >= self.reminder_intervals['incomplete_24h']:
-                reminder_type = 'incomplete_24h'
-            elif minutes_since >= self.reminder_intervals['incomplete_1h']:
-                reminder_type = 'incomplete_1h'
-            
-            if reminder_type:
-                await self.send_reminder(user_id, reminder_type, step)
-                
-        except Exception as e:
-            logger.error(f"Error sending reminder to user {user.get('user_id')}: {e}")
-    
-    async def send_reminder(self, user_id: int, reminder_type: str, step: str):
-        """Отправляем конкретное напоминание"""
-        try:
-            # Проверяем, не отправляли ли уже это напоминание
-            if await self.reminder_already_sent(user_id, reminder_type):
-                return
-            
-            message = self.get_reminder_message(reminder_type, step)
-            
-            if message:
-                # Для напоминания через 3 дня добавляем изображение
-                if reminder_type == 'incomplete_3d':
-                    try:
-                        await self.bot.send_photo(
-                            user_id,
-                            photo="https://raw.githubusercontent.com/vostoklov/youtravel-yandex-bot/main/images/reminder_card.jpg?v=" + str(int(time.time())),
-                            caption=message,
-                            parse_mode="HTML"
-                        )
-                        await self.mark_reminder_sent(user_id, reminder_type)
-                        logger.info(f"Reminder with image {reminder_type} sent to user {user_id}")
-                    except Exception as e:
-                        logger.error(f"Error sending reminder image to user {user_id}: {e}")
-                        # Fallback без изображения
-                        await self.bot.send_message(user_id, message, parse_mode="HTML")
-                        await self.mark_reminder_sent(user_id, reminder_type)
-                        logger.info(f"Reminder {reminder_type} sent to user {user_id}")
-                else:
-                    await self.bot.send_message(user_id, message, parse_mode="HTML")
-                    await self.mark_reminder_sent(user_id, reminder_type)
-                    logger.info(f"Reminder {reminder_type} sent to user {user_id}")
-                
-        except Exception as e:
-            if "chat not found" in str(e) or "bot was blocked" in str(e):
-                logger.warning(f"User {user_id} blocked the bot or chat not found - skipping reminder")
-                # Отмечаем напоминание как отправленное, чтобы не спамить
-                await self.mark_reminder_sent(user_id, reminder_type)
-            else:
-                logger.error(f"Error sending reminder to user {user_id}: {e}")
-    
-    def get_reminder_message(self, reminder_type: str, step: str) -> str:
-        """Получаем текст напоминания"""
-        messages = {
-            'incomplete_1h': {
-                'email': """
-⏰ <b>Напоминание</b>
-
-Вы начали регистрацию, но не завершили процесс.
-
-💡 После завершения получите промокод <b>−10%</b> (до 10 000 ₽) и доступ к корпоративным тарифам со скидками до 40%.
-
-Нажмите /start, чтобы продолжить регистрацию.
-                """,
-                'inn': """
-⏰ <b>Напоминание</b>
-
-Вы зарегистрировались в Яндекс.Путешествиях, но не ввели ИНН вашей компании.
-
-💡 После завершения получите промокод <b>−10%</b> (до 10 000 ₽) и доступ к корпоративным тарифам со скидками до 40%.
-
-Нажмите /start, чтобы продолжить регистрацию.
-                """,
-                'confirmation': """
-⏰ <b>Напоминание</b>
-
-Вы ввели все данные, но не подтвердили участие в партнёрстве.
-
-💡 После завершения получите промокод <b>−10%</b> (до 10 000 ₽) и доступ к корпоративным тарифам со скидками до 40%.
-
-Нажмите /start, чтобы продолжить регистрацию.
-                """
-            },
-            'incomplete_24h': {
-                'email': """
-🔄 <b>Почти готово!</b>
-
-Остался один шаг до получения доступа к корпоративным тарифам Яндекс.Путешествий (скидки до 40%) и промокода −10%.
-
-📧 Укажите email от YouTravel, чтобы активировать персональную скидку.
-
-Нажмите /start, чтобы продолжить регистрацию.
-                """,
-                'inn': """
-🔄 <b>Почти готово!</b>
-
-Остался один шаг до получения доступа к корпоративным тарифам Яндекс.Путешествий (скидки до 40%) и промокода −10%.
-
-💼 Укажите ИНН вашей компании, чтобы активировать персональную скидку.
-
-Нажмите /start, чтобы продолжить регистрацию.
-                """,
-                'confirmation': """
-🔄 <b>Почти готово!</b>
-
-Остался один шаг до получения доступа к корпоративным тарифам Яндекс.Путешествий (скидки до 40%) и промокода −10%.
-
-✅ Подтвердите участие в партнёрстве, чтобы активировать скидку.
-
-Нажмите /start, чтобы продолжить регистрацию.
-                """
-            },
-            'incomplete_3d': {
-                'email': """
-🎯 <b>Последний шанс!</b>
-
-Завершите регистрацию и получите:
-• Скидки до 40% на отели в России и за рубежом
-• Промокод −10% (до 10 000 ₽) на бронирования до 10 ноября
-• Корпоративный кабинет с удобной аналитикой и поддержкой 24/7
-
-Нажмите /start, чтобы завершить.
-                """,
-                'inn': """
-🎯 <b>Последний шанс!</b>
-
-Завершите регистрацию и получите:
-• Скидки до 40% на отели в России и за рубежом
-• Промокод −10% (до 10 000 ₽) на бронирования до 10 ноября
-• Корпоративный кабинет с удобной аналитикой и поддержкой 24/7
-
-Нажмите /start, чтобы завершить.
-                """,
-                'confirmation': """
-🎯 <b>Последний шанс!</b>
-
-Завершите регистрацию и получите:
-• Скидки до 40% на отели в России и за рубежом
-• Промокод −10% (до 10 000 ₽) на бронирования до 10 ноября
-• Корпоративный кабинет с удобной аналитикой и поддержкой 24/7
-
-Нажмите /start, чтобы завершить.
-                """
-            }
-        }
+                    SELECT user_id, next_reminder_at FROM users
+                    WHERE next_reminder_at <= $1
+                      AND ($3::int IS NULL OR mod(user_id, $3) = ANY($4::int[]))
+                    ORDER BY next_reminder_at
+                    LIMIT $2
+                """, horizon_end, limit, partition_count, owned)
         
-        return messages.get(reminder_type, {}).get(step, "")
+        if len(rows) == limit:
+            # Большой хвост просроченных: дальше не заглядываем, process_due дочитает из БД
+            horizon_end = rows[-1]['next_reminder_at']
+        self._heap = [(row['next_reminder_at'], row['user_id']) for row in rows]
+        heapq.heapify(self._heap)
+        self._horizon_end = horizon_end
     
-    async def check_promo_reminders(self):
-        """Проверка напоминаний о промокодах"""
+    async def process_due(self):
+        """Отправить все наступившие напоминания и пересчитать next_reminder_at"""
+        partition_count, owned = self._partition_filter()
+        started = time.perf_counter()
         try:
-            # Получаем пользователей, которые получили промокод 7 дней назад
-            seven_days_ago = datetime.now() - timedelta(days=7)
-            
-            async with db.pool.acquire() as conn:
-                # Проверяем, кому еще не отправляли напоминание о промокоде
-                rows = await conn.fetch("""
-                    SELECT u.user_id, u.promo_code, u.completed_at
-                    FROM users u
-                    LEFT JOIN user_reminders ur ON u.user_id = ur.user_id AND ur.reminder_type = 'promo_reminder'
-                    WHERE u.completed_at IS NOT NULL 
-                    AND u.promo_code IS NOT NULL
-                    AND u.completed_at <= $1
-                    AND ur.user_id IS NULL
-                """, seven_days_ago)
+            while partition_count is None or owned:
+                # Читаем с primary: отметки и новые дедлайны должны быть видны сразу
+                async with db.acquire() as conn:
+                    rows = await conn.fetch("""
+                        SELECT u.user_id, u.step, u.created_at, u.completed_at, u.promo_code,
+                               u.next_reminder_at,
+                               ARRAY(
+                                   SELECT r.reminder_type FROM user_reminders r
+                                   WHERE r.user_id = u.user_id
+                               ) AS sent
+                        FROM users u
+                        WHERE u.next_reminder_at <= NOW()
+                          AND ($2::int IS NULL OR mod(u.user_id, $2) = ANY($3::int[]))
+                          AND NOT EXISTS (SELECT 1 FROM blocked_chats b WHERE b.chat_id = u.user_id)
+                        ORDER BY u.next_reminder_at
+                        LIMIT $1
+                    """, config.REMINDER_BATCH_SIZE, partition_count, owned)
+                if not rows:
+                    break
                 
+                now = datetime.now()
+                messages = []
+                marks = []
+                assignments = []
+                updates = []
                 for row in rows:
-                    await self.send_promo_reminder(row['user_id'], row['promo_code'])
-                    await self.mark_reminder_sent(row['user_id'], 'promo_reminder')
+                    already_sent = set(row['sent'])
+                    reminder_type = self.get_due_reminder_type(row, now)
+                    if reminder_type and reminder_type not in already_sent:
+                        variant = templates.choose_variant(row['user_id'], reminder_type, row['step'])
+                        message = self.build_reminder(row, reminder_type, variant)
+                        if message:
+                            messages.append(message)
+                            marks.append((row['user_id'], reminder_type))
+                            assignments.append((row['user_id'], reminder_type, variant))
+                            already_sent.add(reminder_type)
                     
-        except Exception as e:
-            logger.error(f"Error checking promo reminders: {e}")
-    
-    async def send_promo_reminder(self, user_id: int, promo_code: str):
-        """Отправляем напоминание о промокоде"""
-        try:
-            message = f"""
-🎟️ <b>Напоминание о промокоде</b>
-
-Не забудьте использовать ваш промокод: <b>{promo_code}</b>
-
-💡 Он суммируется с корпоративными тарифами (до 40%) и действует до <b>10 ноября 2025</b>.
-
-Перейдите на <a href="https://travel.yandex.ru">travel.yandex.ru</a>, выберите отель и введите код при оплате.
-            """
-            
-            await self.bot.send_message(user_id, message, parse_mode="HTML")
-            logger.info(f"Promo reminder sent to user {user_id}")
-            
-        except Exception as e:
-            logger.error(f"Error sending promo reminder to user {user_id}: {e}")
-    
-    async def reminder_already_sent(self, user_id: int, reminder_type: str) -> bool:
-        """Проверяем, отправляли ли уже это напоминание"""
-        try:
-            async with db.pool.acquire() as conn:
-                result = await conn.fetchval("""
-                    SELECT 1 FROM user_reminders 
-                    WHERE user_id = $1 AND reminder_type = $2
-                """, user_id, reminder_type)
-                
-                return result is not None
+                    next_at = self.get_next_reminder_at(row, now, already_sent)
+                    updates.append((row['user_id'], next_at, row['next_reminder_at']))
                 
-        except Exception as e:
-            logger.error(f"Error checking reminder status: {e}")
-            return False
-    
-    async def mark_reminder_sent(self, user_id: int, reminder_type: str):
-        """Отмечаем, что напоминание отправлено"""
-        try:
-            async with db.pool.acquire() as conn:
-                # Создаем таблицу если не существует
-                await conn.execute("""
-                    CREATE TABLE IF NOT EXISTS user_reminders (
-                        user_id BIGINT,
-                        reminder_type TEXT,
-                        sent_at TIMESTAMP DEFAULT NOW(),
-                        PRIMARY KEY (user_id, reminder_type)
-                    )
-                """)
+                # Постановка в очередь, отметки и новые дедлайны — одной транзакцией:
+                # падение между отправкой и отметкой больше не даёт дублей
+                async with db.acquire() as conn:
+                    async with conn.transaction():
+                        await outbox.enqueue(messages, conn=conn)
+                        await conn.executemany("""
+                            INSERT INTO user_reminders (user_id, reminder_type)
+                            VALUES ($1, $2)
+                            ON CONFLICT (user_id, reminder_type) DO NOTHING
+                        """, marks)
+                        await conn.executemany("""
+                            INSERT INTO reminder_assignments (user_id, reminder_type, variant)
+                            VALUES ($1, $2, $3)
+                            ON CONFLICT (user_id, reminder_type) DO NOTHING
+                        """, assignments)
+                        # Не перетираем дедлайн, если этап сменился параллельно
+                        await conn.executemany("""
+                            UPDATE users SET next_reminder_at = $2
+                            WHERE user_id = $1 AND next_reminder_at = $3
+                        """, updates)
+                for _, reminder_type in marks:
+                    REMINDERS_QUEUED.inc(reminder_type)
+                if messages:
+                    outbox.wake()
+                    logger.info(f"Queued {len(messages)} reminders")
                 
-                await conn.execute("""
-                    INSERT INTO user_reminders (user_id, reminder_type) 
-                    VALUES ($1, $2)
-                    ON CONFLICT (user_id, reminder_type) DO NOTHING
-                """, user_id, reminder_type)
+                if len(rows) < config.REMINDER_BATCH_SIZE:
+                    break
                 
         except Exception as e:
-            logger.error(f"Error marking reminder as sent: {e}")
+            logger.error(f"Error processing due reminders: {e}")
+        REMINDER_CYCLE_SECONDS.observe(time.perf_counter() - started)
+        
+        now = datetime.now()
+        while self._heap and self._heap[0][0] <= now:
+            heapq.heappop(self._heap)
     
-    async def send_new_user_notification(self, user_id: int, email: str):
-        """Уведомление админам о новом пользователе"""
-        try:
-            message = f"""
-👤 <b>Новый пользователь</b>
-
-ID: {user_id}
-Email: {email}
-Время: {datetime.now().strftime('%d.%m.%Y %H:%M')}
-
-📊 Проверьте статистику: /admin_stats
-            """
-            
-            for admin_id in config.ADMIN_USER_IDS:
-                try:
-                    await self.bot.send_message(admin_id, message, parse_mode="HTML")
-                except Exception as e:
-                    logger.error(f"Failed to send new user notification to admin {admin_id}: {e}")
-                    
-        except Exception as e:
-            logger.error(f"Error sending new user notification: {e}")
+    def get_due_reminder_type(self, user: Dict[str, Any], now: datetime) -> Optional[str]:
+        """Самое позднее наступившее напоминание для пользователя"""
+        if user['completed_at']:
+            promo_due = user['completed_at'] + timedelta(minutes=self.reminder_intervals['promo_reminder'])
+            if user['promo_code'] and promo_due <= now:
+                return 'promo_reminder'
+            return None
+        
+        if user['step'] not in config.REMINDER_STEPS:
+            return None
+        
+        for reminder_type in reversed(INCOMPLETE_REMINDERS):
+            if user['created_at'] + timedelta(minutes=self.reminder_intervals[reminder_type]) <= now:
+                return reminder_type
+        return None
     
-    async def send_completion_notification(self, user_id: int, email: str, promo_code: str):
-        """Уведомление админам о завершенной регистрации"""
-        try:
-            message = f"""
-✅ <b>Регистрация завершена</b>
-
-ID: {user_id}
-Email: {email}
-Промокод: {promo_code}
-Время: {datetime.now().strftime('%d.%m.%Y %H:%M')}
-
-📊 Проверьте статистику: /admin_stats
-            """
-            
-            for admin_id in config.ADMIN_USER_IDS:
-                try:
-                    await self.bot.send_message(admin_id, message, parse_mode="HTML")
-                except Exception as e:
-                    logger.error(f"Failed to send completion notification to admin {admin_id}: {e}")
-                    
-        except Exception as e:
-            logger.error(f"Error sending completion notification: {e}")
-
-    async def send_new_user_notification(self, user_id: int, message: str):
-        """Отправка уведомления о новом пользователе"""
-        try:
-            notification = f"""
-🆕 <b>Новый пользователь!</b>
-
-👤 ID: {user_id}
-📝 Сообщение: {message}
-📅 Время: {datetime.now().strftime('%d.%m.%Y %H:%M')}
-"""
-            
-            # Отправляем всем админам
-            for admin_id in config.ADMIN_USER_IDS:
-                try:
-                    await self.bot.send_message(admin_id, notification, parse_mode="HTML")
-                except Exception as e:
-                    logger.error(f"Failed to send new user notification to admin {admin_id}: {e}")
-                    
-        except Exception as e:
-            logger.error(f"Error sending new user notification: {e}")
-
-    async def send_completion_notification(self, user_id: int, email: str, promo_code: str):
-        """Отправка уведомления о завершенной регистрации"""
-        try:
-            notification = f"""
-✅ <b>Регистрация завершена!</b>
-
-👤 Пользователь: {user_id}
-📧 Email: {email}
-🎟️ Промокод: {promo_code}
-📅 Время: {datetime.now().strftime('%d.%m.%Y %H:%M')}
-"""
-            
-            # Отправляем всем админам
-            for admin_id in config.ADMIN_USER_IDS:
-                try:
-                    await self.bot.send_message(admin_id, notification, parse_mode="HTML")
-                except Exception as e:
-                    logger.error(f"Failed to send completion notification to admin {admin_id}: {e}")
-                    
-        except Exception as e:
-            logger.error(f"Error sending completion notification: {e}")
+    def get_next_reminder_at(self, user: Dict[str, Any], now: datetime, sent: set) -> Optional[datetime]:
+        """Ближайший будущий дедлайн (None — напоминаний больше не будет)"""
+        if user['completed_at']:
+            if not user['promo_code'] or 'promo_reminder' in sent:
+                return None
+            promo_due = user['completed_at'] + timedelta(minutes=self.reminder_intervals['promo_reminder'])
+            return promo_due if promo_due > now else None
+        
+        if user['step'] not in config.REMINDER_STEPS:
+            return None
+        
+        for reminder_type in INCOMPLETE_REMINDERS:
+            due = user['created_at'] + timedelta(minutes=self.reminder_intervals[reminder_type])
+            if due > now:
+                return due
+        return None
+    
+    def build_reminder(self, user: Dict[str, Any], reminder_type: str,
+                       variant: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """Сообщение-напоминание для очереди (None — текста для этапа нет)"""
+        user_id = user['user_id']
+        if variant is None:
+            variant = templates.choose_variant(user_id, reminder_type, user['step'])
+        if not variant:
+            return None
+        if reminder_type == 'promo_reminder':
+            text = templates.render(reminder_type, user['step'], variant, promo_code=user['promo_code'])
+        else:
+            text = templates.render(reminder_type, user['step'], variant)
+        if not text:
+            return None
+        
+        # Поколение регистрации в ключе: после /reset или очистки БД пользователь
+        # регистрируется заново и снова должен получить напоминания
+        generation = int(user['created_at'].timestamp())
+        return outbox_message(
+            f"reminder:{user_id}:{generation}:{reminder_type}", user_id, text,
+            lane='bulk',
+            # Для напоминания через 3 дня добавляем изображение
+            photo='reminder_card.jpg' if reminder_type == 'incomplete_3d' else None,
+            track='reminder_sent'
+        )
 
 # Глобальный экземпляр
 reminders = ReminderSystem()
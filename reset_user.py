@@ -33,7 +33,7 @@ async def reset_user(telegram_id: int):
         logger.info(f"  Completed: {user.get('completed_at')}")
         
         # Удаляем пользователя
-        async with db.pool.acquire() as conn:
+        async with db.acquire() as conn:
             result = await conn.execute(
                 "DELETE FROM users WHERE telegram_id = $1",
                 telegram_id
@@ -57,7 +57,7 @@ async def list_users():
     try:
         await db.connect()
         
-        async with db.pool.acquire() as conn:
+        async with db.acquire() as conn:
             rows = await conn.fetch("SELECT * FROM users ORDER BY created_at DESC")
             
             if not rows:
@@ -0,0 +1,367 @@
+"""
+Общий планировщик фоновых задач
+
+Три вида задач:
+- every(name, seconds, func) — периодическая, интервал от начала прошлого запуска;
+- cron(name, '0 9 * * *', func) — по расписанию (минута час день месяц день_недели,
+  локальное время), поддерживаются *, списки, диапазоны и шаг;
+- service(name, func) — долгоживущий цикл (напоминания, зеркало Sheets),
+  который перезапускается с экспоненциальной паузой, если упал или вышел.
+
+Время последнего запуска периодических задач хранится в scheduled_jobs,
+поэтому рестарт или смена лидера не приводит ни к пропуску, ни к повтору:
+пропущенный запуск выполняется один раз (catchup='once') или
+пропускается (catchup='skip'). jitter разносит запуски случайной задержкой.
+Задачи с leader=True работают в одной реплике (через leases); всё, что
+происходит с задачей, видно в get_stats() и в метриках.
+"""
+import asyncio
+import logging
+import random
+import time
+from datetime import datetime, timedelta
+from typing import Optional, Dict, Any, List, Callable, Awaitable, Set
+
+import config
+from database import db
+from leases import leases
+from monitoring import metrics
+
+logger = logging.getLogger(__name__)
+
+CATCHUP_POLICIES = ('once', 'skip')
+
+JOB_RUNS = metrics.counter('bot_job_runs_total', 'Scheduled job runs by result', ('job', 'status'))
+JOB_SECONDS = metrics.histogram(
+    'bot_job_duration_seconds', 'Scheduled job run duration', ('job',),
+    buckets=(0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0)
+)
+
+# Поле cron -> (минимум, максимум)
+_CRON_FIELDS = (
+    ('minute', 0, 59),
+    ('hour', 0, 23),
+    ('day', 1, 31),
+    ('month', 1, 12),
+    ('weekday', 0, 6),  # 0 — воскресенье, 7 тоже принимается
+)
+
+
+def _parse_cron_field(text: str, low: int, high: int) -> Set[int]:
+    values = set()
+    for part in text.split(','):
+        step = 1
+        if '/' in part:
+            part, step_text = part.split('/', 1)
+            step = int(step_text)
+            if step <= 0:
+                raise ValueError(f"Invalid cron step: {text}")
+        if part == '*':
+            start, end = low, high
+        elif '-' in part:
+            start_text, end_text = part.split('-', 1)
+            start, end = int(start_text), int(end_text)
+        else:
+            start = int(part)
+            # '5/10' — с 5 до конца диапазона
+            end = high if step > 1 else start
+        if high == 6 and end == 7:
+            # Воскресенье как 7
+            values.add(0)
+            end = 6
+            if start == 7:
+                continue
+        if start < low or end > high or start > end:
+            raise ValueError(f"Cron field {text} out of range {low}-{high}")
+        values.update(range(start, end + 1, step))
+    return values
+
+
+class CronSpec:
+    """Разобранное cron-выражение из пяти полей"""
+
+    def __init__(self, spec: str):
+        parts = spec.split()
+        if len(parts) != 5:
+            raise ValueError(f"Cron spec must have 5 fields: {spec!r}")
+        self.spec = spec
+        fields = {
+            name: _parse_cron_field(part, low, high)
+            for part, (name, low, high) in zip(parts, _CRON_FIELDS)
+        }
+        self.minutes = fields['minute']
+        self.hours = fields['hour']
+        self.days = fields['day']
+        self.months = fields['month']
+        self.weekdays = fields['weekday']
+        self._any_day = parts[2] == '*'
+        self._any_weekday = parts[4] == '*'
+
+    def _day_matches(self, moment: datetime) -> bool:
+        day_ok = moment.day in self.days
+        weekday_ok = (moment.weekday() + 1) % 7 in self.weekdays
+        if not self._any_day and not self._any_weekday:
+            # Как в cron: ограничены оба — достаточно любого
+            return day_ok or weekday_ok
+        return day_ok and weekday_ok
+
+    def next_after(self, moment: datetime) -> datetime:
+        """Ближайший момент строго после moment"""
+        candidate = moment.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = candidate + timedelta(days=366 * 5)
+        while candidate < limit:
+            if candidate.month not in self.months:
+                year = candidate.year + candidate.month // 12
+                candidate = candidate.replace(year=year, month=candidate.month % 12 + 1,
+                                              day=1, hour=0, minute=0)
+                continue
+            if not self._day_matches(candidate):
+                candidate = (candidate + timedelta(days=1)).replace(hour=0, minute=0)
+                continue
+            if candidate.hour not in self.hours:
+                candidate = (candidate + timedelta(hours=1)).replace(minute=0)
+                continue
+            if candidate.minute not in self.minutes:
+                candidate += timedelta(minutes=1)
+                continue
+            return candidate
+        raise ValueError(f"Cron spec {self.spec!r} never fires")
+
+
+class Job:
+    def __init__(self, name: str, func: Callable[[], Awaitable[Any]], kind: str,
+                 interval: Optional[float] = None, cron: Optional[CronSpec] = None,
+                 jitter: float = 0.0, catchup: str = 'once', leader: bool = True,
+                 timeout: Optional[float] = None):
+        if catchup not in CATCHUP_POLICIES:
+            raise ValueError(f"Unknown catch-up policy: {catchup}")
+        self.name = name
+        self.func = func
+        self.kind = kind
+        self.interval = interval
+        self.cron = cron
+        self.jitter = jitter
+        self.catchup = catchup
+        self.leader = leader
+        self.timeout = timeout
+        self.task: Optional[asyncio.Task] = None
+        # Статистика этой реплики
+        self.running = False
+        self.runs = 0
+        self.failures = 0
+        self.restarts = 0
+        self.last_run_at: Optional[datetime] = None
+        self.last_error: Optional[str] = None
+        self.last_duration = 0.0
+        self.max_duration = 0.0
+        self.total_duration = 0.0
+        self.next_run_at: Optional[datetime] = None
+
+    @property
+    def schedule(self) -> str:
+        if self.kind == 'cron':
+            return self.cron.spec
+        if self.kind == 'interval':
+            return f"every {self.interval:g}s"
+        return 'service'
+
+    def _jitter(self) -> timedelta:
+        return timedelta(seconds=random.uniform(0, self.jitter)) if self.jitter else timedelta()
+
+    def first_run(self, last_run: Optional[datetime], now: datetime) -> datetime:
+        """Первый запуск с учётом сохранённого последнего и политики пропусков"""
+        if self.kind == 'interval':
+            due = last_run + timedelta(seconds=self.interval) if last_run else now
+        elif last_run is None:
+            # Новая cron-задача не запускается задним числом
+            return self.cron.next_after(now) + self._jitter()
+        else:
+            due = self.cron.next_after(last_run)
+
+        if due > now:
+            return due + self._jitter()
+        if self.catchup == 'once':
+            return now + self._jitter()
+        return self.next_run(now, now)
+
+    def next_run(self, started: datetime, now: datetime) -> datetime:
+        if self.kind == 'interval':
+            return max(started + timedelta(seconds=self.interval), now) + self._jitter()
+        return self.cron.next_after(now) + self._jitter()
+
+
+class JobScheduler:
+    def __init__(self):
+        self.jobs: Dict[str, Job] = {}
+        self._started = False
+
+    def _add(self, job: Job) -> Job:
+        if job.name in self.jobs:
+            raise ValueError(f"Job {job.name} is already registered")
+        self.jobs[job.name] = job
+        return job
+
+    def every(self, name: str, seconds: float, func: Callable[[], Awaitable[Any]],
+              jitter: float = 0.0, catchup: str = 'once', leader: bool = True,
+              timeout: Optional[float] = None) -> Job:
+        """Периодическая задача"""
+        return self._add(Job(name, func, 'interval', interval=seconds, jitter=jitter,
+                             catchup=catchup, leader=leader, timeout=timeout))
+
+    def cron(self, name: str, spec: str, func: Callable[[], Awaitable[Any]],
+             jitter: float = 0.0, catchup: str = 'once', leader: bool = True,
+             timeout: Optional[float] = None) -> Job:
+        """Задача по cron-расписанию"""
+        return self._add(Job(name, func, 'cron', cron=CronSpec(spec), jitter=jitter,
+                             catchup=catchup, leader=leader, timeout=timeout))
+
+    def service(self, name: str, func: Callable[[], Awaitable[Any]], leader: bool = True) -> Job:
+        """Долгоживущий цикл под присмотром"""
+        return self._add(Job(name, func, 'service', leader=leader))
+
+    def start(self):
+        """Запустить задачи; лидерские — через leases (вызывать до leases.start())"""
+        if self._started:
+            return
+        self._started = True
+        for job in self.jobs.values():
+            if job.leader:
+                leases.leader(job.name, lambda job=job: self._supervise(job))
+            else:
+                job.task = asyncio.create_task(self._supervise(job))
+        logger.info(f"⏱ Scheduler started ({', '.join(f'{j.name} [{j.schedule}]' for j in self.jobs.values())})")
+
+    async def close(self):
+        for job in self.jobs.values():
+            if job.task:
+                job.task.cancel()
+                job.task = None
+        self._started = False
+
+    async def _supervise(self, job: Job):
+        """Запуск задачи; падение самого цикла планировщика тоже перезапускается"""
+        backoff = config.SCHEDULER_RESTART_BASE
+        while True:
+            started = time.monotonic()
+            try:
+                if job.kind == 'service':
+                    job.running = True
+                    job.last_run_at = datetime.now()
+                    await job.func()
+                    error = "service exited"
+                else:
+                    await self._run_periodic(job)
+                    error = "scheduler loop exited"
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                error = str(e) or type(e).__name__
+            finally:
+                job.running = False
+
+            if time.monotonic() - started >= config.SCHEDULER_RESTART_RESET:
+                backoff = config.SCHEDULER_RESTART_BASE
+            job.failures += 1
+            job.restarts += 1
+            job.last_error = error[:500]
+            job.next_run_at = datetime.now() + timedelta(seconds=backoff)
+            JOB_RUNS.inc(job.name, 'crashed')
+            logger.error(f"Job {job.name} stopped: {error}; restarting in {backoff:g}s")
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, config.SCHEDULER_RESTART_MAX)
+
+    async def _run_periodic(self, job: Job):
+        last_run = await self._load_last_run(job.name)
+        job.next_run_at = job.first_run(last_run, datetime.now())
+        while True:
+            delay = (job.next_run_at - datetime.now()).total_seconds()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            started = datetime.now()
+            await self._execute(job)
+            job.next_run_at = job.next_run(started, datetime.now())
+
+    async def _execute(self, job: Job):
+        started_at = datetime.now()
+        started = time.perf_counter()
+        job.running = True
+        status, error = 'ok', None
+        try:
+            if job.timeout:
+                await asyncio.wait_for(job.func(), timeout=job.timeout)
+            else:
+                await job.func()
+        except asyncio.CancelledError:
+            raise
+        except asyncio.TimeoutError:
+            status, error = 'error', f"timeout after {job.timeout:g}s"
+        except Exception as e:
+            status, error = 'error', str(e) or type(e).__name__
+        finally:
+            job.running = False
+
+        duration = time.perf_counter() - started
+        job.runs += 1
+        job.last_run_at = started_at
+        job.last_duration = duration
+        job.max_duration = max(job.max_duration, duration)
+        job.total_duration += duration
+        JOB_RUNS.inc(job.name, status)
+        JOB_SECONDS.observe(duration, job.name)
+        if error:
+            job.failures += 1
+            job.last_error = error[:500]
+            logger.error(f"Job {job.name} failed after {duration:.1f}s: {error}")
+
+        try:
+            await self._save_run(job.name, started_at, status, error, duration)
+        except Exception as e:
+            logger.error(f"Failed to save run of job {job.name}: {e}")
+
+    async def _load_last_run(self, name: str) -> Optional[datetime]:
+        async with db.acquire() as conn:
+            return await conn.fetchval("SELECT last_run_at FROM scheduled_jobs WHERE name = $1", name)
+
+    async def _save_run(self, name: str, started_at: datetime, status: str,
+                        error: Optional[str], duration: float):
+        async with db.acquire() as conn:
+            await conn.execute("""
+                INSERT INTO scheduled_jobs (name, last_run_at, last_success_at, last_status, last_error,
+                                            last_duration_ms, runs, failures, updated_at)
+                VALUES ($1, $2, CASE WHEN $3 = 'ok' THEN $2 END, $3, $4, $5,
+                        1, CASE WHEN $3 = 'ok' THEN 0 ELSE 1 END, NOW())
+                ON CONFLICT (name) DO UPDATE SET
+                    last_run_at = EXCLUDED.last_run_at,
+                    last_success_at = COALESCE(EXCLUDED.last_success_at, scheduled_jobs.last_success_at),
+                    last_status = EXCLUDED.last_status,
+                    last_error = EXCLUDED.last_error,
+                    last_duration_ms = EXCLUDED.last_duration_ms,
+                    runs = scheduled_jobs.runs + 1,
+                    failures = scheduled_jobs.failures + EXCLUDED.failures,
+                    updated_at = NOW()
+            """, name, started_at, status, error and error[:500], duration * 1000)
+
+    def get_stats(self) -> List[Dict[str, Any]]:
+        """Состояние задач в этой реплике"""
+        active = {lease['name'] for lease in leases.get_status() if lease.get('leader')}
+        stats = []
+        for job in self.jobs.values():
+            stats.append({
+                'name': job.name,
+                'schedule': job.schedule,
+                'active': job.name in active if job.leader else job.task is not None,
+                'running': job.running,
+                'runs': job.runs,
+                'failures': job.failures,
+                'restarts': job.restarts,
+                'last_run_at': job.last_run_at,
+                'last_error': job.last_error,
+                'avg_ms': job.total_duration / job.runs * 1000 if job.runs else 0.0,
+                'max_ms': job.max_duration * 1000,
+                'next_run_at': job.next_run_at,
+            })
+        return stats
+
+
+# Глобальный экземпляр
+scheduler = JobScheduler()
@@ -1,12 +1,20 @@
+import asyncio
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 import logging
 import os
 import json
+import html
+import time
 import config
+from monitoring import metrics
 
 logger = logging.getLogger(__name__)
 
+SHEETS_CALL_SECONDS = metrics.histogram(
+    'bot_sheets_call_seconds', 'Google Sheets call latency', ('method',)
+)
+
 
 class SheetsManager:
     """Менеджер для работы с Google Sheets"""
@@ -138,6 +146,17 @@ class SheetsManager:
             logger.error("=" * 60)
             raise
     
+    @SHEETS_CALL_SECONDS.time('ping')
+    def ping(self):
+        """Лёгкая проверка доступа: метаданные таблицы без значений ячеек"""
+        if not self.client:
+            self.connect()
+        if not self.client:
+            raise RuntimeError("Google Sheets client is not connected")
+        # open_by_key читает только метаданные (свойства таблицы и листов)
+        self.client.open_by_key(config.GOOGLE_SHEET_EMAILS_ID)
+    
+    @SHEETS_CALL_SECONDS.time('check_email_exists')
     def check_email_exists(self, email: str) -> bool:
         """Проверка существования email в базе верифицированных ТЭ"""
         try:
@@ -167,6 +186,7 @@ class SheetsManager:
             logger.error(f"Error checking email: {e}")
             return False
     
+    @SHEETS_CALL_SECONDS.time('get_available_promo')
     def get_available_promo(self) -> str:
         """Получить доступный промокод из таблицы промокодов"""
         try:
@@ -219,6 +239,7 @@ class SheetsManager:
             logger.error(traceback.format_exc())
             return None
     
+    @SHEETS_CALL_SECONDS.time('get_available_promo_codes')
     def get_available_promo_codes(self) -> list:
         """Получить все доступные промокоды"""
         try:
@@ -256,6 +277,87 @@ class SheetsManager:
             logger.error(f"Error getting promo codes: {type(e).__name__}: {e}")
             return []
     
+    @SHEETS_CALL_SECONDS.time('mark_promo_used')
+    def mark_promo_used(self, promo_code: str, claimed_at: str) -> bool:
+        """Отметить промокод как выданный в листе Promos (зеркало инвентаря из БД)"""
+        # Убеждаемся, что подключение установлено
+        if not self.client:
+            self.connect()
+        
+        spreadsheet = self.client.open_by_key(config.GOOGLE_SHEET_EMAILS_ID)
+        promo_worksheet = spreadsheet.worksheet('Promos')
+        
+        cell = promo_worksheet.find(promo_code, in_column=1)
+        if not cell:
+            logger.warning(f"Promo code {promo_code} not found in Promos sheet")
+            return False
+        
+        promo_worksheet.update(f'B{cell.row}:C{cell.row}', [["used", claimed_at]])
+        logger.info(f"Promo code {promo_code} marked as used in sheet")
+        return True
+    
+    async def sync_promo_inventory(self) -> int:
+        """Импортировать свободные промокоды из листа Promos в инвентарь БД"""
+        from database import db
+        codes = await asyncio.to_thread(self.get_available_promo_codes)
+        imported = await db.import_promo_codes(codes)
+        if imported:
+            logger.info(f"Imported {imported} promo codes into inventory")
+        return imported
+    
+    async def process_outbox(self) -> int:
+        """Отправить в Google Sheets записи, поставленные в очередь при регистрации"""
+        from database import db
+        processed = 0
+        for item in await db.fetch_sheets_outbox():
+            payload = item['payload']
+            try:
+                if item['kind'] == 'promo_used':
+                    marked = await asyncio.to_thread(self.mark_promo_used, payload['code'], payload['claimed_at'])
+                    if not marked:
+                        raise RuntimeError(f"promo code {payload['code']} not found in Promos sheet")
+                elif item['kind'] == 'registration':
+                    saved = await asyncio.to_thread(
+                        self.save_registration, payload['email'], payload['inn'], payload['promo_code']
+                    )
+                    if not saved:
+                        raise RuntimeError("save_registration failed")
+                else:
+                    logger.warning(f"Unknown sheets outbox kind: {item['kind']}")
+                await db.finish_sheets_outbox(item['id'])
+                processed += 1
+            except Exception as e:
+                logger.error(f"Sheets outbox item {item['id']} failed: {type(e).__name__}: {e}")
+                dead = await db.finish_sheets_outbox(item['id'], error=f"{type(e).__name__}: {e}")
+                if dead:
+                    from notifications import notifier
+                    logger.error(f"Sheets outbox item {item['id']} ({item['kind']}) gave up after "
+                                 f"{item['attempts'] + 1} attempts")
+                    notifier.escalate(
+                        f"📄 <b>Запись не попала в Google Sheets</b>\n\n"
+                        f"{item['kind']} #{item['id']}: {html.escape(str(e))[:300]}",
+                        f"sheets_outbox:{item['id']}"
+                    )
+                # Запись отложена и больше не первая в очереди; остальные попробуем в следующий цикл
+                break
+        return processed
+    
+    async def start_mirror(self):
+        """Фоновая синхронизация: очередь записей в Sheets и пополнение инвентаря промокодов"""
+        logger.info("📄 Starting Google Sheets mirror...")
+        last_inventory_sync = 0.0
+        
+        while True:
+            try:
+                if time.monotonic() - last_inventory_sync >= config.PROMO_INVENTORY_SYNC_INTERVAL:
+                    await self.sync_promo_inventory()
+                    last_inventory_sync = time.monotonic()
+                await self.process_outbox()
+            except Exception as e:
+                logger.error(f"Sheets mirror error: {e}")
+            await asyncio.sleep(config.SHEETS_MIRROR_INTERVAL)
+    
+    @SHEETS_CALL_SECONDS.time('check_email_already_registered')
     def check_email_already_registered(self, email: str) -> bool:
         """Проверить, не зарегистрирован ли уже этот email"""
         try:
@@ -291,6 +393,7 @@ class SheetsManager:
             logger.error(f"Error checking email registration: {type(e).__name__}: {e}")
             return False
     
+    @SHEETS_CALL_SECONDS.time('save_registration')
     def save_registration(self, email: str, inn: str, promo_code: str) -> bool:
         """Сохранить данные регистрации в Google Sheets"""
         try:
@@ -331,6 +434,7 @@ class SheetsManager:
             logger.error(f"Error saving registration: {type(e).__name__}: {e}")
             return False
     
+    @SHEETS_CALL_SECONDS.time('remove_registration')
     def remove_registration(self, email: str) -> bool:
         """Удалить запись регистрации из Google Sheets"""
         try:
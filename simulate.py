@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+"""
+Симуляция и бенчмарк конвейера напоминаний
+
+Заполняет локальную базу синтетическими пользователями (разные этапы и
+возраст регистрации), прогоняет цикл ReminderSystem и доставку из
+message_outbox через фейкового бота с задержкой и инъекцией ошибок и
+печатает отчёт: время цикла, запросы к БД, отправки в секунду, дубли.
+
+Только для локальной/тестовой базы! Настройки берутся из .env, базу можно
+переопределить через --dsn. Если в базе есть несинтетические пользователи
+или недоставленные сообщения, симуляция не запускается.
+
+Использование:
+    python simulate.py small
+    python simulate.py large --dsn postgresql://localhost/bot_sim --latency-ms 2 --workers 16
+    python simulate.py medium --error-rate 0.05 --blocked-rate 0.01 --cleanup
+"""
+import argparse
+import asyncio
+import logging
+import random
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from typing import Optional, Dict, Any, List, Tuple
+
+import config
+from assets import assets
+from blocked import blocked
+from database import db
+from outbox import outbox
+from reminders import reminders
+
+logger = logging.getLogger(__name__)
+
+# Размеры наборов
+PRESETS = {
+    'tiny': 1_000,
+    'small': 10_000,
+    'medium': 100_000,
+    'large': 1_000_000,
+}
+
+# Синтетические user_id начинаются отсюда, чтобы не пересекаться с реальными
+SIM_USER_ID_BASE = 10 ** 15
+
+# Доли этапов регистрации
+STEP_WEIGHTS = {
+    'email': 0.35,
+    'inn': 0.2,
+    'confirmation': 0.1,
+    'completed': 0.35,
+}
+
+SEED_CHUNK = 50_000
+
+
+class FakeBot:
+    """Записывает отправки вместо Telegram; задержка и ошибки настраиваются"""
+
+    def __init__(self, latency_ms: float = 5.0, error_rate: float = 0.0,
+                 blocked_rate: float = 0.0, seed: Optional[int] = None):
+        self.latency_ms = latency_ms
+        self.error_rate = error_rate
+        self.blocked_rate = blocked_rate
+        self.random = random.Random(seed)
+        self.received: Counter = Counter()
+        self.sends = 0
+        self.errors = 0
+        self.blocked = 0
+
+    async def _send(self, chat_id: int, text: str):
+        if self.latency_ms:
+            await asyncio.sleep(self.random.uniform(0.5, 1.5) * self.latency_ms / 1000)
+
+        roll = self.random.random()
+        if roll < self.blocked_rate:
+            self.blocked += 1
+            raise Exception("Telegram server says - Forbidden: bot was blocked by the user")
+        if roll < self.blocked_rate + self.error_rate:
+            self.errors += 1
+            raise Exception("Telegram server says - Internal Server Error")
+
+        self.sends += 1
+        self.received[(chat_id, text)] += 1
+        return SimpleNamespace(
+            message_id=self.sends,
+            photo=[SimpleNamespace(file_id="sim-file-id")]
+        )
+
+    async def send_message(self, chat_id: int, text: str, **kwargs):
+        return await self._send(chat_id, text)
+
+    async def send_photo(self, chat_id: int, photo, caption: Optional[str] = None, **kwargs):
+        return await self._send(chat_id, caption or "")
+
+    @property
+    def duplicates(self) -> int:
+        """Одинаковые сообщения, доставленные в один чат больше одного раза"""
+        return sum(count - 1 for count in self.received.values() if count > 1)
+
+
+def synthetic_user(i: int, now: datetime, rng: random.Random) -> Tuple:
+    """Строка users для COPY; next_reminder_at считается как у планировщика"""
+    user_id = SIM_USER_ID_BASE + i
+    step = rng.choices(list(STEP_WEIGHTS), weights=list(STEP_WEIGHTS.values()))[0]
+    created_at = now - timedelta(minutes=rng.uniform(0, 5 * 24 * 60))
+    completed_at = inn = promo_code = None
+    if step == 'completed':
+        completed_at = min(now, created_at + timedelta(minutes=rng.uniform(5, 24 * 60)))
+        # Часть завершивших — давно, чтобы было кому напомнить о промокоде
+        if rng.random() < 0.3:
+            created_at -= timedelta(days=7)
+            completed_at -= timedelta(days=7)
+        inn = f"9{i:011d}"
+        promo_code = f"SIM{i:08d}"
+
+    row = {
+        'user_id': user_id,
+        'step': step,
+        'created_at': created_at,
+        'completed_at': completed_at,
+        'promo_code': promo_code,
+    }
+    if reminders.get_due_reminder_type(row, now):
+        next_reminder_at = now - timedelta(seconds=1)
+    else:
+        next_reminder_at = reminders.get_next_reminder_at(row, now, set())
+
+    return (
+        user_id, f"sim_{i}", f"sim{i}@example.com", inn, promo_code,
+        step, created_at, completed_at, next_reminder_at
+    )
+
+
+async def seed(size: int, rng: random.Random) -> float:
+    """Залить size синтетических пользователей через COPY, вернуть время в секундах"""
+    started = time.perf_counter()
+    now = datetime.now()
+    for offset in range(0, size, SEED_CHUNK):
+        records = [
+            synthetic_user(i, now, rng)
+            for i in range(offset, min(size, offset + SEED_CHUNK))
+        ]
+        async with db.acquire() as conn:
+            await conn.copy_records_to_table(
+                'users',
+                records=records,
+                columns=['user_id', 'telegram_username', 'email', 'inn', 'promo_code',
+                         'step', 'created_at', 'completed_at', 'next_reminder_at']
+            )
+        logger.info(f"Seeded {offset + len(records)}/{size} users")
+    return time.perf_counter() - started
+
+
+async def cleanup():
+    """Удалить синтетических пользователей и всё, что с ними связано"""
+    async with db.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute("DELETE FROM message_outbox WHERE chat_id >= $1", SIM_USER_ID_BASE)
+            await conn.execute("DELETE FROM blocked_chats WHERE chat_id >= $1", SIM_USER_ID_BASE)
+            await conn.execute("DELETE FROM user_reminders WHERE user_id >= $1", SIM_USER_ID_BASE)
+            await conn.execute("DELETE FROM reminder_assignments WHERE user_id >= $1", SIM_USER_ID_BASE)
+            await conn.execute("DELETE FROM user_events WHERE user_id >= $1", SIM_USER_ID_BASE)
+            await conn.execute("DELETE FROM users WHERE user_id >= $1", SIM_USER_ID_BASE)
+    await db.invalidate("*")
+    # Синтетические чаты не должны оставаться в памяти реестра заблокированных
+    await blocked.load()
+
+
+async def real_data() -> Dict[str, int]:
+    """
+    Несинтетические строки, которые тронул бы прогон: process_due и воркеры
+    message_outbox работают по всей базе, без фильтра по SIM_USER_ID_BASE
+    """
+    async with db.acquire() as conn:
+        row = await conn.fetchrow("""
+            SELECT
+                (SELECT COUNT(*) FROM users WHERE user_id < $1) AS users,
+                (SELECT COUNT(*) FROM message_outbox
+                 WHERE chat_id < $1 AND sent_at IS NULL AND failed_at IS NULL) AS outbox
+        """, SIM_USER_ID_BASE)
+    return {key: count for key, count in dict(row).items() if count}
+
+
+async def pending_sim_messages() -> int:
+    async with db.acquire() as conn:
+        return await conn.fetchval("""
+            SELECT COUNT(*) FROM message_outbox
+            WHERE chat_id >= $1 AND sent_at IS NULL AND failed_at IS NULL
+        """, SIM_USER_ID_BASE)
+
+
+async def run_cycle(bot: FakeBot, drain_timeout: float) -> Dict[str, Any]:
+    """
+    Один цикл: постановка наступивших напоминаний в очередь и доставка.
+    Воркеры очереди запускаются только на доставку, чтобы их запросы не
+    попадали в счёт постановки; опрос самой симуляции из счёта исключается.
+    """
+    queries_before = db.stats.queries
+    sends_before = bot.sends
+
+    started = time.perf_counter()
+    await reminders.process_due()
+    enqueue_seconds = time.perf_counter() - started
+    enqueue_queries = db.stats.queries - queries_before
+
+    delivery_before = db.stats.queries
+    polls = 0
+    outbox.start(bot)
+    drain_started = time.perf_counter()
+    try:
+        pending = await pending_sim_messages()
+        polls += 1
+        while pending and time.perf_counter() - drain_started < drain_timeout:
+            await asyncio.sleep(0.2)
+            pending = await pending_sim_messages()
+            polls += 1
+    finally:
+        await outbox.close()
+    drain_seconds = time.perf_counter() - drain_started
+    delivery_queries = db.stats.queries - delivery_before - polls
+
+    sends = bot.sends - sends_before
+    return {
+        'enqueue_seconds': enqueue_seconds,
+        'enqueue_queries': enqueue_queries,
+        'drain_seconds': drain_seconds,
+        'delivery_queries': delivery_queries,
+        'total_queries': enqueue_queries + delivery_queries,
+        'sends': sends,
+        'sends_per_sec': sends / drain_seconds if drain_seconds else 0.0,
+        'left_pending': pending,
+    }
+
+
+def print_report(size: int, seed_seconds: float, cycles: List[Dict[str, Any]], bot: FakeBot):
+    print(f"\n📊 Симуляция напоминаний: {size} пользователей")
+    print(f"• Заливка: {seed_seconds:.1f} с")
+    for n, cycle in enumerate(cycles, 1):
+        print(
+            f"• Цикл {n}: постановка {cycle['enqueue_seconds']:.2f} с "
+            f"({cycle['enqueue_queries']} запросов), доставка {cycle['drain_seconds']:.2f} с, "
+            f"({cycle['delivery_queries']} запросов), "
+            f"отправлено {cycle['sends']} ({cycle['sends_per_sec']:.0f}/с), "
+            f"всего запросов {cycle['total_queries']}"
+            + (f", не доставлено {cycle['left_pending']}" if cycle['left_pending'] else "")
+        )
+    pool = db.get_pool_stats()
+    print(f"• Запросы к БД: avg {pool['query_avg_ms']:.1f} мс, p95 {pool['query_p95_ms']:.1f} мс")
+    print(f"• Ошибки бота: {bot.errors} временных, {bot.blocked} заблокировавших")
+    print(f"• Дубли: {bot.duplicates}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Симуляция конвейера напоминаний на синтетических данных")
+    parser.add_argument('preset', choices=list(PRESETS), help='Размер набора')
+    parser.add_argument('--size', type=int, help='Своё количество пользователей вместо пресета')
+    parser.add_argument('--dsn', help='База для симуляции (по умолчанию DATABASE_URL)')
+    parser.add_argument('--cycles', type=int, default=2, help='Сколько циклов прогнать (повторные не должны слать дубли)')
+    parser.add_argument('--latency-ms', type=float, default=5.0, help='Задержка фейкового Telegram')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Доля временных ошибок отправки')
+    parser.add_argument('--blocked-rate', type=float, default=0.0, help='Доля пользователей, заблокировавших бота')
+    parser.add_argument('--workers', type=int, help='Воркеры message_outbox (по умолчанию OUTBOX_WORKERS)')
+    parser.add_argument('--drain-timeout', type=float, default=600.0, help='Сколько ждать доставку в цикле, с')
+    parser.add_argument('--seed', type=int, default=42, help='Seed генератора')
+    parser.add_argument('--cleanup', action='store_true', help='Удалить синтетические данные после прогона')
+    parser.add_argument('--force', action='store_true', help='Разрешить запуск при ENVIRONMENT=production')
+    args = parser.parse_args()
+
+    if config.ENVIRONMENT == 'production' and not args.force and not args.dsn:
+        parser.error("ENVIRONMENT=production: укажите --dsn тестовой базы или --force")
+
+    if args.dsn:
+        config.DATABASE_URL = args.dsn
+    # Быстрые повторы и опрос, чтобы не ждать минутами
+    config.OUTBOX_POLL_INTERVAL = 0.1
+    config.OUTBOX_RETRY_BASE_SECONDS = 0.2
+    if args.workers:
+        config.OUTBOX_WORKERS = args.workers
+
+    size = args.size or PRESETS[args.preset]
+    rng = random.Random(args.seed)
+    bot = FakeBot(args.latency_ms, args.error_rate, args.blocked_rate, seed=args.seed)
+
+    await db.connect()
+    try:
+        # ENVIRONMENT не защищает staging и восстановленные дампы: фейковый бот
+        # пометил бы реальные сообщения доставленными, а напоминания — отправленными
+        found = await real_data()
+        if found:
+            details = ", ".join(f"{table}: {count}" for table, count in found.items())
+            parser.error(f"в базе есть несинтетические данные ({details}); нужна пустая тестовая база")
+
+        await cleanup()
+        seed_seconds = await seed(size, rng)
+
+        reminders.bot = bot
+        # Все партиции — этому процессу
+        reminders.partitions = None
+        # file_id фейкового бота не должны попасть в общий кэш telegram_assets
+        assets.persist = False
+        cycles = []
+        for _ in range(args.cycles):
+            cycles.append(await run_cycle(bot, args.drain_timeout))
+
+        print_report(size, seed_seconds, cycles, bot)
+
+        if args.cleanup:
+            await cleanup()
+            print("🧹 Синтетические данные удалены")
+    finally:
+        await db.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    asyncio.run(main())
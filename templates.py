@@ -0,0 +1,234 @@
+"""
+Реестр шаблонов напоминаний и настроек кампании
+
+Шаблоны компилируются один раз (string.Template) и могут переопределяться
+в БД (reminder_templates, campaign_settings) без редеплоя — реестр
+перечитывает их, когда меняется updated_at (при UPDATE его сдвигает
+триггер). Отрендеренные тексты кэшируются по (тип, этап, вариант, версия
+кампании). Несколько активных вариантов одного шаблона — A/B-тест: вариант
+выбирается детерминированно по user_id с учётом весов, назначение
+записывается в reminder_assignments.
+"""
+import asyncio
+import logging
+import zlib
+from string import Template
+from typing import Optional, Dict, Any, List, Tuple
+
+import config
+from database import db
+
+logger = logging.getLogger(__name__)
+
+# Настройки кампании по умолчанию (переопределяются в campaign_settings)
+DEFAULT_CAMPAIGN = {
+    'promo_deadline': '10 ноября 2025',
+    'promo_deadline_short': '10 ноября',
+}
+
+# Этап '*' — шаблон для любого этапа
+ANY_STEP = '*'
+
+# (тип напоминания, этап) -> текст; $переменные берутся из кампании и данных пользователя
+DEFAULT_TEMPLATES = {
+    ('incomplete_1h', 'email'): """
+⏰ <b>Напоминание</b>
+
+Вы начали регистрацию, но не завершили процесс.
+
+💡 После завершения получите промокод <b>−10%</b> (до 10 000 ₽) и доступ к корпоративным тарифам со скидками до 40%.
+
+Нажмите /start, чтобы продолжить регистрацию.
+""",
+    ('incomplete_1h', 'inn'): """
+⏰ <b>Напоминание</b>
+
+Вы зарегистрировались в Яндекс.Путешествиях, но не ввели ИНН вашей компании.
+
+💡 После завершения получите промокод <b>−10%</b> (до 10 000 ₽) и доступ к корпоративным тарифам со скидками до 40%.
+
+Нажмите /start, чтобы продолжить регистрацию.
+""",
+    ('incomplete_1h', 'confirmation'): """
+⏰ <b>Напоминание</b>
+
+Вы ввели все данные, но не подтвердили участие в партнёрстве.
+
+💡 После завершения получите промокод <b>−10%</b> (до 10 000 ₽) и доступ к корпоративным тарифам со скидками до 40%.
+
+Нажмите /start, чтобы продолжить регистрацию.
+""",
+    ('incomplete_24h', 'email'): """
+🔄 <b>Почти готово!</b>
+
+Остался один шаг до получения доступа к корпоративным тарифам Яндекс.Путешествий (скидки до 40%) и промокода −10%.
+
+📧 Укажите email от YouTravel, чтобы активировать персональную скидку.
+
+Нажмите /start, чтобы продолжить регистрацию.
+""",
+    ('incomplete_24h', 'inn'): """
+🔄 <b>Почти готово!</b>
+
+Остался один шаг до получения доступа к корпоративным тарифам Яндекс.Путешествий (скидки до 40%) и промокода −10%.
+
+💼 Укажите ИНН вашей компании, чтобы активировать персональную скидку.
+
+Нажмите /start, чтобы продолжить регистрацию.
+""",
+    ('incomplete_24h', 'confirmation'): """
+🔄 <b>Почти готово!</b>
+
+Остался один шаг до получения доступа к корпоративным тарифам Яндекс.Путешествий (скидки до 40%) и промокода −10%.
+
+✅ Подтвердите участие в партнёрстве, чтобы активировать скидку.
+
+Нажмите /start, чтобы продолжить регистрацию.
+""",
+    ('incomplete_3d', ANY_STEP): """
+🎯 <b>Последний шанс!</b>
+
+Завершите регистрацию и получите:
+• Скидки до 40% на отели в России и за рубежом
+• Промокод −10% (до 10 000 ₽) на бронирования до $promo_deadline_short
+• Корпоративный кабинет с удобной аналитикой и поддержкой 24/7
+
+Нажмите /start, чтобы завершить.
+""",
+    ('promo_reminder', ANY_STEP): """
+🎟️ <b>Напоминание о промокоде</b>
+
+Не забудьте использовать ваш промокод: <b>$promo_code</b>
+
+💡 Он суммируется с корпоративными тарифами (до 40%) и действует до <b>$promo_deadline</b>.
+
+Перейдите на <a href="https://travel.yandex.ru">travel.yandex.ru</a>, выберите отель и введите код при оплате.
+""",
+}
+
+
+class TemplateRegistry:
+    def __init__(self):
+        self.campaign: Dict[str, str] = dict(DEFAULT_CAMPAIGN)
+        # (тип, этап) -> [(вариант, вес, шаблон)]
+        self._variants: Dict[Tuple[str, str], List[Tuple[str, int, Template]]] = {
+            key: [('a', 1, Template(body))] for key, body in DEFAULT_TEMPLATES.items()
+        }
+        # (тип, этап, вариант, версия) -> шаблон с подставленной кампанией
+        self._rendered: Dict[Tuple[str, str, str, int], Template] = {}
+        self.version = 0
+        self._stamp = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def load(self):
+        """Перечитать шаблоны и настройки кампании из БД поверх встроенных"""
+        async with db.acquire() as conn:
+            # Версия = время последней правки + число строк (ловит и удаления)
+            stamp = tuple(await conn.fetchrow("""
+                SELECT
+                    (SELECT MAX(updated_at) FROM reminder_templates),
+                    (SELECT COUNT(*) FROM reminder_templates),
+                    (SELECT MAX(updated_at) FROM campaign_settings),
+                    (SELECT COUNT(*) FROM campaign_settings)
+            """))
+            if stamp == self._stamp and self.version:
+                return
+            templates = await conn.fetch("""
+                SELECT reminder_type, step, variant, weight, body
+                FROM reminder_templates
+                WHERE active
+                ORDER BY reminder_type, step, variant
+            """)
+            settings = await conn.fetch("SELECT key, value FROM campaign_settings")
+
+        variants = {
+            key: [('a', 1, Template(body))] for key, body in DEFAULT_TEMPLATES.items()
+        }
+        overridden = set()
+        for row in templates:
+            key = (row['reminder_type'], row['step'])
+            if key not in overridden:
+                # Шаблоны из БД заменяют встроенные для этого (тип, этап) целиком
+                variants[key] = []
+                overridden.add(key)
+            variants[key].append((row['variant'], max(row['weight'], 0), Template(row['body'])))
+
+        # Шаблон '*' из БД важнее встроенных для конкретных этапов: оставляем
+        # только этапы, которые переопределены в БД явно
+        any_step_types = {reminder_type for reminder_type, step in overridden if step == ANY_STEP}
+        for key in list(variants):
+            if key[0] in any_step_types and key[1] != ANY_STEP and key not in overridden:
+                del variants[key]
+
+        campaign = dict(DEFAULT_CAMPAIGN)
+        campaign.update({row['key']: row['value'] for row in settings})
+
+        self._variants, self.campaign = variants, campaign
+        self._rendered = {}
+        self._stamp = stamp
+        self.version += 1
+        logger.info(f"📝 Loaded reminder templates v{self.version} ({len(templates)} from DB)")
+
+    def start(self):
+        """Периодически проверять изменения в БД"""
+        if not self._task:
+            self._task = asyncio.create_task(self._reload_loop())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _reload_loop(self):
+        while True:
+            await asyncio.sleep(config.TEMPLATES_RELOAD_INTERVAL)
+            try:
+                await self.load()
+            except Exception as e:
+                logger.error(f"Template reload failed: {e}")
+
+    def _lookup(self, reminder_type: str, step: str) -> Optional[Tuple[str, List[Tuple[str, int, Template]]]]:
+        for key_step in (step, ANY_STEP):
+            variants = self._variants.get((reminder_type, key_step))
+            if variants:
+                return key_step, variants
+        return None
+
+    def choose_variant(self, user_id: int, reminder_type: str, step: str) -> Optional[str]:
+        """Вариант для пользователя: стабильный между вызовами и процессами"""
+        found = self._lookup(reminder_type, step)
+        if not found:
+            return None
+        variants = found[1]
+        total = sum(weight for _, weight, _ in variants)
+        if len(variants) == 1 or total <= 0:
+            return variants[0][0]
+        point = zlib.crc32(f"{user_id}:{reminder_type}".encode()) % total
+        for variant, weight, _ in variants:
+            if point < weight:
+                return variant
+            point -= weight
+        return variants[-1][0]
+
+    def render(self, reminder_type: str, step: str, variant: str = 'a', **values: Any) -> str:
+        """Текст напоминания; пустая строка — шаблона нет"""
+        found = self._lookup(reminder_type, step)
+        if not found:
+            return ""
+        key_step, variants = found
+
+        cache_key = (reminder_type, key_step, variant, self.version)
+        template = self._rendered.get(cache_key)
+        if template is None:
+            source = next((t for v, _, t in variants if v == variant), variants[0][2])
+            # Кампания подставляется один раз, на каждый вызов остаются только данные пользователя
+            template = Template(source.safe_substitute(self.campaign))
+            self._rendered[cache_key] = template
+
+        if not values:
+            return template.template
+        return template.safe_substitute(values)
+
+
+# Глобальный экземпляр
+templates = TemplateRegistry()
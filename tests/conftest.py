@@ -0,0 +1,9 @@
+import os
+import sys
+
+# Модули бота лежат в корне репозитория
+sys.path.insert(0, os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
+
+# config.py требует эти переменные; юнит-тестам не нужны ни бот, ни БД, ни таблицы
+for name in ('BOT_TOKEN', 'DATABASE_URL', 'GOOGLE_SHEET_EMAILS_ID', 'GOOGLE_SHEET_PROMOS_ID'):
+    os.environ.setdefault(name, 'test')
@@ -0,0 +1,74 @@
+"""
+Кольцевой буфер поминутных счётчиков для алертов по частоте ошибок
+"""
+import random
+
+from errorrate import MinuteRing
+
+
+def test_empty():
+    ring = MinuteRing()
+    assert ring.window(5) == 0
+    assert ring.window(60) == 0
+
+
+def test_same_minute():
+    ring = MinuteRing()
+    ring.add(100)
+    ring.add(100, 2)
+    assert ring.window(1) == 3
+    assert ring.window(5) == 3
+    assert ring.window(60) == 3
+
+
+def test_windows():
+    ring = MinuteRing()
+    ring.add(100)
+    ring.add(103)
+    assert ring.window(3) == 1     # минуты 101..103
+    assert ring.window(4) == 2     # минуты 100..103
+    assert ring.window(60) == 2
+
+
+def test_expiry_after_an_hour():
+    ring = MinuteRing()
+    ring.add(100)
+    ring.add(159)
+    assert ring.window(60) == 2
+    ring.add(160)
+    # Минута 100 вышла из часового окна
+    assert ring.window(60) == 2
+    assert ring.window(5) == 2
+
+
+def test_advance_without_errors():
+    ring = MinuteRing()
+    ring.add(100, 5)
+    ring.advance(104)
+    assert ring.window(5) == 5
+    ring.advance(105)
+    assert ring.window(5) == 0
+    assert ring.window(60) == 5
+
+
+def test_long_gap_resets():
+    ring = MinuteRing()
+    ring.add(100, 7)
+    ring.add(500)
+    assert ring.window(60) == 1
+    assert ring.window(5) == 1
+
+
+def test_matches_brute_force():
+    rng = random.Random(7)
+    ring = MinuteRing()
+    events = []
+    minute = 1000
+    for _ in range(2000):
+        minute += rng.choice((0, 0, 0, 1, 1, 2, 7, 61))
+        count = rng.randint(1, 3)
+        ring.add(minute, count)
+        events.append((minute, count))
+        for window in (1, 5, 60):
+            expected = sum(c for m, c in events if minute - window < m <= minute)
+            assert ring.window(window) == expected
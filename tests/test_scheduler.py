@@ -0,0 +1,92 @@
+"""
+Разбор cron-выражений планировщика
+"""
+from datetime import datetime
+
+import pytest
+
+from scheduler import CronSpec, _parse_cron_field
+
+
+def test_star_and_lists():
+    assert _parse_cron_field('*', 0, 6) == set(range(7))
+    assert _parse_cron_field('1,3,5', 0, 59) == {1, 3, 5}
+    assert _parse_cron_field('10-12', 0, 59) == {10, 11, 12}
+
+
+def test_steps():
+    assert _parse_cron_field('*/15', 0, 59) == {0, 15, 30, 45}
+    # N/step — с N до конца диапазона
+    assert _parse_cron_field('5/15', 0, 59) == {5, 20, 35, 50}
+    assert _parse_cron_field('10-30/10', 0, 59) == {10, 20, 30}
+    assert _parse_cron_field('1-5/2,20', 0, 59) == {1, 3, 5, 20}
+
+
+def test_sunday_as_seven():
+    assert CronSpec('0 0 * * 7').weekdays == {0}
+    assert CronSpec('0 0 * * 0').weekdays == {0}
+    assert CronSpec('0 0 * * 5-7').weekdays == {5, 6, 0}
+    assert CronSpec('0 0 * * 0,7').weekdays == {0}
+
+
+@pytest.mark.parametrize('spec', [
+    '60 * * * *',
+    '* 24 * * *',
+    '* * 0 * *',
+    '* * * 13 *',
+    '* * * * 8',
+    '*/0 * * * *',
+    '5-1 * * * *',
+    '* * *',
+    'a * * * *',
+])
+def test_invalid_specs(spec):
+    with pytest.raises(ValueError):
+        CronSpec(spec)
+
+
+def test_daily():
+    spec = CronSpec('0 9 * * *')
+    assert spec.next_after(datetime(2025, 1, 1, 8, 30)) == datetime(2025, 1, 1, 9, 0)
+    # Строго после: ровно 09:00 -> следующий день
+    assert spec.next_after(datetime(2025, 1, 1, 9, 0)) == datetime(2025, 1, 2, 9, 0)
+    assert spec.next_after(datetime(2025, 1, 1, 9, 0, 30)) == datetime(2025, 1, 2, 9, 0)
+
+
+def test_every_n_minutes():
+    spec = CronSpec('*/15 * * * *')
+    assert spec.next_after(datetime(2025, 1, 1, 10, 7)) == datetime(2025, 1, 1, 10, 15)
+    assert spec.next_after(datetime(2025, 1, 1, 23, 50)) == datetime(2025, 1, 2, 0, 0)
+
+
+def test_weekday_only():
+    # 1 января 2025 — среда
+    spec = CronSpec('0 0 * * 1')
+    assert spec.next_after(datetime(2025, 1, 1)) == datetime(2025, 1, 6)
+    assert CronSpec('30 6 * * 7').next_after(datetime(2025, 1, 1)) == datetime(2025, 1, 5, 6, 30)
+
+
+def test_day_of_month_or_day_of_week():
+    # Ограничены оба поля — достаточно совпадения любого (13-е число или пятница)
+    spec = CronSpec('0 0 13 * 5')
+    assert spec.next_after(datetime(2025, 1, 1)) == datetime(2025, 1, 3)
+    assert spec.next_after(datetime(2025, 1, 10)) == datetime(2025, 1, 13)
+    assert spec.next_after(datetime(2025, 1, 13)) == datetime(2025, 1, 17)
+
+
+def test_month_rollover():
+    assert CronSpec('0 0 1 * *').next_after(datetime(2025, 1, 31, 12)) == datetime(2025, 2, 1)
+    # В апреле нет 31-го — ближайшее 31 мая
+    assert CronSpec('0 0 31 * *').next_after(datetime(2025, 4, 1)) == datetime(2025, 5, 31)
+    # Переход через декабрь в следующий год
+    assert CronSpec('0 0 1 1 *').next_after(datetime(2025, 6, 1)) == datetime(2026, 1, 1)
+    assert CronSpec('15 10 * 3 *').next_after(datetime(2025, 12, 31, 23, 59)) == datetime(2026, 3, 1, 10, 15)
+
+
+def test_leap_day():
+    assert CronSpec('0 0 29 2 *').next_after(datetime(2025, 3, 1)) == datetime(2028, 2, 29)
+
+
+def test_never_fires():
+    with pytest.raises(ValueError):
+        CronSpec('0 0 31 2 *').next_after(datetime(2025, 1, 1))
@@ -3,7 +3,10 @@
 """
 import re
 import asyncio
-from typing import Optional, Dict, Any
+from datetime import datetime, timedelta
+from typing import Optional, Dict, Any, Tuple
+
+_EPOCH = datetime(1970, 1, 1)
 
 def validate_email(email: str) -> bool:
     """Валидация email"""
@@ -74,3 +77,16 @@ def mask_email(email: str) -> str:
         masked_local = local[0] + '*' * (len(local) - 2) + local[-1]
     
     return f"{masked_local}@{domain}"
+
+def encode_cursor(created_at: datetime, user_id: int) -> str:
+    """Кодирование keyset-курсора (created_at, user_id) для callback_data"""
+    micros = (created_at - _EPOCH) // timedelta(microseconds=1)
+    return f"{micros}_{user_id}"
+
+def decode_cursor(cursor: str) -> Optional[Tuple[datetime, int]]:
+    """Декодирование keyset-курсора, None если курсор некорректен"""
+    try:
+        micros, user_id = cursor.split('_')
+        return _EPOCH + timedelta(microseconds=int(micros)), int(user_id)
+    except (ValueError, AttributeError):
+        return None